@@ -1,114 +1,69 @@
-from flask import Flask, request, jsonify
-from threading import RLock
-from document import Document
+from flask import Flask, Response, g, request, jsonify
 from repo import DocumentRepo
 from new_db import NewDb
-import json  
-import uuid
-import requests
+import os
+import time
 from flask_cors import CORS 
+import metrics
+from handlers import DocumentApi, REQUEST_SECONDS, text_chunks
+from notifier import NotificationDispatcher
 
 
 app = Flask(__name__)
 app.secret_key = "super_secret_key"  
 CORS(app)
 
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_time(response):
+    # labeled by the route pattern, not the url, so document ids do not become labels
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    REQUEST_SECONDS.observe(time.perf_counter() - g.request_start, route=route, method=request.method, status=response.status_code)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 
 newDb = NewDb()
 newDb.init_repo()
 repo = DocumentRepo(newDb)
-repo_lock = RLock()
+repo.recover() # bring the snapshots up to the logged operations
 
 # WebSocket notification settings
-WS_NOTIFY_URL = "http://localhost:8081/notify"
-
-def notify_document_update(doc_id: str, action: str = "update"):
-    """
-    Notify the WebSocket server about a document update.
-    This will broadcast the update to all connected clients viewing this document.
-    """
-    try:
-        requests.post(
-            WS_NOTIFY_URL,
-            json={"doc_id": doc_id, "action": action},
-            timeout=1
-        )
-    except requests.exceptions.RequestException as e:
-        # Don't fail the main request if WebSocket notification fails
-        print(f"WebSocket notification failed: {e}")
-
-def is_valid_uuid(val):
-    try:
-        uuid.UUID(val)
-        return True
-    except ValueError:
-        return False
+# any worker's /notify reaches the subscribers of all workers sharing a pub/sub broker
+WS_NOTIFY_URL = os.environ.get("WS_NOTIFY_URL", "http://localhost:8081/notify")
+notifier = NotificationDispatcher(WS_NOTIFY_URL)
+# the route bodies, shared with async_server.py; updates are sent in the background, batched
+api = DocumentApi(repo, notifier.notify)
+
+def respond(result):
+    """Turns the (payload, status) of a DocumentApi method into a response, streaming iterators of chunks."""
+    payload, status = result
+    if isinstance(payload, dict):
+        return jsonify(payload), status
+    return Response(payload, status=status, mimetype='application/json')
 
 @app.route('/api/document', methods=['POST'])
 def create_document():
-    with repo_lock:
-        document_id = repo.create()
-    return jsonify({"result": "success", "value": document_id})
+    return respond(api.create_document())
 
 @app.route('/api/document', methods=['GET'])
 def list_documents():
-    with repo_lock:
-        items = repo.list_all()
-        return jsonify({"result": "success", "value": items})
+    return respond(api.list_documents(request.args))
 
 @app.route('/api/document/<doc_id>', methods=['GET'])
 def get_document(doc_id):
-    if not is_valid_uuid(doc_id):
-        return jsonify({"result": "error", "reason": "Invalid UUID"}), 400
-    with repo_lock:
-        root_document = repo.find_document_by_id(doc_id)
-        if root_document == None:
-            return jsonify({"result": "error", "reason": "Document not found"}), 404
-        path = request.args.get('path')
-        if path:
-            try:
-                val = root_document[path]
-                if hasattr(val, 'json'): # Handle if the result is another Document object
-                    return jsonify({"result": "success", "value": json.loads(val.json())})
-                return jsonify({"result": "success", "value": val})
-            except TypeError:
-                return jsonify({"result": "error", "reason": "Type error in path retrieval"}), 500
-            except KeyError:
-                return jsonify({"result" :"error", "reason": "Path not found"}), 404
-            except ValueError:
-                return jsonify({"result": "error", "reason": "Path is not appropriate"}), 404
-            except Exception as e:
-                return jsonify({"result": "error", "reason": f"An error occurred while retrieving the path: {str(e)}"}), 500
-        else:
-            return jsonify({"result": "success", "value": json.loads(root_document.json())})
+    return respond(api.get_document(doc_id, request.args))
 
 # insert document into document
 @app.route('/api/document/<doc_id>/insert/<doc_to_insert>', methods=['POST'])
 def insert_document(doc_id, doc_to_insert):
-    if not is_valid_uuid(doc_id) or not is_valid_uuid(doc_to_insert):
-        return jsonify({"result": "error", "reason": "Invalid UUID"}), 400
-    with repo_lock:
-        try:
-            root_doc = repo.find_document_by_id(doc_id)
-            found_doc = repo.find_document_by_id(doc_to_insert)
-            path = request.args.get('path') # path is required
-
-            if not root_doc:
-                return jsonify({"result": "error", "reason": f"Document with {doc_id} id is not found"}), 404
-
-            if not found_doc:
-                return jsonify({"result": "error", "reason": f"Document with {doc_id} id is not found"}), 404
-
-            if not path:
-                return jsonify({"result": "error", "reason": "Path is required"}), 400
-
-            root_doc[path] = found_doc
-            newDb.insert_document_to_document(doc_id, payload_id, path)
-            return jsonify({"result": "success", "value": f"Document with id {payload_id} is inserted at {path}"}), 201
-        except Exception as e:
-            return jsonify({"result": "error", "reason": str(e)}), 404
-
-
+    return respond(api.insert_document(doc_id, doc_to_insert, request.args.get('path')))
 
 # insert value into document
 @app.route('/api/document/<doc_id>/insert', methods=['POST'])
@@ -117,119 +72,40 @@ def insert_value(doc_id):
     insert a document with its id at a given path
     create a document with the data at a given path
     """
-    if not is_valid_uuid(doc_id):
-        return jsonify({"result": "error", "reason": "Invalid UUID"}), 400
-    with repo_lock:
-        try:
-            root_doc = repo.find_document_by_id(doc_id)
-            path = request.args.get('path') # path is required
-
-            if not root_doc:
-                return jsonify({"result": "error", "reason": f"Document with {doc_id} id is not found"}), 404
-            if not path:
-                return jsonify({"result": "error", "reason": "Path is required"}), 400
-
-            data = request.json 
-            if not isinstance(data, dict):
-                # doc[0/1] = 
-                root_doc[path] = data
-                return jsonify({"result": "success", "value": f"Data added at {path} path!"})
-
-            if data.get("markup"):
-                # Create a new element with the specified markup type
-                markup_type = data.get("markup")
-                root_doc[path] = markup_type  # This creates a new Document with this markup
-                # Save the updated tree to database
-                newDb.insert_document_tree(root_doc)
-                notify_document_update(doc_id, "insert")
-                return jsonify({"result": "success", "value": f"Element with markup '{markup_type}' created at {path}"}), 201
-
-            if data.get("value"):
-                # doc[0/1/content] = value
-                value = data.get("value")
-                root_doc[path] = value
-                # Save the updated tree to database
-                newDb.insert_document_tree(root_doc)
-                notify_document_update(doc_id, "insert")
-                return jsonify({"result": "success", "value": value + " is inserted at " + path}), 200
-
-        except Exception as e:
-            return jsonify({"result": "error", "reason": str(e)}), 404
+    return respond(api.insert_value(doc_id, request.args.get('path'), request.json))
+
+@app.route('/api/document/<doc_id>/batch', methods=['POST'])
+def apply_batch(doc_id):
+    return respond(api.apply_batch(doc_id, request.json))
+
+@app.route('/api/document/<doc_id>/ops', methods=['POST'])
+def apply_operations(doc_id):
+    return respond(api.apply_operations(doc_id, request.json))
 
 @app.route('/api/document/<doc_id>/delete', methods=['DELETE'])
 def document_delete(doc_id):
-    print("inside")
-    if not is_valid_uuid(doc_id):
-        print("invalid uuid")
-        return jsonify({"result": "error", "reason": "Invalid UUID"}), 400
-    with repo_lock:
-        try:
-            current_document = repo.find_document_by_id(doc_id)
-            if not current_document:
-                print("doc not found")
-                return jsonify({"result": "error", "reason": f"Document with {doc_id} id is not found"}), 404
-            path = request.args.get('path') # path is optional
-            print(path)
-            if not path:
-                repo.delete(doc_id)
-                notify_document_update(doc_id, "delete")
-                return jsonify({"result": "success", "value": f"Item with {doc_id} id is deleted!"})
-            newDb.delete_document(current_document[path].id)
-            del current_document[path]
-            notify_document_update(doc_id, "delete")
-            return jsonify({"result": "success", "value": f"Item at {path} path is deleted!"})
-        except ValueError as e:
-            return jsonify({"result": "error", "reason": "Path is not appropriate"}), 404
-        except Exception as e:
-            return jsonify({"result": "error", "reason": str(e)}), 404
+    return respond(api.delete(doc_id, request.args.get('path')))
 
 @app.route('/api/document/import', methods=['POST'])
 def import_json():
-    try:
-        new_doc = Document()
-        new_doc.importJson(request.json)
-        new_doc.regenerate_ids() 
-        newDb.insert_document_tree(new_doc)
-        notify_document_update(new_doc.id, "import")
-        return jsonify({"result": "success", "value": new_doc.id}), 201
-    except Exception as e:
-        return jsonify({"result": "error", "reason": str(e)}), 400
+    return respond(api.import_json(request.json))
+
+@app.route('/api/search', methods=['GET'])
+def search_all():
+    return respond(api.search(None, request.args))
 
 @app.route('/api/document/<doc_id>/search', methods=['GET'])
 def search_document(doc_id):
-    current_document = repo.find_document_by_id(doc_id)
-    query = request.args.get('q')
-    results = [json.loads(curr) for curr in current_document.search(query)]
-    return jsonify({"result": "success", "value": results})
+    return respond(api.search(doc_id, request.args))
 
 @app.route('/api/document/<doc_id>/draw', methods=['GET'])
 def draw_document(doc_id):
-    # 1. Find the root
-    current_document = repo.find_document_by_id(doc_id)
-    if not current_document:
-        return "Document not found", 404
-
-    path = request.args.get('path')
-    
-    try:
-        if path:
-            target_node = current_document[path]
-            return target_node.html()
-        else:
-            return current_document.html()
-    except Exception as e:
-        return f"Error resolving path: {str(e)}", 400
+    html, status = api.draw(doc_id, request.args.get('path'))
+    return Response(text_chunks(html), status=status, mimetype='text/html')
 
 @app.route('/api/document/<doc_id>/parent', methods=['GET'])
 def parent_document(doc_id):
-    parent = newDb.parent(doc_id) # parent is fake, dont do any operations with it
-    if parent == None:
-        return jsonify({"result": "error", "reason": "Document does not have a parent"})
-
-    result = {"id" : parent.id, "markup":parent.markup}
-    if parent.attributes != {}:
-        result.update(parent.attributes)
-    return jsonify({"result": "success", "value": result})
+    return respond(api.parent(doc_id))
 
 if __name__ == '__main__':
     app.run(debug=True, port=8000)
@@ -239,9 +115,12 @@ if __name__ == '__main__':
 @app.route('/api/document', methods=['GET'])
 @app.route('/api/document/<doc_id>', methods=['GET'])
 @app.route('/api/document/<doc_id>/insert', methods=['POST'])
+@app.route('/api/document/<doc_id>/batch', methods=['POST'])
+@app.route('/api/document/<doc_id>/ops', methods=['POST'])
 @app.route('/api/document/<doc_id>/delete', methods=['DELETE'])
 @app.route('/api/document/import', methods=['POST'])
 @app.route('/api/document/<doc_id>/search', methods=['GET'])
+@app.route('/api/search', methods=['GET'])
 @app.route('/api/document/<doc_id>/draw', methods=['GET'])
 @app.route('/api/document/<doc_id>/parent', methods=['GET'])
 """
@@ -0,0 +1,233 @@
+"""
+All-asyncio server: the REST API and the WebSocket hub in one process.
+
+Serves the same /api/document/... routes as api.py, both backed by
+handlers.DocumentApi, with aiohttp handlers on API_PORT and the WebSocket
+endpoint of websocket_server.py on WS_PORT, both on one event loop.
+Blocking SQLite and document work runs in a thread pool,
+and updates are broadcast by calling the connection manager directly instead
+of posting them to the /notify endpoint.
+
+    python3 async_server.py
+"""
+import asyncio
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+import websockets
+
+from handlers import DocumentApi, REQUEST_SECONDS, text_chunks
+from new_db import NewDb
+from repo import DocumentRepo
+from websocket_server import WS_HOST, WS_PORT, manager, websocket_handler, handle_health, handle_metrics
+
+logger = logging.getLogger(__name__)
+
+API_HOST = "localhost"
+API_PORT = 8000
+API_WORKERS = 16  # threads running blocking database and document work
+
+newDb = NewDb()
+newDb.init_repo()
+repo = DocumentRepo(newDb)
+repo.recover()
+executor = ThreadPoolExecutor(max_workers=API_WORKERS, thread_name_prefix="api-worker")
+loop: asyncio.AbstractEventLoop = None  # set by main()
+
+
+def publish(doc_id: str, action: str, ops: list = None, version: int = None):
+    """
+    Broadcasts an update through the connection manager.
+    Called from worker threads while they hold the document's write lock, so
+    updates reach the event loop in the order they were applied.
+    """
+    loop.call_soon_threadsafe(manager.publish, doc_id, action, ops, version)
+
+
+# the route bodies, shared with api.py, run in the thread pool
+api = DocumentApi(repo, publish)
+
+
+async def run_blocking(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+
+async def respond(request: web.Request, func, *args) -> web.StreamResponse:
+    """
+    Runs a DocumentApi method in the thread pool and sends the (payload, status) it returns.
+    An iterator of chunks is streamed, each chunk serialized in the thread pool too.
+    """
+    payload, status = await run_blocking(func, *args)
+    if isinstance(payload, dict):
+        return web.json_response(payload, status=status)
+    response = web.StreamResponse(status=status, headers={"Content-Type": "application/json"})
+    await response.prepare(request)
+    while True:
+        chunk = await run_blocking(next, payload, None)
+        if chunk is None:
+            break
+        await response.write(chunk.encode())
+    await response.write_eof()
+    return response
+
+
+async def read_json(request: web.Request):
+    """The JSON body of a request, raises HTTPBadRequest if it is not valid JSON."""
+    try:
+        return await request.json()
+    except json.JSONDecodeError:
+        raise web.HTTPBadRequest(text=json.dumps({"result": "error", "reason": "Invalid JSON"}),
+                                content_type="application/json", headers=CORS_HEADERS)
+
+
+# aiohttp handlers
+
+async def create_document(request):
+    return await respond(request, api.create_document)
+
+
+async def list_documents(request):
+    return await respond(request, api.list_documents, request.query)
+
+
+async def get_document(request):
+    return await respond(request, api.get_document, request.match_info["doc_id"], request.query)
+
+
+async def insert_document(request):
+    return await respond(request, api.insert_document, request.match_info["doc_id"],
+                         request.match_info["doc_to_insert"], request.query.get("path"))
+
+
+async def insert_value(request):
+    data = await read_json(request)
+    return await respond(request, api.insert_value, request.match_info["doc_id"], request.query.get("path"), data)
+
+
+async def apply_batch(request):
+    data = await read_json(request)
+    return await respond(request, api.apply_batch, request.match_info["doc_id"], data)
+
+
+async def apply_operations(request):
+    data = await read_json(request)
+    return await respond(request, api.apply_operations, request.match_info["doc_id"], data)
+
+
+async def document_delete(request):
+    return await respond(request, api.delete, request.match_info["doc_id"], request.query.get("path"))
+
+
+async def import_json(request):
+    data = await read_json(request)
+    return await respond(request, api.import_json, data)
+
+
+async def search(request):
+    return await respond(request, api.search, request.match_info.get("doc_id"), request.query)
+
+
+async def draw_document(request):
+    doc_id = request.match_info["doc_id"]
+    path = request.query.get("path")
+    # Served without locking, and without the thread pool, if the cached rendering is still current
+    html, status = api.cached_html(doc_id, path), 200
+    if html is None:
+        html, status = await run_blocking(api.draw, doc_id, path)
+    response = web.StreamResponse(status=status, headers={"Content-Type": "text/html; charset=utf-8"})
+    await response.prepare(request)
+    for chunk in text_chunks(html):
+        await response.write(chunk.encode())
+    await response.write_eof()
+    return response
+
+
+async def parent_document(request):
+    return await respond(request, api.parent, request.match_info["doc_id"])
+
+
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "GET, POST, DELETE, OPTIONS",
+    "Access-Control-Allow-Headers": "Content-Type",
+}
+
+
+@web.middleware
+async def cors_middleware(request, handler):
+    """Allows the frontend to call the API from another origin, like flask_cors does for api.py."""
+    if request.method == "OPTIONS":
+        return web.Response(headers=CORS_HEADERS)
+    response = await handler(request)
+    if not response.prepared:
+        response.headers.update(CORS_HEADERS)
+    return response
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    """Times every request, labeled by the route pattern so that document ids do not become labels."""
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource else "unmatched"
+        REQUEST_SECONDS.observe(time.perf_counter() - start, route=route, method=request.method, status=status)
+
+
+def create_app() -> web.Application:
+    app = web.Application(middlewares=[metrics_middleware, cors_middleware])
+    app.router.add_post("/api/document", create_document)
+    app.router.add_get("/api/document", list_documents)
+    app.router.add_post("/api/document/import", import_json)
+    app.router.add_get("/api/document/{doc_id}", get_document)
+    app.router.add_post("/api/document/{doc_id}/insert/{doc_to_insert}", insert_document)
+    app.router.add_post("/api/document/{doc_id}/insert", insert_value)
+    app.router.add_post("/api/document/{doc_id}/batch", apply_batch)
+    app.router.add_post("/api/document/{doc_id}/ops", apply_operations)
+    app.router.add_delete("/api/document/{doc_id}/delete", document_delete)
+    app.router.add_get("/api/document/{doc_id}/search", search)
+    app.router.add_get("/api/search", search)
+    app.router.add_get("/api/document/{doc_id}/draw", draw_document)
+    app.router.add_get("/api/document/{doc_id}/parent", parent_document)
+    app.router.add_get("/health", handle_health)
+    app.router.add_get("/metrics", handle_metrics)
+    return app
+
+
+async def main():
+    """Starts the API and the WebSocket server on one event loop."""
+    global loop
+    loop = asyncio.get_running_loop()
+    await manager.pubsub.start()
+
+    runner = web.AppRunner(create_app())
+    await runner.setup()
+    site = web.TCPSite(runner, API_HOST, API_PORT)
+    await site.start()
+    logger.info(f"API server started on http://{API_HOST}:{API_PORT}")
+
+    try:
+        async with websockets.serve(websocket_handler, WS_HOST, WS_PORT):
+            logger.info(f"WebSocket server started on ws://{WS_HOST}:{WS_PORT}")
+            await asyncio.Future()  # Run forever
+    finally:
+        await runner.cleanup()
+        executor.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        logger.info("Server shutdown requested")
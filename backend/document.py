@@ -1,34 +1,333 @@
+import base64
 import json
+import sys
 import uuid
 import time
-from threading import RLock
+from bisect import bisect_left
+from threading import Lock, RLock
+
+import metrics
+from order_keys import key_between, keys_between
+
+HTML_RENDER_SECONDS = metrics.histogram("html_render_seconds", "Time re-rendering the HTML of a tree, cached subtrees excluded")
+
+def _without_ids(data):
+    """Copy of a to_dict() tree without ids, so that importing it creates fresh ones."""
+    copy = {key: value for key, value in data.items() if key not in ('id', 'children')}
+    if 'children' in data:
+        copy['children'] = [_without_ids(child) for child in data['children']]
+    return copy
+
+_lazy_lock_guard = Lock() # creation of the per-node locks
+
+def new_id():
+    """A new node id: a uuid4 string, or its 22 character url-safe base64 form if Document.COMPACT_IDS is set."""
+    if Document.COMPACT_IDS:
+        return base64.urlsafe_b64encode(uuid.uuid4().bytes).rstrip(b"=").decode()
+    return str(uuid.uuid4())
 
 class Document:
     """
     Represents a node in a JSON-based rich text document.
     Each Document object is a node in a tree, with a markup type,
     attributes (like content, style, src), and a list of children.
+
+    Documents in the repo cache have many thousands of nodes, so nodes are
+    slotted, markup names are interned, and the observer set, the lock and
+    the description are only allocated when used.
     """
-    def __init__(self, markup='document', id=None, parent=None, attributes = {}):
-        self.markup = markup
-        self.description = "New document"
-        self.id = id if id else str(uuid.uuid4())
+    __slots__ = ('markup', 'id', 'children', 'attributes', 'parent_doc', 'position',
+                 '_description', '_observers', '_lock',
+                 'dirty_nodes', 'removed_ids', 'index', '_html', 'pending_ops')
+    COMPACT_IDS = False # generate short ids instead of uuid strings, see new_id()
+
+    def __init__(self, markup='document', id=None, parent=None, attributes=None):
+        self.markup = sys.intern(markup)
+        self._description = None
+        self.id = id if id else new_id()
         self.children = []
-        self.attributes = attributes
+        self.attributes = attributes if attributes is not None else {}
         self.parent_doc = parent
-        self.observers = set()
-        self.lock = RLock()
+        self.position = None # order key among siblings, see order_keys.py
+        self._observers = None
+        self._lock = None
+        # pending persistence changes, only kept on the root node
+        self.dirty_nodes = None
+        self.removed_ids = None
+        # id -> node for the whole tree, only kept on the root node
+        self.index = None
+        self._html = None # rendered fragment of roots, their top-level children and drawn subtrees, cleared when this subtree changes
+        # operations applied to the tree, only kept on the root node and only
+        # recorded once enabled with record_ops()
+        self.pending_ops = None
+
+    @property
+    def description(self):
+        return self._description if self._description is not None else "New document"
+
+    @description.setter
+    def description(self, value):
+        self._description = value
+
+    @property
+    def observers(self):
+        """The observers of this node, the set is allocated on first use."""
+        if self._observers is None:
+            self._observers = set()
+        return self._observers
+
+    @property
+    def lock(self):
+        """The lock of this node, created on first use."""
+        lock = self._lock
+        if lock is None:
+            with _lazy_lock_guard:
+                if self._lock is None:
+                    self._lock = RLock()
+                lock = self._lock
+        return lock
+
+    def _root(self):
+        root = self
+        while root.parent_doc:
+            root = root.parent_doc
+        return root
+
+    def _id_index(self):
+        """
+        Returns the id -> node map of the whole tree.
+        Built on first use, then kept up to date by the tree mutations.
+        """
+        root = self._root()
+        if root.index is None:
+            root.index = {}
+            root._index_subtree(root.index)
+        return root.index
+
+    def _index_subtree(self, index):
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            index[node.id] = node
+            stack.extend(node.children)
+
+    def _unindex_subtree(self, index):
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            index.pop(node.id, None)
+            stack.extend(node.children)
+
+    def _mark_dirty(self, subtree=False):
+        """
+        Records this node (and its descendants if subtree is set) as needing
+        its row rewritten on the next save.
+        """
+        root = self._root()
+        if root.dirty_nodes is None:
+            root.dirty_nodes = {}
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            root.dirty_nodes[node.id] = node
+            if root.removed_ids:
+                root.removed_ids.discard(node.id)
+            if subtree:
+                stack.extend(node.children)
+
+    def _mark_removed(self, root=None):
+        """Records this node and its descendants as deleted on the next save."""
+        root = root or self._root()
+        if root.removed_ids is None:
+            root.removed_ids = set()
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            root.removed_ids.add(node.id)
+            if root.dirty_nodes:
+                root.dirty_nodes.pop(node.id, None)
+            stack.extend(node.children)
+
+    def _insert_child(self, idx, child):
+        """
+        Inserts child at idx and gives it an order key between its new neighbours,
+        so no other sibling has to change.
+        """
+        self._ensure_positions()
+        before = self.children[idx - 1].position if idx > 0 else None
+        after = self.children[idx].position if idx < len(self.children) else None
+        child.position = key_between(before, after)
+        child.parent_doc = self
+        child.index = None
+        self.children.insert(idx, child)
+        root = self._root()
+        if root.index is not None:
+            child._index_subtree(root.index)
+        child._mark_dirty(subtree=True)
+        if root.pending_ops is not None:
+            child._record_op("insert", node=child.to_dict())
+
+    def _ensure_positions(self):
+        """Gives the children order keys if any of them is missing one."""
+        if any(child.position is None for child in self.children):
+            for child, key in zip(self.children, keys_between(None, None, len(self.children))):
+                child.position = key
+                child._mark_dirty(subtree=True)
+
+    def record_ops(self):
+        """
+        Starts recording the operations applied to this tree, see take_ops().
+        Must be called on the root of the tree.
+        """
+        if self.pending_ops is None:
+            self.pending_ops = []
+
+    def take_ops(self):
+        """
+        Returns the operations recorded since the last call and clears them.
+        Each is a dict with "op" (insert, delete, set, unset or replace) and a
+        "path" of child indices from the root, plus "node" for insert/replace,
+        "key" for set/unset and "value" for set.
+        """
+        ops = self.pending_ops or []
+        if self.pending_ops is not None:
+            self.pending_ops = []
+        return ops
+
+    def apply_op(self, op, keep_ids=False):
+        """
+        Applies an operation in the format of take_ops() to this tree, which must be the root.
+        Inserted and replaced nodes get fresh ids, the replaced node keeps its own,
+        unless keep_ids is set to replay recorded operations as they were.
+        """
+        with self.lock:
+            kind = op.get("op")
+            path = op.get("path") or ""
+            if kind == "insert":
+                parent_path, _, idx = path.rpartition("/")
+                node = self._node_at(parent_path)
+                idx = int(idx)
+                if idx > len(node.children):
+                    raise IndexError("Index out of bounds")
+                new_node = Document()
+                new_node._from_dict(op["node"] if keep_ids else _without_ids(op["node"]), parent=None)
+                node._insert_child(idx, new_node)
+            elif kind == "delete":
+                if not path:
+                    raise ValueError("Cannot delete the root")
+                self.__delitem__(path)
+                return
+            elif kind == "replace":
+                node = self._node_at(path)
+                data = op["node"] if keep_ids else dict(_without_ids(op["node"]), id=node.id)
+                node.importJson(data)
+                return
+            elif kind in ("set", "unset"):
+                node = self._node_at(path)
+                key = op["key"]
+                if kind == "set":
+                    node.attributes[key] = op.get("value")
+                elif key in node.attributes:
+                    del node.attributes[key]
+                else:
+                    return
+                node._mark_dirty()
+                node._record_op(kind, **{k: v for k, v in op.items() if k in ("key", "value")})
+            else:
+                raise ValueError(f"Unknown operation: {kind}")
+            node._notify_observers()
+
+    def apply_path_op(self, op):
+        """
+        Applies one edit with the same path semantics as doc[path] = value and del doc[path]:
+        {"op": "insert", "path": "0/1", "markup": "paragraph"}, or "node": {<document JSON>} to insert a subtree
+        {"op": "set", "path": "0/1/content", "value": "..."}
+        {"op": "delete", "path": "0/1"} or {"op": "delete", "path": "0/1/style"}
+        """
+        kind = op.get("op")
+        path = op.get("path")
+        if not path:
+            raise ValueError("Path is required")
+        leaf = path.rsplit("/", 1)[-1]
+        if kind == "insert":
+            if not leaf.isdigit():
+                raise ValueError(f"Insert path must end in an index: {path}")
+            if "node" in op:
+                node = Document()
+                node.importJson(op["node"])
+                self[path] = node # copied with fresh ids
+            elif op.get("markup"):
+                self[path] = op["markup"]
+            else:
+                raise ValueError("Insert needs a markup or a node")
+        elif kind == "set":
+            if leaf.isdigit():
+                raise ValueError(f"Set path must end in an attribute: {path}")
+            self[path] = op.get("value")
+        elif kind == "delete":
+            del self[path]
+        else:
+            raise ValueError(f"Unknown operation: {kind}")
+
+    def _node_at(self, path):
+        """Returns the node at a path of child indices ("" is this node)."""
+        node = self
+        for part in path.split("/") if path else []:
+            idx = int(part)
+            if not 0 <= idx < len(node.children):
+                raise IndexError(f"Path index out of bounds: {path}")
+            node = node.children[idx]
+        return node
+
+    def _record_op(self, op, **fields):
+        root = self._root()
+        if root.pending_ops is not None:
+            root.pending_ops.append({"op": op, "path": self._path_from_root(), **fields})
+
+    def _path_from_root(self):
+        parts = []
+        node = self
+        while node.parent_doc:
+            parts.append(str(node._index_in_parent()))
+            node = node.parent_doc
+        return "/".join(reversed(parts))
+
+    def take_changes(self):
+        """
+        Returns (dirty nodes, removed ids) recorded since the last call and clears them.
+        Must be called on the root of the tree.
+        """
+        dirty = list((self.dirty_nodes or {}).values())
+        removed = self.removed_ids or set()
+        self.dirty_nodes = None
+        self.removed_ids = None
+        return dirty, removed
+
+    def has_changes(self):
+        return bool(self.dirty_nodes or self.removed_ids)
+
+    def _invalidate_html(self):
+        """Drops the rendered HTML of this node and its ancestors, siblings keep theirs."""
+        node = self
+        while node:
+            node._html = None
+            node = node.parent_doc
 
     def _notify_observers(self):
+        self._invalidate_html()
         try:
             root = self
+            watched = bool(self._observers)
             while root.parent():
                 root = root.parent()
-            
+                watched = watched or bool(root._observers)
+            if not watched:
+                return
+
             html_snapshot = root.html()
             
             # Notify observers on this node
-            for obs in self.observers:
+            for obs in self._observers or ():
                 obs.update(html_snapshot, self.id)
                 
             # Bubble notification up to the parent
@@ -40,26 +339,34 @@ class Document:
 
     def _notify_observers_bubble(self, html_snapshot):
         """Helper to bubble notifications up without re-rendering HTML."""
-        for obs in self.observers:
+        for obs in self._observers or ():
             obs.update(html_snapshot, self.id)
         if self.parent_doc:
             self.parent_doc._notify_observers_bubble(html_snapshot)
 
-    def _get_path(self,idstr, current_path=""):
+    def _index_in_parent(self):
+        siblings = self.parent_doc.children
+        if self.position is not None:
+            # children are kept sorted by their order keys
+            idx = bisect_left(siblings, self.position, key=lambda c: c.position or "")
+            if idx < len(siblings) and siblings[idx] is self:
+                return idx
+        return siblings.index(self)
+
+    def _get_path(self,idstr):
         """
         Internal helper to find the path to a node with the given id.
         Returns the path as a string of indices separated by '/'.
         """
-        if self.id == idstr:
-            return current_path.rstrip('/')
-
-        for idx, child in enumerate(self.children):
-            child_path = f"{current_path}{idx}/"
-            result = child._get_path(idstr, child_path)
-            if result:
-                return result
-
-        return None
+        node = self.getid(idstr)
+        if node is None:
+            return None
+
+        parts = []
+        while node is not self:
+            parts.append(str(node._index_in_parent()))
+            node = node.parent_doc
+        return "/".join(reversed(parts))
     
     def importJson(self, data):
         """
@@ -67,7 +374,15 @@ class Document:
         This will overwrite the current node's data.
         """
         try:
+            root = self._root()
+            self._mark_removed(root)
+            if root.index is not None:
+                self._unindex_subtree(root.index)
             self._from_dict(data, parent=self.parent_doc)
+            if root.index is not None:
+                self._index_subtree(root.index)
+            self._mark_dirty(subtree=True)
+            self._record_op("replace", node=self.to_dict())
             self._notify_observers()
         except KeyError as e:
             raise ValueError(f"Missing expected key in JSON: {e}")
@@ -77,8 +392,8 @@ class Document:
         if 'markup' not in data:
             raise ValueError("Missing 'markup' in data")
             
-        self.markup = data['markup']
-        self.id = data.get('id', str(uuid.uuid4()))
+        self.markup = sys.intern(data['markup'])
+        self.id = data['id'] if 'id' in data else new_id()
         self.parent_doc = parent
         self.attributes = {}
         self.children = []
@@ -88,9 +403,11 @@ class Document:
             if key not in reserved_keys:
                 self.attributes[key] = value
 
-        for child_data in data.get('children', []):
-            child_doc = Document(parent=self)
+        children = data.get('children', [])
+        for child_data, key in zip(children, keys_between(None, None, len(children))):
+            child_doc = Document(id=child_data.get('id'), parent=self)
             child_doc._from_dict(child_data, parent=self)
+            child_doc.position = key
             self.children.append(child_doc)
 
     def _find_node_and_key(self, path):
@@ -149,7 +466,8 @@ class Document:
                 raise ValueError(f"Error getting item at path '{path}': {e}")
 
     def regenerate_ids(self):
-        self.id = str(uuid.uuid4())
+        self._root().index = None # rebuilt on next lookup
+        self.id = new_id()
         for child in self.children:
             if isinstance(child, Document):
                 child.regenerate_ids()
@@ -169,37 +487,34 @@ class Document:
                 if key.isdigit():
                     # This is an insertion/replacement at a numeric index
                     idx = int(key)
+                    if idx > len(node.children):
+                        raise IndexError("Index out of bounds")
                     if isinstance(value, Document):
                         newNode = Document()
                         newNode.importJson(value.to_dict())
                         newNode.regenerate_ids() 
-                        newNode.parent_doc = node
-                        if idx == len(node.children):
-                            node.children.append(newNode)
-                        else:
-                            node.children.insert(idx, newNode)
+                        newNode.take_changes() # tracked on the tree it joins below
+                        node._insert_child(idx, newNode)
                     elif isinstance(value, tuple):
                         new_node = Document(id=value[0], markup=value[1], parent=node, attributes=json.loads(value[2]))
-                        if idx == len(node.children):
-                            node.children.append(new_node)
-                        else:
-                            node.children.insert(idx, new_node)
-
+                        node._insert_child(idx, new_node)
                     else:
                         new_node = Document(markup=str(value), parent=node)
-
-                        if idx == len(node.children):
-                            node.children.append(new_node)
-                        else:
-                            # Insert at position, shifting others
-                            node.children.insert(idx, new_node)
+                        # Insert at position, shifting others
+                        node._insert_child(idx, new_node)
 
                 elif key in ('text', 'content'):
                     node.attributes['content'] = value
+                    node._mark_dirty()
+                    node._record_op("set", key='content', value=value)
                 elif node.attributes.get(key):
                     node.attributes[key] = value
+                    node._mark_dirty()
+                    node._record_op("set", key=key, value=value)
                 else:
                     node.attributes[key] = value
+                    node._mark_dirty()
+                    node._record_op("set", key=key, value=value)
 
                 # Notify observers starting from the modified node
                 node._notify_observers()
@@ -220,14 +535,25 @@ class Document:
                 if key.isdigit():
                     idx = int(key)
                     if 0 <= idx < len(node.children):
+                        removed = node.children[idx]
+                        removed._record_op("delete")
+                        removed._mark_removed()
+                        root = self._root()
+                        if root.index is not None:
+                            removed._unindex_subtree(root.index)
                         del node.children[idx]
+                        removed.parent_doc = None
                     else:
                         raise IndexError("Index out of bounds")
                 elif key == 'text':
                     if 'content' in node.attributes:
                         del node.attributes['content']
+                        node._mark_dirty()
+                        node._record_op("unset", key='content')
                 elif key in node.attributes:
                     del node.attributes[key]
+                    node._mark_dirty()
+                    node._record_op("unset", key=key)
                 else:
                     raise ValueError(f"Invalid key in path: {key}")
 
@@ -265,13 +591,11 @@ class Document:
                     idx = int(key)
                     newNode = Document()
                     newNode.importJson(document.to_dict())
+                    newNode.take_changes() # tracked on the tree it joins below
+                    if idx > len(node.children):
+                        raise IndexError("Index out of bounds")
                     # Set parent of the inserted document
-                    newNode.parent_doc = node
-
-                    if idx == len(node.children):
-                        node.children.append(newNode)
-                    else:
-                        node.children.insert(idx, newNode)
+                    node._insert_child(idx, newNode)
 
                     # Notify observers
                     node._notify_observers()
@@ -282,14 +606,13 @@ class Document:
                 raise ValueError(f"Error inserting at path '{path}': {e}")
 
     def getid(self, idstr):
-        if self.id == idstr:
-            return self
-        
-        for child in self.children:
-            found = child.getid(idstr)
-            if found:
-                return found
-        return None
+        """Returns the node with the given id in this subtree, or None."""
+        found = self._id_index().get(idstr)
+        # the index covers the whole tree, make sure the node is under self
+        node = found
+        while node is not None and node is not self:
+            node = node.parent_doc
+        return found if node is self else None
 
     def search(self, text):
         results = []
@@ -310,12 +633,49 @@ class Document:
         print(self.html())
 
     def html(self):
+        """Returns the rendered HTML, re-rendering only the parts changed since the last call."""
+        if self._html is None:
+            with HTML_RENDER_SECONDS.time():
+                self._html = self._render_html()
+        return self._html
 
+    def _cached_html(self):
+        """
+        html() without the timing, for the nested calls of a render.
+        Only the top-level children keep their rendering, so that an edit re-renders
+        one of them while the memo stays at about twice the size of the document's HTML,
+        instead of a copy per level of nesting.
+        """
+        if self._html is not None:
+            return self._html
+        html = self._render_html()
+        if self.parent_doc is not None and self.parent_doc.parent_doc is None:
+            self._html = html
+        return html
+
+    def _tags(self):
+        """
+        Returns the (opening, closing) HTML around this node's children,
+        or None for leaves and unknown markups.
+        """
         style_attr = ""
         if self.attributes.get('style'):
             style_attribute = self.attributes.get('style')
             style_attr = f' style="{style_attribute}"' 
 
+        tag_map = {
+            'document': ('', ''),
+            'paragraph': (f'\t<p{style_attr}>\n', '\n</p>\n'),
+            'strong': (f'<strong{style_attr}>', '</strong>'),
+            'list': (f'\t<ul{style_attr}>\n', '</ul>\n'),
+            'item': (f'\t<li{style_attr}>\n', '\n</li>\n'),
+            'table': (f'\t<table{style_attr}>\n', '</table>\n'),
+            'row': (f'\t<tr{style_attr}>\n', '</tr>\n'),
+            'cell': (f'\t<td{style_attr}>\n', '\n</td>\n'),
+        }
+        return tag_map.get(self.markup)
+
+    def _render_html(self):
         if self.markup == 'text':
             return self.attributes.get('content') or ""
             
@@ -324,27 +684,25 @@ class Document:
             return f'\t<img src="{src}" alt="image" />\n' if src else '\t<img alt="image" />\n'
 
         # Handle other markups by processing children
-        children_html = "".join([child.html() for child in self.children])
+        children_html = "".join([child._cached_html() for child in self.children])
         
-        tag_map = {
-            'document': lambda: children_html,
-            'paragraph': lambda: f'\t<p{style_attr}>\n{children_html}\n</p>\n',
-            'strong': lambda: f'<strong{style_attr}>{children_html}</strong>',
-            'list': lambda: f'\t<ul{style_attr}>\n{children_html}</ul>\n',
-            'item': lambda: f'\t<li{style_attr}>\n{children_html}\n</li>\n',
-            'table': lambda: f'\t<table{style_attr}>\n{children_html}</table>\n',
-            'row': lambda: f'\t<tr{style_attr}>\n{children_html}</tr>\n',
-            'cell': lambda: f'\t<td{style_attr}>\n{children_html}\n</td>\n',
-        }
-        
-        if self.markup in tag_map:
-            return tag_map[self.markup]()
+        tags = self._tags()
+        if tags:
+            return tags[0] + children_html + tags[1]
         if children_html:
             # Default
+            style_attr = f' style="{self.attributes["style"]}"' if self.attributes.get('style') else ""
             return f'\t<div{style_attr}>\n{children_html}\n</div>\n'
         else:
             return ""
-    def to_dict(self):
+
+    def to_dict(self, depth=None, offset=0, limit=None):
+        """
+        Returns the tree as nested dicts.
+        depth limits the levels of children included (0 is this node alone),
+        nodes whose children are left out get "children_count" instead.
+        offset and limit select a window of this node's own children.
+        """
         d = {}
         d["markup"] = self.markup
         d["id"] = self.id
@@ -353,7 +711,11 @@ class Document:
         d.update(attrs)
 
         if self.children:
-            d["children"] = [child.to_dict() for child in self.children]
+            if depth == 0:
+                d["children_count"] = len(self.children)
+            else:
+                children = self.children[offset:offset + limit if limit is not None else None]
+                d["children"] = [child.to_dict(depth - 1 if depth is not None else None) for child in children]
 
         return d
 
@@ -364,7 +726,8 @@ class Document:
         self.observers.add(obj)
 
     def unwatch(self, obj):
-        self.observers.discard(obj)
+        if self._observers:
+            self._observers.discard(obj)
 
     def print(self):
         print(self.json())
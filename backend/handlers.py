@@ -0,0 +1,441 @@
+"""
+Route bodies of the document API, shared by api.py (Flask) and async_server.py (aiohttp).
+
+The servers only parse requests, call a DocumentApi method and turn what it
+returns into a response. Every method blocks on the repo's locks and SQLite,
+so async_server.py runs them in its thread pool. They return (payload,
+status): payload is a dict sent as JSON, or for document reads an iterator
+of JSON chunks to stream, serialized from a copy of the document taken
+under its read lock. draw() returns (html, status), streamed in
+text_chunks() of the rendered string. Both are complete before the first
+chunk is sent: streaming keeps serialization and sending out of the lock
+and bounds the size of each write, not the time to the first byte.
+
+    api = DocumentApi(repo, publish)
+    payload, status = api.get_document(doc_id, request.args)
+
+publish(doc_id, action, ops, version) hands an update to the WebSocket
+fan-out, like NotificationDispatcher.notify or DocumentConnectionManager.publish.
+"""
+import base64
+import json
+import uuid
+
+import metrics
+from document import Document
+from ot import VersionError
+
+STREAM_CHUNK_SIZE = 64 * 1024
+SEARCH_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+MAX_BATCH_OPERATIONS = 10000
+CHILDREN_MAX_LIMIT = 1000
+LIST_LIMIT = 50
+LIST_MAX_LIMIT = 200
+
+REQUEST_SECONDS = metrics.histogram("http_request_seconds", "Time handling API requests", ("route", "method", "status"))
+
+
+def is_valid_uuid(val):
+    """Accepts uuid strings and the compact ids of Document.COMPACT_IDS."""
+    try:
+        if len(val) == 22:
+            uuid.UUID(bytes=base64.urlsafe_b64decode(val + "=="))
+        else:
+            uuid.UUID(val)
+        return True
+    except (ValueError, TypeError):
+        return False
+
+
+def buffered(pieces, size=STREAM_CHUNK_SIZE):
+    """Joins the small pieces of a generator into chunks of about size characters."""
+    buf = []
+    length = 0
+    for piece in pieces:
+        buf.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield "".join(buf)
+            buf = []
+            length = 0
+    if buf:
+        yield "".join(buf)
+
+
+def text_chunks(text: str, size=STREAM_CHUNK_SIZE):
+    """
+    Yields an immutable string, e.g. a rendering from Document.html(), in
+    slices of size characters, so it is streamed without holding any lock.
+    The string itself is already whole in memory.
+    """
+    for start in range(0, len(text), size):
+        yield text[start:start + size]
+
+
+def document_response(doc, version: int = None, depth: int = None, offset: int = 0, limit: int = None) -> dict:
+    """
+    {"result": "success", "value": <doc>, "version": <version>}, with the
+    document copied by Document.to_dict(depth, offset, limit). Built under
+    the caller's read lock; the copy can be serialized after releasing it.
+    With a window of children it also has "children_total" and "next_offset",
+    the offset of the next window or null on the last one.
+    """
+    response = {"result": "success", "value": doc.to_dict(depth, offset, limit)}
+    if version is not None:
+        response["version"] = version
+    if offset or limit is not None:
+        total = len(doc.children)
+        end = total if limit is None else min(offset + limit, total)
+        response["children_total"] = total
+        response["next_offset"] = end if end < total else None
+    return response
+
+
+def stream_json(response: dict):
+    """
+    Yields the JSON of a document_response() in chunks of about STREAM_CHUNK_SIZE
+    characters, each child of the document encoded on its own, so the JSON of a
+    large document is never one string in memory. The dict copy it is encoded
+    from is, in full, before the first chunk.
+    """
+    def pieces():
+        value = response["value"]
+        children = value.get("children")
+        if not children:
+            yield json.dumps(response)
+            return
+        head = json.dumps({key: item for key, item in value.items() if key != "children"})
+        yield '{"result": "success", "value": ' + head[:-1] + ', "children": ['
+        for i, child in enumerate(children):
+            yield (', ' if i else '') + json.dumps(child)
+        yield ']}'
+        rest = json.dumps({key: item for key, item in response.items() if key not in ("result", "value")})
+        yield (', ' + rest[1:]) if len(rest) > 2 else '}'
+    return buffered(pieces())
+
+
+def tree_args(args) -> tuple:
+    """
+    The depth, offset and limit query parameters of a document read, None
+    (0 for offset) where not given. Raises ValueError if one is not a valid number.
+    """
+    depth = int(args["depth"]) if "depth" in args else None
+    offset = int(args.get("offset", 0))
+    limit = min(int(args["limit"]), CHILDREN_MAX_LIMIT) if "limit" in args else None
+    if (depth is not None and depth < 0) or offset < 0 or (limit is not None and limit < 1):
+        raise ValueError("depth and offset must not be negative, limit must be positive")
+    return depth, offset, limit
+
+
+def error(reason: str, status: int) -> tuple:
+    return {"result": "error", "reason": reason}, status
+
+
+class DocumentApi:
+    """The document routes on top of a DocumentRepo, announcing changes through publish."""
+
+    def __init__(self, repo, publish):
+        self.repo = repo
+        self.publish = publish
+
+    def notify_document_update(self, doc_id: str, action: str = "update", root_id: str = None, ops: list = None):
+        """
+        Announces a document update to the clients viewing it.
+        ops are the applied operations (see Document.take_ops) with paths relative
+        to root_id; subscribers of the root get them so they can patch their copy
+        instead of reloading, along with the root's new version. Subscribers of
+        doc_id itself, if it is not the root, only get the action.
+        Called while holding the root's write lock, so updates are published in
+        the order they were applied.
+        """
+        version = self.repo.version(root_id) if root_id else None
+        targets = [doc_id] if not root_id or root_id == doc_id else [root_id, doc_id]
+        for target in targets:
+            if target == root_id:
+                self.publish(target, action, ops, version)
+            else:
+                self.publish(target, action, None, None)
+
+    def create_document(self):
+        return {"result": "success", "value": self.repo.create()}, 200
+
+    def list_documents(self, args):
+        """
+        Lists root documents with their titles and sizes, limit at a time.
+        Pass the next_cursor of a response as cursor to get the next page, it is null on the last one.
+        """
+        try:
+            limit = min(max(int(args.get("limit", LIST_LIMIT)), 1), LIST_MAX_LIMIT)
+        except ValueError:
+            return error("limit must be an integer", 400)
+        items, next_cursor = self.repo.list_all(args.get("cursor"), limit)
+        return {"result": "success", "value": items, "next_cursor": next_cursor}, 200
+
+    def get_document(self, doc_id, args):
+        if not is_valid_uuid(doc_id):
+            return error("Invalid UUID", 400)
+        path = args.get("path")
+        try:
+            depth, offset, limit = tree_args(args)
+        except ValueError as e:
+            return error(str(e), 400)
+        repo = self.repo
+        with repo.reading(doc_id):
+            if not path and depth is None:
+                root_document = repo.find_document_by_id(doc_id)
+                if root_document is None:
+                    return error("Document not found", 404)
+                response = document_response(root_document, repo.version(root_document._root().id), depth, offset, limit)
+            else:
+                try:
+                    # loads only the subtree at path if the document is not cached,
+                    # one level deeper than depth to count the children left out
+                    root_id, val = repo.find_path(doc_id, path or "", depth + 1 if depth is not None else None)
+                    if root_id is None:
+                        return error("Document not found", 404)
+                    # the version of the whole tree, edits sent to /ops are based on it
+                    version = repo.version(root_id)
+                    if not isinstance(val, Document):
+                        return {"result": "success", "value": val}, 200
+                    response = document_response(val, version, depth, offset, limit)
+                except TypeError:
+                    return error("Type error in path retrieval", 500)
+                except KeyError:
+                    return error("Path not found", 404)
+                except ValueError:
+                    return error("Path is not appropriate", 404)
+                except Exception as e:
+                    return error(f"An error occurred while retrieving the path: {str(e)}", 500)
+        # serialized after releasing the lock, from the copy
+        return stream_json(response), 200
+
+    def insert_document(self, doc_id, doc_to_insert, path):
+        """Inserts a copy of the document doc_to_insert, with fresh ids, at path of doc_id."""
+        if not is_valid_uuid(doc_id) or not is_valid_uuid(doc_to_insert):
+            return error("Invalid UUID", 400)
+        if not path:
+            return error("Path is required", 400)
+        repo = self.repo
+        try:
+            # Copy the inserted document under its own lock first, so the two
+            # documents are never locked at the same time
+            with repo.reading(doc_to_insert):
+                found_doc = repo.find_document_by_id(doc_to_insert)
+                if not found_doc:
+                    return error(f"Document with {doc_to_insert} id is not found", 404)
+                source = Document()
+                source.importJson(found_doc.to_dict())
+
+            with repo.writing(doc_id):
+                root_doc = repo.find_document_by_id(doc_id)
+                if not root_doc:
+                    return error(f"Document with {doc_id} id is not found", 404)
+                root_doc[path] = source # copied with fresh ids
+                root_id, ops = repo.save(root_doc)
+                self.notify_document_update(doc_id, "insert", root_id, ops)
+            return {"result": "success", "value": f"Document with id {doc_to_insert} is inserted at {path}"}, 201
+        except Exception as e:
+            return error(str(e), 404)
+
+    def insert_value(self, doc_id, path, data):
+        """
+        Sets path of doc_id to data if it is not an object, else creates an
+        element {"markup": ...} or sets a {"value": ...} at path.
+        """
+        if not is_valid_uuid(doc_id):
+            return error("Invalid UUID", 400)
+        if not path:
+            return error("Path is required", 400)
+        repo = self.repo
+        with repo.writing(doc_id):
+            try:
+                root_doc = repo.find_document_by_id(doc_id)
+                if not root_doc:
+                    return error(f"Document with {doc_id} id is not found", 404)
+
+                if not isinstance(data, dict):
+                    # doc[0/1] =
+                    root_doc[path] = data
+                    root_id, ops = repo.save(root_doc)
+                    self.notify_document_update(doc_id, "insert", root_id, ops)
+                    return {"result": "success", "value": f"Data added at {path} path!"}, 200
+
+                if data.get("markup"):
+                    # Create a new element with the specified markup type
+                    markup_type = data.get("markup")
+                    root_doc[path] = markup_type
+                    root_id, ops = repo.save(root_doc)
+                    self.notify_document_update(doc_id, "insert", root_id, ops)
+                    return {"result": "success", "value": f"Element with markup '{markup_type}' created at {path}"}, 201
+
+                if data.get("value"):
+                    # doc[0/1/content] = value
+                    value = data.get("value")
+                    root_doc[path] = value
+                    root_id, ops = repo.save(root_doc)
+                    self.notify_document_update(doc_id, "insert", root_id, ops)
+                    return {"result": "success", "value": value + " is inserted at " + path}, 200
+
+                return error("Nothing to insert", 400)
+            except Exception as e:
+                return error(str(e), 404)
+
+    def apply_batch(self, doc_id, operations):
+        """
+        Applies an ordered list of insert/set/delete operations (see Document.apply_path_op)
+        to the document at once: under one lock, saved together and announced
+        with one notification. If any of them fails none is applied.
+        """
+        if not is_valid_uuid(doc_id):
+            return error("Invalid UUID", 400)
+        if isinstance(operations, dict):
+            operations = operations.get("ops")
+        if not isinstance(operations, list):
+            return error("Expected a list of operations", 400)
+        if len(operations) > MAX_BATCH_OPERATIONS:
+            return error(f"At most {MAX_BATCH_OPERATIONS} operations per batch", 400)
+        repo = self.repo
+        with repo.writing(doc_id):
+            current_document = repo.find_document_by_id(doc_id)
+            if not current_document:
+                return error(f"Document with {doc_id} id is not found", 404)
+            for i, op in enumerate(operations):
+                try:
+                    if not isinstance(op, dict):
+                        raise ValueError("Operation must be an object")
+                    current_document.apply_path_op(op)
+                except Exception as e:
+                    # none of the batch is kept, the tree is reloaded on the next request
+                    repo.discard(current_document._root().id)
+                    return {"result": "error", "reason": f"Operation {i} failed: {e}", "index": i}, 400
+            try:
+                root_id, ops = repo.save(current_document)
+            except Exception as e:
+                return error(str(e), 500)
+            self.notify_document_update(doc_id, "update", root_id, ops)
+            return {"result": "success", "value": f"{len(operations)} operations applied", "version": repo.version(root_id)}, 200
+
+    def apply_operations(self, doc_id, data):
+        """
+        Applies operations a client made on an older version of a document.
+        data: {"version": <version the ops were made on>, "ops": [<ops as in the document_update messages>]}
+        The ops are rebased over everything saved since that version (see ot.py),
+        so concurrent editors do not have to reload before every edit. Responds
+        with the ops as applied and the new version, or 409 if the version is too
+        old and the client has to reload.
+        """
+        if not is_valid_uuid(doc_id):
+            return error("Invalid UUID", 400)
+        if not isinstance(data, dict) or not isinstance(data.get("ops"), list) or not isinstance(data.get("version"), int):
+            return error('Expected {"version": int, "ops": [...]}', 400)
+        repo = self.repo
+        with repo.writing(doc_id):
+            try:
+                root_doc = repo.find_document_by_id(doc_id)
+                if not root_doc:
+                    return error(f"Document with {doc_id} id is not found", 404)
+                root_id, ops, version = repo.apply_ops(root_doc, data["ops"], data["version"])
+                self.notify_document_update(root_id, "update", root_id, ops)
+                return {"result": "success", "value": ops, "version": version}, 200
+            except VersionError as e:
+                return {"result": "error", "reason": str(e), "version": repo.version(root_doc._root().id)}, 409
+            except Exception as e:
+                return error(str(e), 400)
+
+    def delete(self, doc_id, path):
+        """Deletes the node at path of doc_id, or doc_id itself without a path."""
+        if not is_valid_uuid(doc_id):
+            return error("Invalid UUID", 400)
+        repo = self.repo
+        with repo.writing(doc_id):
+            try:
+                current_document = repo.find_document_by_id(doc_id)
+                if not current_document:
+                    return error(f"Document with {doc_id} id is not found", 404)
+                if not path:
+                    root_id, ops = repo.delete(doc_id)
+                    # a deleted root has no version to patch, its viewers just learn it is gone
+                    self.notify_document_update(doc_id, "delete", None if root_id == doc_id else root_id, ops)
+                    return {"result": "success", "value": f"Item with {doc_id} id is deleted!"}, 200
+                del current_document[path]
+                root_id, ops = repo.save(current_document)
+                self.notify_document_update(doc_id, "delete", root_id, ops)
+                return {"result": "success", "value": f"Item at {path} path is deleted!"}, 200
+            except ValueError:
+                return error("Path is not appropriate", 404)
+            except Exception as e:
+                return error(str(e), 404)
+
+    def import_json(self, data):
+        try:
+            new_doc = Document()
+            new_doc.importJson(data)
+            new_doc.regenerate_ids()
+            self.repo.insert_tree(new_doc)
+            self.notify_document_update(new_doc.id, "import")
+            return {"result": "success", "value": new_doc.id}, 201
+        except Exception as e:
+            return error(str(e), 400)
+
+    def search(self, doc_id, args):
+        """
+        Runs a full-text search with the q, limit and offset query parameters,
+        in the document doc_id or in all documents if it is None.
+        The response holds one page of matches and the offset of the next page, or null on the last one.
+        """
+        if doc_id is not None and not is_valid_uuid(doc_id):
+            return error("Invalid UUID", 400)
+        try:
+            limit = min(max(int(args.get("limit", SEARCH_LIMIT)), 1), SEARCH_MAX_LIMIT)
+            offset = max(int(args.get("offset", 0)), 0)
+        except ValueError:
+            return error("limit and offset must be integers", 400)
+        # the index follows the repo rows, which lag behind saves until the next checkpoint
+        if self.repo.catch_up(doc_id) is None and doc_id is not None:
+            return error("Document not found", 404)
+        # one extra row tells whether there is a next page
+        rows = self.repo.db.search(args.get("q") or "", doc_id, limit + 1, offset)
+        results = [{"id": row[0], "root_id": row[1], "content": row[2], "snippet": row[3], "score": row[4]}
+                   for row in rows[:limit]]
+        next_offset = offset + limit if len(rows) > limit else None
+        return {"result": "success", "value": results, "next_offset": next_offset}, 200
+
+    def cached_html(self, doc_id, path):
+        """The current rendering of a whole cached document, served without locking, else None."""
+        return None if path else self.repo.cached_html(doc_id)
+
+    def draw(self, doc_id, path):
+        """The HTML of doc_id, or of the element at path of it, as (text, status)."""
+        html = self.cached_html(doc_id, path)
+        if html is not None:
+            return html, 200
+        repo = self.repo
+        with repo.reading(doc_id):
+            try:
+                if path:
+                    # loads only the subtree at path if the document is not cached
+                    root_id, target_node = repo.find_path(doc_id, path)
+                    if root_id is None:
+                        return "Document not found", 404
+                    if not isinstance(target_node, Document):
+                        raise ValueError(f"{path} is not an element")
+                    return target_node.html(), 200
+                current_document = repo.find_document_by_id(doc_id)
+                if not current_document:
+                    return "Document not found", 404
+                return current_document.html(), 200
+            except Exception as e:
+                return f"Error resolving path: {str(e)}", 400
+
+    def parent(self, doc_id):
+        # from the cached tree, the repo table may be behind the logged operations
+        with self.repo.reading(doc_id):
+            node = self.repo.find_document_by_id(doc_id)
+            parent = node.parent_doc if node else None
+            if parent is None:
+                return error("Document does not have a parent", 200)
+            result = {"id": parent.id, "markup": parent.markup}
+            if parent.attributes != {}:
+                result.update(parent.attributes)
+        return {"result": "success", "value": result}, 200
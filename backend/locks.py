@@ -0,0 +1,78 @@
+from contextlib import contextmanager
+from threading import Condition, Lock
+
+
+class ReadWriteLock:
+    """
+    Lets many readers or a single writer in.
+    Waiting writers block new readers, so a steady stream of reads cannot starve writes.
+    Not reentrant.
+    """
+    def __init__(self):
+        self.cond = Condition(Lock())
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        with self.cond:
+            while self.writer or self.waiting_writers:
+                self.cond.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.readers -= 1
+                if not self.readers:
+                    self.cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self.cond:
+            self.waiting_writers += 1
+            while self.writer or self.readers:
+                self.cond.wait()
+            self.waiting_writers -= 1
+            self.writer = True
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.writer = False
+                self.cond.notify_all()
+
+
+class LockTable:
+    """
+    One ReadWriteLock per key, created on first use and dropped when nobody holds or waits for it.
+    """
+    def __init__(self):
+        self._mutex = Lock()
+        self._locks = {} # key -> [ReadWriteLock, number of users]
+
+    @contextmanager
+    def _lock(self, key):
+        with self._mutex:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [ReadWriteLock(), 0]
+            entry[1] += 1
+        try:
+            yield entry[0]
+        finally:
+            with self._mutex:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+    @contextmanager
+    def read(self, key):
+        with self._lock(key) as lock, lock.read():
+            yield
+
+    @contextmanager
+    def write(self, key):
+        with self._lock(key) as lock, lock.write():
+            yield
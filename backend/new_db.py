@@ -1,23 +1,297 @@
 import os
+import re
 import sqlite3
 import json
-import uuid
-from threading import Lock
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from queue import LifoQueue, Empty, Full
+from threading import Condition, Event, Lock, Thread
 
+import metrics
 from document import Document
+from order_keys import keys_between
+
+QUERY_SECONDS = metrics.histogram("db_query_seconds", "Time from executing a query to fetching its last row", ("query",))
+QUERY_ROWS = metrics.counter("db_query_rows_total", "Rows fetched or changed", ("query",))
+SLOW_QUERIES = metrics.counter("db_slow_queries_total", "Queries slower than the slow query threshold", ("query",))
+HYDRATION_SECONDS = metrics.histogram("document_hydration_seconds", "Time building document trees from rows")
+HYDRATION_NODES = metrics.counter("document_hydration_nodes_total", "Nodes built from rows")
+
+@lru_cache(maxsize=1024)
+def query_shape(sql):
+    """The SQL on one line, with numbers and lists of placeholders collapsed so that one statement is one label."""
+    shape = " ".join(sql.split())
+    shape = re.sub(r"\?(\s*,\s*\?)+", "?, ...", shape)
+    return re.sub(r"\b\d+\b", "N", shape)
+
+class _TimedCursor(sqlite3.Cursor):
+    """
+    Records the time and row count of every query in the db metrics.
+    A query counts from execute() to its last fetch: fetchall(), fetchone(),
+    a short fetchmany(), the next execute() or the cursor going away.
+    """
+    _pending = None # [sql, seconds, rows] of the query still being fetched
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        start = time.perf_counter()
+        try:
+            super().execute(sql, parameters)
+        finally:
+            self._pending = [sql, time.perf_counter() - start, 0]
+        if self.description is None: # nothing to fetch
+            self._pending[2] = max(self.rowcount, 0)
+            self._finish()
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self._finish()
+        start = time.perf_counter()
+        try:
+            super().executemany(sql, seq_of_parameters)
+        finally:
+            self._pending = [sql, time.perf_counter() - start, max(self.rowcount, 0)]
+            self._finish()
+        return self
+
+    def _fetch(self, fetch, *args):
+        start = time.perf_counter()
+        result = fetch(*args)
+        if self._pending is not None:
+            self._pending[1] += time.perf_counter() - start
+        return result
+
+    def fetchone(self):
+        row = self._fetch(super().fetchone)
+        if self._pending is not None:
+            self._pending[2] += row is not None
+        self._finish()
+        return row
+
+    def fetchall(self):
+        rows = self._fetch(super().fetchall)
+        if self._pending is not None:
+            self._pending[2] += len(rows)
+        self._finish()
+        return rows
+
+    def fetchmany(self, size=None):
+        rows = self._fetch(super().fetchmany, size or self.arraysize)
+        if self._pending is not None:
+            self._pending[2] += len(rows)
+            if len(rows) < (size or self.arraysize):
+                self._finish()
+        return rows
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        try:
+            self._finish()
+        except Exception:
+            pass # interpreter shutdown
+
+    def _finish(self):
+        pending = self._pending
+        if pending is None:
+            return
+        self._pending = None
+        sql, seconds, rows = pending
+        shape = query_shape(sql)
+        QUERY_SECONDS.observe(seconds, query=shape)
+        QUERY_ROWS.inc(rows, query=shape)
+        threshold = self.connection.slow_query_seconds
+        if threshold is not None and seconds >= threshold:
+            SLOW_QUERIES.inc(query=shape)
+            print(f"Slow query ({seconds * 1000:.1f} ms, {rows} rows): {shape}")
+
+class _TimedConnection(sqlite3.Connection):
+    """Connection whose cursors, including those of execute() and executemany(), are _TimedCursors."""
+    slow_query_seconds = None
+
+    def cursor(self, factory=_TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
 
 class DocumentDbModel:
-    def __init__(self, doc_id, root_id, path, markup, attributes):
+    def __init__(self, doc_id, root_id, path, markup, attributes, parent_id=None, position=""):
         self.id = doc_id
         self.root_id = root_id
         self.markup = markup
         self.path = path
         self.attributes = attributes
+        self.parent_id = parent_id
+        self.position = position
+
+class LogAck:
+    """Completion of queued log appends, set once the group commit holding them has finished."""
+    def __init__(self):
+        self.event = Event()
+        self.error = None
+
+    def set(self, error=None):
+        self.error = error
+        self.event.set()
+
+    def wait(self):
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
 
 class NewDb:
+    """
+    SQLite persistence for document trees.
+
+    Every node is one row in the repo table. Siblings are ordered by their
+    position, a fractional order key (see order_keys.py), and path is the
+    chain of positions from the root with every segment terminated by '/'
+    (the root's path is ""). '/' sorts below every key character, so sorting
+    a document's rows by path gives document order, and a subtree is the
+    contiguous range [path, path with its final '/' bumped to '0') on the
+    (root_id, path) index. Inserting or deleting a node only touches the rows
+    of that node's subtree.
+
+    Connections are long-lived and shared through a small pool so that a
+    request does not pay for connect() and pragma setup every time. The
+    database runs in WAL mode: readers on other pooled connections keep
+    reading while a writer commits, and writers are serialized in-process
+    so they queue on a lock instead of spinning on SQLITE_BUSY.
+
+    Edits are persisted as an append-only log: every operation applied to a
+    document (see Document.take_ops) is a row of the ops table, numbered by
+    the document's version. The repo rows are a snapshot of the document at
+    the version recorded in the snapshots table and are only rewritten at
+    checkpoints. Loading a document means reading its snapshot and replaying
+    the operations logged after it. Queries that read the repo table
+    directly (search, parent) see documents as of their last checkpoint,
+    callers that need every save checkpoint first (DocumentRepo.catch_up).
+    So does the document list, which reads the title and node count of every
+    root from root_summaries, rewritten whenever a whole root is written.
+
+    Log appends are group committed: a writer thread collects the appends
+    of all documents for flush_interval seconds, or until max_batch_ops
+    operations are queued, and commits them in one transaction. How long
+    append_ops() waits is its durability: "none" returns right away,
+    "commit" waits for the group commit and "fsync" also has it synced to
+    disk (synchronous = full for that transaction).
+
+    The contents of text nodes are also kept in repo_text, an FTS5 index
+    keyed by the repo rowid. Triggers on repo keep it in sync, so every
+    write path updates it in the same transaction. recursive_triggers is on
+    so that rows overwritten by "insert or replace" leave the index too.
+    """
     DB_NAME = "document.db"
+    SCHEMA_VERSION = 7 # 1: order keys, 2: terminated key paths and indexes, 3: full-text index, 4: operation log, 5: root index, 6: root summaries, 7: unindexed text root_id
+    PATH_END = "~" # sorts after every order key character
+    POOL_SIZE = 8  # idle connections kept around, extra ones are closed
+    STATEMENT_CACHE_SIZE = 256  # prepared statements cached per connection
+    PRAGMAS = (
+        "pragma journal_mode = wal",
+        "pragma synchronous = normal",  # fsync on checkpoint, not on every commit
+        "pragma temp_store = memory",
+        "pragma cache_size = -16000",  # 16 MB page cache per connection
+        "pragma mmap_size = 268435456",
+        "pragma busy_timeout = 5000",
+        "pragma recursive_triggers = on",  # replaced rows fire the delete trigger
+    )
+    SNIPPET_TOKENS = 12 # words around the matches in search snippets
+    TITLE_LENGTH = 80 # characters of the first text used as a document's title
+    KEPT_OPS = 1000 # logged operations kept per document behind its snapshot, for history and resync
+    FLUSH_INTERVAL = 0.002 # seconds log appends are collected for one group commit
+    MAX_BATCH_OPS = 1000 # operations that trigger a group commit right away
+    DURABILITY = "commit" # default for append_ops: "none", "commit" or "fsync"
+    # queries taking longer are printed, None turns the slow query log off
+    SLOW_QUERY_SECONDS = float(os.environ["SLOW_QUERY_MS"]) / 1000 if os.environ.get("SLOW_QUERY_MS") else None
+
+    def __init__(self, db_name=None, flush_interval=None, max_batch_ops=None, durability=None, slow_query_seconds=None):
+        self.db_name = db_name or NewDb.DB_NAME
+        self.slow_query_seconds = slow_query_seconds if slow_query_seconds is not None else NewDb.SLOW_QUERY_SECONDS
+        self._pool = LifoQueue(maxsize=NewDb.POOL_SIZE)
+        self._write_lock = Lock()
+        self.flush_interval = flush_interval if flush_interval is not None else NewDb.FLUSH_INTERVAL
+        self.max_batch_ops = max_batch_ops or NewDb.MAX_BATCH_OPS
+        self.durability = durability or NewDb.DURABILITY
+        self._log_cond = Condition()
+        self._log_queue = [] # (rows, durability, LogAck) waiting for the next group commit
+        self._queued_ops = 0
+        self._unacked = 0 # queued or being committed
+        self._log_writer = None
+
+    def _open(self):
+        # isolation_level=None: we issue begin/commit ourselves in _transaction()
+        conn = sqlite3.connect(
+            self.db_name,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=NewDb.STATEMENT_CACHE_SIZE,
+            factory=_TimedConnection, # query metrics and the slow query log
+        )
+        conn.slow_query_seconds = self.slow_query_seconds
+        for pragma in NewDb.PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    @contextmanager
+    def _connect(self):
+        """Borrow a pooled connection for reads."""
+        try:
+            conn = self._pool.get_nowait()
+        except Empty:
+            conn = self._open()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                # a transaction that could not be rolled back, the connection is not reused
+                conn.close()
+            else:
+                try:
+                    self._pool.put_nowait(conn)
+                except Full:
+                    conn.close()
+
+    @contextmanager
+    def _transaction(self, fsync=False):
+        """
+        Borrow a pooled connection and run the block as one write transaction.
+        With fsync the commit is synced to disk before returning.
+        """
+        with self._write_lock, self._connect() as conn:
+            if fsync:
+                conn.execute("pragma synchronous = full")
+            try:
+                conn.execute("begin immediate")
+                try:
+                    yield conn
+                    conn.execute("commit")
+                except BaseException:
+                    # also when the commit itself failed (busy, disk full, I/O error)
+                    if conn.in_transaction:
+                        conn.execute("rollback")
+                    raise
+            finally:
+                if fsync:
+                    conn.execute("pragma synchronous = normal")
+
+    def close(self):
+        """Commit the queued log appends and close all idle pooled connections."""
+        self.flush()
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except Empty:
+                return
+
     def init_repo(self):
-        with sqlite3.connect(NewDb.DB_NAME) as conn:
+        with self._transaction() as conn:
             cursor = conn.cursor()
             cursor.execute("""
                 create table if not exists repo(
@@ -25,247 +299,562 @@ class NewDb:
                     markup text not null,
                     attributes text not null,
                     root_id text not null,
+                    parent_id text,
+                    position text not null default '',
                     path varchar(256)
                 )
             """)
+            columns = [c[1] for c in cursor.execute("""pragma table_info(repo)""")]
+            if 'parent_id' not in columns:
+                self._migrate_index_paths(cursor)
+            version = cursor.execute("""pragma user_version""").fetchone()[0]
+            if version < 2:
+                # key paths written before segments were terminated
+                cursor.execute("""update repo set path = path || '/' where path != '' and path not like '%/'""")
+            cursor.execute("""create index if not exists repo_root_path on repo(root_id, path)""")
+            cursor.execute("""create index if not exists repo_parent_position on repo(parent_id, position)""")
+            cursor.execute("""create index if not exists repo_roots on repo(root_id) where path = ''""") # listing root documents
+            self._create_text_index(cursor, rebuild=version < 7)
+            cursor.execute("""
+                create table if not exists ops(
+                    root_id text not null,
+                    version integer not null,
+                    op text not null,
+                    primary key (root_id, version)
+                ) without rowid
+            """)
+            cursor.execute("""
+                create table if not exists snapshots(
+                    root_id text primary key,
+                    version integer not null
+                )
+            """)
+            cursor.execute("""
+                create table if not exists root_summaries(
+                    root_id text primary key,
+                    title text,
+                    size integer not null
+                )
+            """)
+            if version < 6:
+                self._summarize_roots(cursor)
+            cursor.execute(f"""pragma user_version = {NewDb.SCHEMA_VERSION}""")
 
-    def get_all(self):
-        with sqlite3.connect(NewDb.DB_NAME) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""select id from repo""")
-            return cursor.fetchall()
-    
-    def insert_document_tree(self, doc):
-        self._from_dict(doc.to_dict(), doc.id, "")
-
-    def _from_dict(self, data, root_id, path):
-        """Recursive helper to build the document tree from a dictionary."""
-        if 'markup' not in data:
-            raise ValueError("Missing 'markup' in data")
-            
-        markup = data['markup']
-        doc_id = data.get('id', str(uuid.uuid4()))
-        attr = {}
-
-        reserved_keys = {'markup', 'id', 'children'}
-        for key, value in data.items():
-            if key not in reserved_keys:
-                attr[key] = value
-        attr_str = json.dumps(attr)
-
-        db_model = DocumentDbModel(doc_id, root_id, path, markup, attr_str)
-        
-        with sqlite3.connect(NewDb.DB_NAME) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                """insert or replace into repo (id, markup, path, root_id, attributes) values (?, ?, ?, ?, ?)""",
-                (db_model.id, db_model.markup, db_model.path, db_model.root_id, db_model.attributes)
+    def _summarize_roots(self, cursor):
+        """Fills root_summaries for the documents written before it existed."""
+        roots = cursor.execute("""select id, attributes from repo where path = ''""").fetchall()
+        rows = []
+        for root_id, attributes in roots:
+            title = json.loads(attributes).get("title")
+            if not title:
+                row = cursor.execute("""
+                    select json_extract(attributes, '$.content') from repo
+                    where root_id = ? and markup = 'text' and json_extract(attributes, '$.content') != ''
+                    order by path limit 1
+                    """, (root_id,)).fetchone()
+                title = row[0][:NewDb.TITLE_LENGTH] if row else None
+            size = cursor.execute("""select count(*) from repo where root_id = ?""", (root_id,)).fetchone()[0]
+            rows.append((root_id, title, size))
+        cursor.executemany("""insert or replace into root_summaries (root_id, title, size) values (?, ?, ?)""", rows)
+
+    def _summary(self, root, size):
+        """
+        The root_summaries row of a root Document: its "title" attribute or the
+        start of its first text in document order, and its number of nodes.
+        """
+        title = root.attributes.get("title")
+        if not title:
+            stack = [root]
+            while stack:
+                node = stack.pop()
+                content = node.attributes.get("content") if node.markup == "text" else None
+                if content:
+                    title = str(content)[:NewDb.TITLE_LENGTH]
+                    break
+                stack.extend(reversed(node.children))
+        return (root.id, title or None, size)
+
+    def _create_text_index(self, cursor, rebuild=False):
+        """Creates the full-text index over text node contents and the triggers maintaining it."""
+        if rebuild:
+            # an older table may index root_id, which fts5 cannot alter
+            cursor.execute("""drop table if exists repo_text""")
+        cursor.execute("""
+            create virtual table if not exists repo_text using fts5(
+                content,
+                root_id unindexed,
+                tokenize = 'unicode61 remove_diacritics 2'
             )
-            conn.commit()
+        """)
+        cursor.execute("""
+            create trigger if not exists repo_text_insert after insert on repo
+            when new.markup = 'text' begin
+                insert into repo_text (rowid, content, root_id)
+                values (new.rowid, json_extract(new.attributes, '$.content'), new.root_id);
+            end
+        """)
+        cursor.execute("""
+            create trigger if not exists repo_text_delete after delete on repo
+            when old.markup = 'text' begin
+                delete from repo_text where rowid = old.rowid;
+            end
+        """)
+        cursor.execute("""
+            create trigger if not exists repo_text_update after update of markup, attributes, root_id on repo begin
+                delete from repo_text where rowid = old.rowid;
+                insert into repo_text (rowid, content, root_id)
+                select new.rowid, json_extract(new.attributes, '$.content'), new.root_id
+                where new.markup = 'text';
+            end
+        """)
+        if rebuild:
+            # rows written before the index existed
+            cursor.execute("""
+                insert into repo_text (rowid, content, root_id)
+                select rowid, json_extract(attributes, '$.content'), root_id from repo where markup = 'text'
+            """)
 
-        for i, child_data in enumerate(data.get('children', [])):
+    def _migrate_index_paths(self, cursor):
+        """Converts rows stored with the old numeric index paths ("0/2/1") to order keys."""
+        cursor.execute("""alter table repo add column parent_id text""")
+        cursor.execute("""alter table repo add column position text not null default ''""")
+        rows = cursor.execute("""select id, root_id, path from repo""").fetchall()
+        # numeric sort so that 10 comes after 9, parents before children
+        rows.sort(key=lambda r: (r[1], [int(p) for p in r[2].split("/") if p]))
+        by_index_path = {}
+        children = {}
+        for doc_id, root_id, path in rows:
+            by_index_path[(root_id, path)] = doc_id
             if path:
-                self._from_dict(child_data, root_id, path + "/" + str(i))
-            else:
-                self._from_dict(child_data, root_id, str(i))
+                parent_path = path.rsplit("/", 1)[0] if "/" in path else ""
+                children.setdefault((root_id, parent_path), []).append(path)
 
+        updates = []
+        def renumber(root_id, index_path, key_path):
+            paths = children.get((root_id, index_path), [])
+            parent_id = by_index_path[(root_id, index_path)]
+            for child_path, key in zip(paths, keys_between(None, None, len(paths))):
+                child_key_path = key_path + key + "/"
+                updates.append((parent_id, key, child_key_path, by_index_path[(root_id, child_path)]))
+                renumber(root_id, child_path, child_key_path)
+        for (root_id, path), doc_id in list(by_index_path.items()):
+            if path == "":
+                renumber(root_id, "", "")
+        cursor.executemany("""update repo set parent_id = ?, position = ?, path = ? where id = ?""", updates)
 
+    def list_roots(self, after=None, limit=50):
+        """
+        Returns (id, title, size) of up to limit root documents with ids after
+        `after`, in id order. The title is the root's "title" attribute or the
+        start of its first text, the size its number of nodes, both as of the
+        last checkpoint: they are read from root_summaries, which every write
+        of a whole root updates (see _summary).
+        """
+        with self._connect() as conn:
+            return conn.execute("""
+                select r.id, s.title, s.size
+                from repo r
+                left join root_summaries s on s.root_id = r.id
+                where r.path = '' and r.root_id > ?
+                order by r.root_id limit ?
+                """, (after or "", limit)).fetchall()
 
-    def search(self, text):
-        with sqlite3.connect(NewDb.DB_NAME) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                """select * from where markup like ? or attributes like ?""",
-                ("%" + text + "%", "%" + text + "%")
+    def insert_document_tree(self, doc):
+        """
+        Writes the whole tree of doc in a single transaction.
+        The tree is flattened into rows first and written with one executemany,
+        so the cost is one commit no matter how many nodes the document has.
+        """
+        meta = self._get_row_meta(doc.id)
+        root_id, parent_id, path = meta if meta else (doc.id, None, "")
+        rows = self._flatten(doc, root_id, parent_id, path)
+        _, removed = doc.take_changes() # everything is rewritten, only deletions are left
+        summary = self._summary(doc, len(rows)) if root_id == doc.id else None
+        with self._transaction() as conn:
+            conn.executemany("""delete from repo where id = ?""", [(i,) for i in removed])
+            conn.executemany(
+                """insert or replace into repo (id, markup, attributes, root_id, parent_id, position, path) values (?, ?, ?, ?, ?, ?, ?)""",
+                rows
             )
-            return cursor.fetchall()
+            if summary:
+                conn.execute("""insert or replace into root_summaries (root_id, title, size) values (?, ?, ?)""", summary)
 
-    def insert_document(self, db_model):
-        with sqlite3.connect(NewDb.DB_NAME) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                """insert or replace into repo (id, markup, path, root_id, attributes) values (?, ?, ?, ?, ?)""",
-                (db_model.id, db_model.markup, db_model.path, db_model.root_id, db_model.attributes)
+    def append_ops(self, root_id, first_version, ops, durability=None):
+        """
+        Appends operations to the log of a document, numbered from first_version.
+        They are committed with the next group commit; durability ("none",
+        "commit" or "fsync", the db's default if not given) decides whether
+        to wait for it. Raises the commit's error when waiting.
+        Returns the LogAck of the append.
+        """
+        ack = LogAck()
+        if not ops:
+            ack.set()
+            return ack
+        durability = durability or self.durability
+        rows = [(root_id, first_version + i, json.dumps(op)) for i, op in enumerate(ops)]
+        with self._log_cond:
+            if self._log_writer is None:
+                self._log_writer = Thread(target=self._write_log, name="log-writer", daemon=True)
+                self._log_writer.start()
+            self._log_queue.append((rows, durability, ack))
+            self._queued_ops += len(rows)
+            self._unacked += 1
+            self._log_cond.notify_all()
+        if durability != "none":
+            ack.wait()
+        return ack
+
+    def flush(self):
+        """Waits until every queued log append is committed."""
+        with self._log_cond:
+            if not self._unacked:
+                return
+            ack = LogAck()
+            self._log_queue.append(([], "commit", ack))
+            self._unacked += 1
+            self._log_cond.notify_all()
+        ack.wait()
+
+    def _take_log_batch(self):
+        with self._log_cond:
+            while not self._log_queue:
+                self._log_cond.wait()
+            # let appends of other writers join the batch
+            deadline = time.monotonic() + self.flush_interval
+            while self._queued_ops < self.max_batch_ops:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._log_cond.wait(remaining)
+            batch, self._log_queue = self._log_queue, []
+            self._queued_ops = 0
+            return batch
+
+    def _write_log(self):
+        """Group commits the queued log appends, one transaction per batch."""
+        while True:
+            batch = self._take_log_batch()
+            error = None
+            try:
+                fsync = any(durability == "fsync" for _, durability, _ in batch)
+                with self._transaction(fsync=fsync) as conn:
+                    conn.executemany(
+                        """insert into ops (root_id, version, op) values (?, ?, ?)""",
+                        [row for rows, _, _ in batch for row in rows]
+                    )
+            except Exception as e:
+                error = e
+                print(f"Writing the operation log failed: {e}")
+            with self._log_cond:
+                self._unacked -= len(batch)
+            for _, _, ack in batch:
+                ack.set(error)
+
+    def get_ops(self, root_id, after_version):
+        """Returns (version, operation) for the logged operations of a document after after_version, oldest first."""
+        self.flush()
+        with self._connect() as conn:
+            rows = conn.execute(
+                """select version, op from ops where root_id = ? and version > ? order by version""",
+                (root_id, after_version)
+            ).fetchall()
+            return [(version, json.loads(op)) for version, op in rows]
+
+    def get_snapshot_version(self, root_id):
+        """Returns the version the repo rows of a document are at, 0 if it was never checkpointed."""
+        with self._connect() as conn:
+            row = conn.execute("""select version from snapshots where root_id = ?""", (root_id,)).fetchone()
+            return row[0] if row else 0
+
+    def get_unsnapshotted_roots(self):
+        """Returns the ids of documents with logged operations newer than their snapshot."""
+        self.flush()
+        with self._connect() as conn:
+            rows = conn.execute("""
+                select o.root_id
+                from ops o
+                left join snapshots s on s.root_id = o.root_id
+                group by o.root_id
+                having max(o.version) > coalesce(max(s.version), 0)
+                """).fetchall()
+            return [row[0] for row in rows]
+
+    def save_changes(self, doc, version=None):
+        """
+        Persists only the nodes changed since the tree was loaded or last saved.
+        doc can be any node of the in-memory tree; changes are recorded on its root.
+        With a version this is a checkpoint: the rows are recorded as the
+        snapshot at that version and the log behind it is compacted.
+        """
+        root = doc._root()
+        if not root.has_changes() and version is None:
+            return
+        if version is not None:
+            # the log is compacted below, queued appends must not land behind that
+            self.flush()
+        dirty, removed = root.take_changes()
+
+        meta = self._get_row_meta(root.id)
+        root_id, root_parent_id, base_path = meta if meta else (root.id, None, "")
+
+        paths = {}
+        def path_of(node):
+            # memoized so nodes of the same inserted subtree share the parent lookups
+            key = id(node)
+            if key not in paths:
+                if node is root:
+                    paths[key] = base_path
+                else:
+                    paths[key] = path_of(node.parent_doc) + node.position + "/"
+            return paths[key]
+
+        rows = []
+        for node in dirty:
+            if node._root() is not root:
+                continue # detached after being changed
+            parent_id = root_parent_id if node is root else node.parent_doc.id
+            rows.append((node.id, node.markup, json.dumps(node.attributes), root_id,
+                         parent_id, node.position or "", path_of(node)))
+        # the document list reads titles and sizes from here instead of counting rows
+        summary = self._summary(root, len(root._id_index())) if root_id == root.id else None
+
+        with self._transaction() as conn:
+            conn.executemany("""delete from repo where id = ?""", [(i,) for i in removed])
+            conn.executemany(
+                """insert or replace into repo (id, markup, attributes, root_id, parent_id, position, path) values (?, ?, ?, ?, ?, ?, ?)""",
+                rows
             )
-            # update siblings and nephews
-            if db_model.root_id != db_model.id:
-                self._update_siblings(cursor, root_id, db_model.path, 1)
-            conn.commit()
-
-    def insert_data_to_document(self, doc_id, path, markup, attributes):
-        doc_meta = self._get_document_obj_by_id(doc_id) # doc is included
-        root_id, abs_path = doc_meta
-        new_id = str(uuid.uuid4())
-        new_path = abs_path + "/" + path 
-        with sqlite3.connect(NewDb.DB_NAME) as conn:
+            if summary:
+                conn.execute("""insert or replace into root_summaries (root_id, title, size) values (?, ?, ?)""", summary)
+            if version is not None:
+                conn.execute("""insert or replace into snapshots (root_id, version) values (?, ?)""", (root_id, version))
+                conn.execute("""delete from ops where root_id = ? and version <= ?""", (root_id, version - NewDb.KEPT_OPS))
+
+    def _flatten(self, doc, root_id, parent_id, path):
+        """
+        Turns a Document tree into repo rows in document order.
+        Walks the tree with an explicit stack so deep documents do not hit the recursion limit.
+        """
+        rows = []
+        stack = [(doc, parent_id, path)]
+        while stack:
+            node, node_parent_id, node_path = stack.pop()
+            rows.append((node.id, node.markup, json.dumps(node.attributes), root_id,
+                         node_parent_id, node.position or "", node_path))
+
+            node._ensure_positions()
+            # reversed so that the first child is popped first
+            for child in reversed(node.children):
+                stack.append((child, node.id, node_path + child.position + "/"))
+        return rows
+
+    def _match_query(self, text):
+        """
+        Turns user input into an FTS5 query: every word must appear, as a word or a word prefix.
+        Words are quoted so that FTS5 operators in the input are searched for literally.
+        """
+        terms = ['"' + term.replace('"', '""') + '"*' for term in text.split()]
+        if not terms:
+            return None
+        return "content : (" + " ".join(terms) + ")"
+
+    def search(self, text, doc_id=None, limit=20, offset=0):
+        """
+        Full-text search over text nodes, best matches first.
+        With doc_id only the subtree of that node is searched, otherwise all documents.
+        Returns rows of (id, root_id, content, snippet, score); lower scores are better (bm25).
+        """
+        root_id, path = None, None
+        if doc_id:
+            meta = self._get_document_obj_by_id(doc_id)
+            if meta is None:
+                return []
+            root_id, path = meta
+        query = self._match_query(text)
+        if query is None:
+            return []
+
+        sql = f"""
+            select r.id, r.root_id, repo_text.content,
+                   snippet(repo_text, 0, '<b>', '</b>', '...', {NewDb.SNIPPET_TOKENS}),
+                   bm25(repo_text, 1.0, 0.0) as score
+            from repo_text
+            join repo r on r.rowid = repo_text.rowid
+            where repo_text match ?
+            """
+        params = [query]
+        if root_id:
+            sql += """ and r.root_id = ? and r.path >= ? and r.path < ?"""
+            params.append(root_id)
+            params.extend(self._subtree_range(path))
+        sql += """ order by score limit ? offset ?"""
+        params.extend((limit, offset))
+        with self._connect() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def insert_document(self, db_model):
+        with self._transaction() as conn:
             cursor = conn.cursor()
             cursor.execute(
-                """insert or replace into repo (id, markup, path, root_id, attributes) values (?, ?, ?, ?, ?)""",
-                (doc_id, markup, new_path, root_id, attributes)
+                """insert or replace into repo (id, markup, attributes, root_id, parent_id, position, path) values (?, ?, ?, ?, ?, ?, ?)""",
+                (db_model.id, db_model.markup, db_model.attributes, db_model.root_id,
+                 db_model.parent_id, db_model.position, db_model.path)
             )
+            if db_model.path == "":
+                # a new, empty document
+                cursor.execute("""insert or replace into root_summaries (root_id, title, size) values (?, ?, 1)""",
+                               (db_model.id, json.loads(db_model.attributes).get("title") or None))
 
-            # update siblings and nephews
-            if root_id != db_model.id:
-                self._update_siblings(cursor, root_id, db_model.path, 1)
-
-            conn.commit()
+    def _subtree_range(self, path):
+        """
+        Bounds of the (root_id, path) index range holding the node at path and its descendants.
+        "a0/b1/" covers everything from "a0/b1/" up to, but not including, "a0/b10".
+        """
+        if path == "":
+            return "", NewDb.PATH_END
+        return path, path[:-1] + "0"
 
     def get_descendants(self, root_id, path):
-        with sqlite3.connect(NewDb.DB_NAME) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                     """
                     select id, path, markup, attributes
                     from repo 
-                    where root_id = ? and path like ? 
-                    """,(root_id, path + "%"))
+                    where root_id = ? and path >= ? and path < ?
+                    order by path
+                    """,(root_id, *self._subtree_range(path)))
             return cursor.fetchall()
 
-    def insert_document_to_document(self, original_doc_id, given_doc_id, new_path):
-        doc_meta = self._get_document_obj_by_id(given_doc_id)
-        old_root_id, old_path = doc_meta
-        desc = self.get_descendants(old_root_id, old_path)
-
-        doc_meta = self._get_document_obj_by_id(original_doc_id) # doc is included
-        root_id, abs_path = doc_meta
-
-        for d in desc:
-            if abs_path != "":
-                abs_path = abs_path + "/" 
-            # 0/0
-            p = abs_path + new_path + d[1][len(old_path):] # remove old path prefix add the new one
-            print("new_path", new_path)
-            print("p", p)
-            print("d[1]", d[1])
-            print("old_path", old_path)
-            new_id = str(uuid.uuid4())
-            m = DocumentDbModel(new_id, root_id, p, d[2], d[3])
-            with sqlite3.connect(NewDb.DB_NAME) as conn:
-                cursor = conn.cursor()
-                if d[0] == given_doc_id:
-                    self._update_siblings(cursor, root_id, p, 1)
-                cursor.execute(
-                    """insert into repo (id, root_id, path, markup , attributes) values (?, ?, ?, ?, ?)""",
-                    (new_id, root_id, p, d[2], d[3])
-                )
-                # update siblings and nephews
-                conn.commit()
-
     def delete_document(self, doc_id):
         doc_meta = self._get_document_obj_by_id(doc_id)
         root_id = doc_meta[0]
         path = doc_meta[1]
-        with sqlite3.connect(NewDb.DB_NAME) as conn:
+        self.flush() # no queued log appends of a deleted document may land after it
+        with self._transaction() as conn:
 
             cursor = conn.cursor()
 
             cursor.execute( # remove descendants and itself in a single query, including root
                 """
-                delete from repo where path like ? and root_id = ?
+                delete from repo where root_id = ? and path >= ? and path < ?
                 """,
-                (path + "%", root_id)
+                (root_id, *self._subtree_range(path))
             )
-
-            if root_id != doc_id:
-                print(f"Updating siblings for {path}")
-                self._update_siblings(cursor, root_id, path, -1)
-            conn.commit()
+            if path == "":
+                # a whole document, its log goes with it
+                cursor.execute("""delete from ops where root_id = ?""", (root_id,))
+                cursor.execute("""delete from snapshots where root_id = ?""", (root_id,))
+                cursor.execute("""delete from root_summaries where root_id = ?""", (root_id,))
 
     def parent(self, doc_id):
-        doc_meta = self._get_document_obj_by_id(doc_id)
-        root_id, path = doc_meta
-        if doc_meta == None:
-            return None
-        with sqlite3.connect(NewDb.DB_NAME) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
-            cursor.execute("""select id, markup, attributes from repo where path = ? """, (path.rsplit("/", 1)[0],))
+            cursor.execute("""
+                select p.id, p.markup, p.attributes
+                from repo n
+                join repo p on p.id = n.parent_id
+                where n.id = ?
+                """, (doc_id,))
             doc_tpl = cursor.fetchone()
             if doc_tpl == None:
                 return None
             return Document(id = doc_tpl[0], markup=doc_tpl[1], attributes=json.loads(doc_tpl[2]))
 
     def get_document_by_path(self, path, root_id):
-        with sqlite3.connect(NewDb.DB_NAME) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("""select id, markup, attributes, path from repo where root_id = ? and path = ? """, (root_id, path))
             return cursor.fetchone()
                     
-    def get_document_by_id(self, doc_id):
-        doc_meta = self._get_document_obj_by_id(doc_id)
-        if doc_meta == None:
-            return None
-        with sqlite3.connect(NewDb.DB_NAME) as conn:
-            root_id, path = doc_meta
+    def get_document_by_id(self, doc_id, depth=None):
+        """
+        Builds the subtree of doc_id from its rows. With depth, only the
+        nodes up to depth levels below doc_id are built (0 is the node alone).
+        """
+        with self._connect() as conn:
             cursor = conn.cursor()
-            cursor.execute("""
-                select id, markup, attributes, path
-                from repo
-                where root_id = ? and path like ?
-                order by path asc
-                """
-            ,(root_id, f"{path}%")) # get itself and the descendants
+            cursor.execute("""select root_id, path from repo where id = ? """, (doc_id,))
+            doc_meta = cursor.fetchone()
+            if doc_meta == None:
+                return None
+            root_id, path = doc_meta
+            if depth is None:
+                cursor.execute("""
+                    select id, markup, attributes, parent_id, position
+                    from repo
+                    where root_id = ? and path >= ? and path < ?
+                    order by path asc
+                    """
+                ,(root_id, *self._subtree_range(path))) # get itself and the descendants as one index range
+            else:
+                # every path segment ends in '/', so the number of '/' is the level of a node
+                cursor.execute("""
+                    select id, markup, attributes, parent_id, position
+                    from repo
+                    where root_id = ? and path >= ? and path < ?
+                    and length(path) - length(replace(path, '/', '')) <= ?
+                    order by path asc
+                    """
+                ,(root_id, *self._subtree_range(path), path.count("/") + depth))
 
             doc = cursor.fetchall()
             if doc:
-                if root_id == doc_id:
-                    return self._construct_document(doc, is_root=True)
                 return self._construct_document(doc)
             else:
                 return None
 
+    def get_node_id_at(self, doc_id, indices):
+        """
+        Follows child indices (as in the index paths of Document, "0/3" is [0, 3])
+        down from doc_id and returns the id of the node they lead to, or None
+        if one is out of range. One (parent_id, position) index lookup per level.
+        """
+        node_id = doc_id
+        with self._connect() as conn:
+            for index in indices:
+                row = conn.execute(
+                    """select id from repo where parent_id = ? order by position limit 1 offset ?""",
+                    (node_id, index)
+                ).fetchone()
+                if row is None:
+                    return None
+                node_id = row[0]
+        return node_id
+
+    def get_root_id(self, doc_id):
+        """Returns the id of the root document containing doc_id, or None."""
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""select root_id from repo where id = ? """, (doc_id,))
+            row = cursor.fetchone()
+            return row[0] if row else None
+
     def _get_document_obj_by_id(self, doc_id):
-        with sqlite3.connect(NewDb.DB_NAME) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("""select root_id, path from repo where id = ? """, (doc_id,))
             return cursor.fetchone()
 
-    def _construct_document(self, doc, is_root=False):
-        doc_obj = Document(id=doc[0][0], markup=doc[0][1], attributes=json.loads(doc[0][2]))
-        original_path = doc[0][3]
-        path_size = len(original_path)
-        if is_root:
-            path_size = path_size - 1
-        # doc: id markup attributes path
-        for d in doc[1:]:
-            cur_path = d[3][path_size+1:]
-            doc_obj[cur_path] = d[0:3]
-        return doc_obj
-
-    def _update_siblings(self, cursor, root_id, path, operation):
-        if len(path) == 1:
-            path_var = path + "%"
-        else:
-            path_var = path.rsplit("/", 1)[0] + "/%" # include / to just match with the children
-        # get sibling documents
-        cursor.execute(
-                """
-                select id, path from repo where path like ? and root_id = ? order by path asc
-                """,
-                (path_var,root_id)
-            )
-        siblings = cursor.fetchall()
-        if siblings:
-            for s in siblings:
-                doc_parts = path.split("/")
-                lng = len(doc_parts)
-                sibling_parts = s[1].split("/")
-                if int(sibling_parts[lng-1]) < int(doc_parts[lng-1]): # take the middle one
-                    """
-                    update is in 0/1/0
-                    when inserting 0/1/0 -> 0/2/0
-                    when deleting 0/1/0 -> 0/0/0
-                    """
-                    continue # <= means include the same, so <
-                else:
-                    print(siblings)
-                    print(s)
-                    print(path)
-                    sibling_parts[lng-1]  = str(int(sibling_parts[lng-1]) + operation)
-                    new_path = "/".join(sibling_parts)
-                    cursor.execute(
-                        """
-                        update repo set path = ? where id = ?
-                        """,
-                        (new_path, s[0])
-                    )
+    def _get_row_meta(self, doc_id):
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""select root_id, parent_id, path from repo where id = ? """, (doc_id,))
+            return cursor.fetchone()
 
+    def _construct_document(self, doc):
+        # doc: id markup attributes parent_id position, in document order
+        with HYDRATION_SECONDS.time():
+            doc_obj = Document(id=doc[0][0], markup=doc[0][1], attributes=json.loads(doc[0][2]))
+            doc_obj.position = doc[0][4]
+            nodes = {doc_obj.id: doc_obj}
+            for d in doc[1:]:
+                parent = nodes[d[3]]
+                node = Document(id=d[0], markup=d[1], parent=parent, attributes=json.loads(d[2]))
+                node.position = d[4]
+                parent.children.append(node) # rows come sorted, so appending keeps sibling order
+                nodes[node.id] = node
+            doc_obj.index = nodes
+        HYDRATION_NODES.inc(len(doc))
+        return doc_obj
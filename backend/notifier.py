@@ -0,0 +1,72 @@
+import time
+import requests
+from collections import OrderedDict
+from threading import Condition, Thread
+
+
+class NotificationDispatcher:
+    """
+    Sends document update notifications to the WebSocket server in the background.
+
+    notify() only queues the update and returns. A worker thread waits
+    `window` seconds after the first queued update so that more can arrive,
+    merges updates of the same document into one event (their ops are
+    concatenated in order, the version is the latest one) and posts all
+    pending events in one request over a keep-alive session.
+    """
+    WINDOW = 0.02 # seconds to collect updates before sending
+    MAX_BATCH = 500 # events per request
+
+    def __init__(self, url, window=None, max_batch=None, timeout=1):
+        self.url = url
+        self.window = window if window is not None else NotificationDispatcher.WINDOW
+        self.max_batch = max_batch or NotificationDispatcher.MAX_BATCH
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.pending = OrderedDict() # doc_id -> event, in order of first update
+        self.cond = Condition()
+        self.worker = Thread(target=self._run, name="notification-dispatcher", daemon=True)
+        self.worker.start()
+
+    def notify(self, doc_id, action="update", ops=None, version=None):
+        """
+        Queue an update of doc_id. ops=None means the change cannot be patched and clients reload.
+        version is the document version after the update, if it has one.
+        """
+        with self.cond:
+            event = self.pending.get(doc_id)
+            if event is None:
+                event = self.pending[doc_id] = {"doc_id": doc_id, "action": action, "ops": list(ops) if ops is not None else None}
+                self.cond.notify()
+            else:
+                event["action"] = action
+                if event["ops"] is None or ops is None:
+                    event["ops"] = None # one of the merged updates has no ops, clients have to reload anyway
+                else:
+                    event["ops"].extend(ops)
+            if version is not None:
+                event["version"] = version
+
+    def _take_batch(self):
+        with self.cond:
+            while not self.pending:
+                self.cond.wait()
+        # let more updates for the same documents arrive before sending
+        time.sleep(self.window)
+        with self.cond:
+            batch = []
+            while self.pending and len(batch) < self.max_batch:
+                _, event = self.pending.popitem(last=False)
+                if event["ops"] is None:
+                    del event["ops"]
+                batch.append(event)
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            try:
+                self.session.post(self.url, json={"events": batch}, timeout=self.timeout)
+            except requests.exceptions.RequestException as e:
+                # Don't let a missing WebSocket server stop the dispatcher
+                print(f"WebSocket notification failed: {e}")
@@ -0,0 +1,169 @@
+"""
+Fractional order keys for sibling ordering.
+
+Every child of a node gets a string key and siblings are ordered by comparing
+their keys as plain strings. A key can always be generated between two
+existing keys, so inserting a node never requires renumbering its siblings.
+
+Keys are an integer part followed by an optional fraction, all in base 62.
+The first character of the integer part encodes its length ('a' is two
+characters long, 'b' three and so on; 'Z', 'Y', ... are the negative side),
+which keeps keys short when nodes are appended or prepended repeatedly.
+Based on the algorithm described in "Implementing Fractional Indexing" by
+David Greenspan.
+
+All characters sort above '/', so '/'-joined key paths sort in document order.
+"""
+
+DIGITS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+SMALLEST_INTEGER = "A" + DIGITS[0] * 26
+
+
+def _midpoint(a, b):
+    """Fraction strictly between a and b ("" means 0, None means 1)."""
+    if b is not None:
+        # skip the common prefix
+        n = 0
+        while n < len(b) and (a[n] if n < len(a) else DIGITS[0]) == b[n]:
+            n += 1
+        if n > 0:
+            return b[:n] + _midpoint(a[n:], b[n:])
+
+    digit_a = DIGITS.index(a[0]) if a else 0
+    digit_b = DIGITS.index(b[0]) if b is not None else len(DIGITS)
+    if digit_b - digit_a > 1:
+        return DIGITS[(digit_a + digit_b + 1) // 2]
+    # the first digits are consecutive
+    if b is not None and len(b) > 1:
+        return b[:1]
+    return DIGITS[digit_a] + _midpoint(a[1:], None)
+
+
+def _integer_length(head):
+    if "a" <= head <= "z":
+        return ord(head) - ord("a") + 2
+    if "A" <= head <= "Z":
+        return ord("Z") - ord(head) + 2
+    raise ValueError(f"Invalid order key head: {head}")
+
+
+def _integer_part(key):
+    length = _integer_length(key[0])
+    if length > len(key):
+        raise ValueError(f"Invalid order key: {key}")
+    return key[:length]
+
+
+def _validate(key):
+    if key == SMALLEST_INTEGER:
+        raise ValueError(f"Invalid order key: {key}")
+    integer = _integer_part(key)
+    if key[len(integer):].endswith(DIGITS[0]):
+        raise ValueError(f"Invalid order key: {key}")
+
+
+def _increment_integer(x):
+    head, digits = x[0], list(x[1:])
+    for i in range(len(digits) - 1, -1, -1):
+        d = DIGITS.index(digits[i]) + 1
+        if d < len(DIGITS):
+            digits[i] = DIGITS[d]
+            return head + "".join(digits)
+        digits[i] = DIGITS[0]
+    # carried out of the integer part, grow it
+    if head == "Z":
+        return "a" + DIGITS[0]
+    if head == "z":
+        return None
+    head = chr(ord(head) + 1)
+    if head > "a":
+        digits.append(DIGITS[0])
+    else:
+        digits.pop()
+    return head + "".join(digits)
+
+
+def _decrement_integer(x):
+    head, digits = x[0], list(x[1:])
+    for i in range(len(digits) - 1, -1, -1):
+        d = DIGITS.index(digits[i]) - 1
+        if d >= 0:
+            digits[i] = DIGITS[d]
+            return head + "".join(digits)
+        digits[i] = DIGITS[-1]
+    if head == "a":
+        return "Z" + DIGITS[-1]
+    if head == "A":
+        return None
+    head = chr(ord(head) - 1)
+    if head < "Z":
+        digits.append(DIGITS[-1])
+    else:
+        digits.pop()
+    return head + "".join(digits)
+
+
+def key_between(a, b):
+    """
+    Returns a key that sorts after a and before b.
+    a=None means "before the first key", b=None means "after the last key".
+    """
+    if a is not None:
+        _validate(a)
+    if b is not None:
+        _validate(b)
+    if a is not None and b is not None and a >= b:
+        raise ValueError(f"Order keys out of order: {a} >= {b}")
+
+    if a is None:
+        if b is None:
+            return "a" + DIGITS[0]
+        int_b = _integer_part(b)
+        frac_b = b[len(int_b):]
+        if int_b == SMALLEST_INTEGER:
+            return int_b + _midpoint("", frac_b)
+        if int_b < b:
+            return int_b
+        result = _decrement_integer(int_b)
+        if result is None:
+            raise ValueError("Cannot decrement order key any further")
+        return result
+
+    int_a = _integer_part(a)
+    frac_a = a[len(int_a):]
+    if b is None:
+        result = _increment_integer(int_a)
+        return int_a + _midpoint(frac_a, None) if result is None else result
+
+    int_b = _integer_part(b)
+    frac_b = b[len(int_b):]
+    if int_a == int_b:
+        return int_a + _midpoint(frac_a, frac_b)
+    result = _increment_integer(int_a)
+    if result is None:
+        raise ValueError("Cannot increment order key any further")
+    if result < b:
+        return result
+    return int_a + _midpoint(frac_a, None)
+
+
+def keys_between(a, b, n):
+    """Returns n ascending keys between a and b, spread so none of them gets long."""
+    if n == 0:
+        return []
+    if n == 1:
+        return [key_between(a, b)]
+    if b is None:
+        keys = [key_between(a, None)]
+        for _ in range(n - 1):
+            keys.append(key_between(keys[-1], None))
+        return keys
+    if a is None:
+        keys = [key_between(None, b)]
+        for _ in range(n - 1):
+            keys.append(key_between(None, keys[-1]))
+        keys.reverse()
+        return keys
+    mid = n // 2
+    c = key_between(a, b)
+    return keys_between(a, c, mid) + [c] + keys_between(c, b, n - mid - 1)
@@ -0,0 +1,136 @@
+"""
+Operational transformation of document tree operations.
+
+Operations are the dicts recorded by Document.take_ops(): insert, delete,
+set, unset and replace, addressed by a path of child indices from the root.
+A client that edited an older version of a document sends its operations
+with that version; the server rebases them over the operations applied
+since then (rebase()), applies the result and broadcasts it. Two users
+inserting at the same path therefore both end up in the document, the one
+applied first at the lower index.
+
+Attribute writes do not move nodes. Of two concurrent set/unset of the same
+key, or replaces of the same node, the one applied first wins and the other
+is dropped. An operation on a node that was deleted or replaced
+concurrently, or on anything under it, is dropped too, except a delete of
+the replaced node itself.
+"""
+from collections import deque
+
+
+class VersionError(Exception):
+    """The base version of a set of operations is unknown or no longer in the history."""
+
+
+class OpHistory:
+    """
+    The most recent operations applied to one document.
+    version counts every operation applied since the history was created.
+    """
+    LIMIT = 1000 # operations kept for rebasing
+
+    def __init__(self, version=0, limit=None):
+        self.version = version
+        self.ops = deque(maxlen=limit or OpHistory.LIMIT)
+
+    def append(self, ops):
+        self.ops.extend(ops)
+        self.version += len(ops)
+
+    def since(self, base_version):
+        """Returns the operations applied after base_version, raises VersionError if they are not all kept."""
+        missing = self.version - base_version
+        if missing < 0 or missing > len(self.ops):
+            raise VersionError(f"Version {base_version} is not available, the document is at {self.version}")
+        return list(self.ops)[len(self.ops) - missing:]
+
+    def forget(self):
+        """Drops the kept operations, clients on older versions have to reload."""
+        self.ops.clear()
+
+
+def _parse(path):
+    return [int(part) for part in path.split("/")] if path else []
+
+
+def _format(parts):
+    return "/".join(str(part) for part in parts)
+
+
+def _target(op, path):
+    """The node an operation depends on: the parent for inserts, the node itself otherwise."""
+    return path[:-1] if op["op"] == "insert" else path
+
+
+def transform(op, against, wins_ties=False):
+    """
+    Rewrites op, created on the same version as against, to apply after against.
+    Returns None if against removed the node op works on, or won a conflict with it.
+    Conflicts are won by against unless wins_ties is set, which is how the
+    side applied first is told apart: inserts at the same index go after
+    against, writes of the same attribute and replaces of the same node are dropped.
+    """
+    kind = against["op"]
+    if kind in ("set", "unset"):
+        same_key = op["op"] in ("set", "unset") and op["path"] == against["path"] and op["key"] == against["key"]
+        return None if same_key and not wins_ties else op
+
+    path = _parse(op["path"])
+    other = _parse(against["path"])
+    target = _target(op, path)
+    depth = len(other) - 1 # level of the index against changes
+    in_subtree = target[:len(other)] == other and len(target) >= len(other)
+
+    if kind == "replace":
+        # the replaced node and everything under it are new, only a delete of the node still applies
+        if not in_subtree or (len(target) == len(other) and op["op"] == "delete"):
+            return op
+        if len(target) == len(other) and op["op"] == "replace" and wins_ties:
+            return op
+        return None
+
+    if depth < 0:
+        return op # the root is never inserted or deleted
+    same_parent = len(path) > depth and path[:depth] == other[:depth]
+
+    if kind == "insert":
+        if not same_parent:
+            return op
+        index = path[depth]
+        tie = index == other[depth] and op["op"] == "insert" and len(path) == depth + 1
+        if index > other[depth] or (index == other[depth] and not (tie and wins_ties)):
+            path[depth] += 1
+    elif kind == "delete":
+        if in_subtree:
+            return None
+        if same_parent and path[depth] > other[depth]:
+            path[depth] -= 1
+    else:
+        return op
+
+    return {**op, "path": _format(path)}
+
+
+def rebase(ops, concurrent):
+    """
+    Transforms ops, created on a version the concurrent operations were
+    applied to, so that they can be applied after them.
+    Returns the transformed operations, dropped ones left out.
+    """
+    rebased = []
+    concurrent = list(concurrent)
+    for op in ops:
+        transformed = []
+        for other in concurrent:
+            if op is None:
+                transformed.append(other)
+                continue
+            # both sides move past each other, so later ops see this one applied
+            other_after = transform(other, op, wins_ties=True)
+            op = transform(op, other)
+            if other_after is not None:
+                transformed.append(other_after)
+        concurrent = transformed
+        if op is not None:
+            rebased.append(op)
+    return rebased
@@ -0,0 +1,220 @@
+"""
+Pub/sub backbone under the WebSocket fan-out.
+
+DocumentConnectionManager publishes every document update event here and
+broadcasts what comes back to its own subscribers. Two backends:
+
+  InProcessPubSub - hands events straight back, for a single WebSocket server.
+  BrokerPubSub    - sends events to a Broker over a local TCP or unix socket.
+                    The broker relays every event to all connected workers,
+                    the publisher included, so all workers see the updates
+                    in the same order and number them the same way.
+
+Run a broker and several workers on one box:
+
+    python3 pubsub.py localhost:8090
+    PUBSUB_BROKER=localhost:8090 WS_PORT=8080 HTTP_PORT=8081 python3 websocket_server.py
+    PUBSUB_BROKER=localhost:8090 WS_PORT=8082 HTTP_PORT=8083 python3 websocket_server.py
+
+Events are dicts (doc_id, action and optionally ops and version), sent as
+one JSON object per line.
+"""
+import asyncio
+import json
+import logging
+import sys
+
+logger = logging.getLogger(__name__)
+
+BROKER_ADDRESS = "localhost:8090"
+MAX_EVENT_SIZE = 16 * 1024 * 1024 # longest event line, ops of big imports included
+MAX_WORKER_BUFFER = 64 * 1024 * 1024 # unsent bytes before the broker drops a worker
+RECONNECT_DELAY = 1.0 # seconds between attempts to reach the broker
+
+
+async def _open_connection(address: str):
+    """Connects to "host:port", or to a unix socket if the address is a path."""
+    if address.startswith("/"):
+        return await asyncio.open_unix_connection(address, limit=MAX_EVENT_SIZE)
+    host, port = address.rsplit(":", 1)
+    return await asyncio.open_connection(host, int(port), limit=MAX_EVENT_SIZE)
+
+
+class InProcessPubSub:
+    """Delivers published events to the handler of this process only."""
+
+    def __init__(self):
+        self.handler = None
+
+    def attach(self, handler, on_reset=None):
+        """handler(event) is called for every event, on_reset() after events may have been missed."""
+        self.handler = handler
+
+    async def start(self):
+        pass
+
+    def publish(self, event: dict):
+        self.handler(event)
+
+    async def close(self):
+        pass
+
+    def stats(self) -> dict:
+        return {"backend": "in-process"}
+
+
+class BrokerPubSub:
+    """
+    Publishes events through a Broker and receives those of every worker.
+
+    While the broker is unreachable, events are delivered to this worker's
+    own subscribers only. After reconnecting, on_reset() is called since
+    updates published by other workers in the meantime were lost.
+    """
+
+    def __init__(self, address: str = BROKER_ADDRESS, reconnect_delay: float = RECONNECT_DELAY):
+        self.address = address
+        self.reconnect_delay = reconnect_delay
+        self.handler = None
+        self.on_reset = None
+        self.writer = None
+        self.task = None
+        self.published = 0
+        self.received = 0
+        self.reconnects = 0
+
+    def attach(self, handler, on_reset=None):
+        self.handler = handler
+        self.on_reset = on_reset
+
+    async def start(self):
+        """Connects in the background, reconnecting whenever the connection is lost."""
+        self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        connected_before = False
+        while True:
+            try:
+                reader, writer = await _open_connection(self.address)
+            except OSError as e:
+                logger.warning(f"Pub/sub broker {self.address} unreachable: {e}")
+                await asyncio.sleep(self.reconnect_delay)
+                continue
+            logger.info(f"Connected to pub/sub broker {self.address}")
+            self.writer = writer
+            if connected_before:
+                self.reconnects += 1
+                if self.on_reset:
+                    self.on_reset()
+            connected_before = True
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    self.received += 1
+                    try:
+                        self.handler(json.loads(line))
+                    except Exception as e:
+                        # one bad event must not cut this worker off the broker
+                        logger.error(f"Error handling pub/sub event: {e}")
+            except (ConnectionError, ValueError) as e:
+                logger.error(f"Pub/sub broker connection failed: {e}")
+            finally:
+                self.writer = None
+                writer.close()
+            logger.warning(f"Lost pub/sub broker {self.address}")
+            await asyncio.sleep(self.reconnect_delay)
+
+    def publish(self, event: dict):
+        """Must be called from the event loop thread."""
+        self.published += 1
+        if self.writer is None or self.writer.is_closing():
+            self.handler(event) # no broker, at least our own clients hear about it
+            return
+        self.writer.write(json.dumps(event).encode() + b"\n")
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+        if self.writer:
+            self.writer.close()
+
+    def stats(self) -> dict:
+        return {
+            "backend": "broker",
+            "address": self.address,
+            "connected": self.writer is not None,
+            "published": self.published,
+            "received": self.received,
+            "reconnects": self.reconnects,
+        }
+
+
+class Broker:
+    """
+    Relays every event line it receives to all connected workers, sender
+    included, in the order received. Lines are passed through unparsed.
+    A worker that stops reading is disconnected; it resyncs its clients
+    when it reconnects.
+    """
+
+    def __init__(self, address: str = BROKER_ADDRESS, max_worker_buffer: int = MAX_WORKER_BUFFER):
+        self.address = address
+        self.max_worker_buffer = max_worker_buffer
+        self.workers: set = set()
+        self.server = None
+
+    async def start(self):
+        if self.address.startswith("/"):
+            self.server = await asyncio.start_unix_server(self._handle, self.address, limit=MAX_EVENT_SIZE)
+        else:
+            host, port = self.address.rsplit(":", 1)
+            self.server = await asyncio.start_server(self._handle, host, int(port), limit=MAX_EVENT_SIZE)
+        logger.info(f"Pub/sub broker listening on {self.address}")
+
+    async def _handle(self, reader, writer):
+        self.workers.add(writer)
+        logger.info(f"Worker connected. Total workers: {len(self.workers)}")
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self._relay(line)
+        except (ConnectionError, ValueError) as e:
+            logger.error(f"Worker connection failed: {e}")
+        finally:
+            self.workers.discard(writer)
+            writer.close()
+            logger.info(f"Worker disconnected. Total workers: {len(self.workers)}")
+
+    def _relay(self, line: bytes):
+        for writer in list(self.workers):
+            if writer.transport.get_write_buffer_size() > self.max_worker_buffer:
+                logger.warning("Disconnecting slow worker")
+                self.workers.discard(writer)
+                writer.close()
+                continue
+            writer.write(line)
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+        for writer in list(self.workers):
+            writer.close()
+
+
+async def main(address: str):
+    broker = Broker(address)
+    await broker.start()
+    await asyncio.Future()  # Run forever
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    try:
+        asyncio.run(main(sys.argv[1] if len(sys.argv) > 1 else BROKER_ADDRESS))
+    except KeyboardInterrupt:
+        logger.info("Broker shutdown requested")
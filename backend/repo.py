@@ -1,42 +1,430 @@
 from document import Document
-from threading import RLock
+from threading import RLock, Thread
+from collections import OrderedDict
+from locks import LockTable
 from new_db import NewDb, DocumentDbModel
+from ot import OpHistory, rebase
 import json
+import time
 
 
 class DocumentRepo:
-    def __init__(self, db):
-        self.db = NewDb()
-        self.documents = {} 
+    """
+    Repository in front of NewDb.
+
+    documents is an LRU cache of hydrated root Documents keyed by root id,
+    bounded by the total number of nodes it holds. Lookups of any node are
+    served from its cached root. Writes must go through the repo (create,
+    save, insert_tree, delete) so the cache stays in sync with the database.
+
+    Callers lock per root document: reads of a document and everything
+    done with the returned nodes happen inside reading(doc_id), changes
+    inside writing(doc_id). self.lock only guards the cache bookkeeping and
+    is never held during database calls.
+
+    Every root document also has an OpHistory of the operations saved
+    through the repo. Its version is what clients base concurrent edits on,
+    see apply_ops().
+
+    save() appends the operations to the database log instead of rewriting
+    rows. Every CHECKPOINT_OPS operations, or CHECKPOINT_INTERVAL seconds
+    after the first unsnapshotted save, the changed rows are written as a
+    new snapshot (checkpoint()). A document evicted from the cache is
+    rebuilt from its snapshot and the log tail when it is loaded again.
+    Nodes inserted since the last snapshot are not in the repo table yet;
+    unsaved_ids maps them to their root so they can still be found by id.
+    """
+    MAX_CACHED_NODES = 200000
+    CHECKPOINT_OPS = 200
+    CHECKPOINT_INTERVAL = 5 # seconds
+
+    def __init__(self, db, max_cached_nodes=None, checkpoint_ops=None, checkpoint_interval=None):
+        self.db = db if db else NewDb()
+        self.documents = OrderedDict() # root id -> Document, least recently used first
+        self.max_cached_nodes = max_cached_nodes or DocumentRepo.MAX_CACHED_NODES
+        self._sizes = {} # root id -> node count
+        self._cached_nodes = 0
+        self.node_roots = {} # node id -> root id, for the nodes of cached roots
         self.attached_users = {}
         self.lock = RLock()
+        self.locks = LockTable() # root id -> ReadWriteLock
+        self.histories = {} # root id -> OpHistory
+        self.checkpoint_ops = checkpoint_ops or DocumentRepo.CHECKPOINT_OPS
+        self.snapshot_versions = {} # root id -> version its repo rows are at
+        self.unsaved_ids = {} # node id -> root id, for nodes not in a snapshot yet
+        self._unsaved_by_root = {} # root id -> those node ids
+        self._behind = {} # root id -> time of its first save after the last snapshot
+        self.checkpoint_interval = checkpoint_interval or DocumentRepo.CHECKPOINT_INTERVAL
+        Thread(target=self._run_checkpoints, name="checkpointer", daemon=True).start()
+
+    def _root_id_of(self, doc_id):
+        """
+        Returns the id of the root document containing doc_id, or None.
+        Nodes of cached roots are found through node_roots, only others cost a query.
+        """
+        with self.lock:
+            if doc_id in self.documents:
+                return doc_id
+            root_id = self.unsaved_ids.get(doc_id)
+            if root_id is not None:
+                return root_id
+            root = self.documents.get(self.node_roots.get(doc_id))
+            # deleted nodes stay in node_roots until the next checkpoint; an index being rebuilt is skipped
+            if root is not None and root.index is not None and doc_id in root.index:
+                return root.id
+        return self.db.get_root_id(doc_id)
+
+    def _track_unsaved(self, root_id, ops):
+        """Remembers the root of the nodes created by ops until the next checkpoint."""
+        with self.lock:
+            ids = self._unsaved_by_root.setdefault(root_id, set())
+            cached = root_id in self.documents
+            for op in ops:
+                if op["op"] not in ("insert", "replace"):
+                    continue
+                stack = [op["node"]]
+                while stack:
+                    node = stack.pop()
+                    if "id" in node:
+                        ids.add(node["id"])
+                        self.unsaved_ids[node["id"]] = root_id
+                        if cached:
+                            self.node_roots[node["id"]] = root_id
+                    stack.extend(node.get("children", ()))
+
+    def _forget_unsaved(self, root_id):
+        for node_id in self._unsaved_by_root.pop(root_id, ()):
+            self.unsaved_ids.pop(node_id, None)
+
+    def _lock_key(self, doc_id):
+        return self._root_id_of(doc_id) or doc_id
+
+    def reading(self, doc_id):
+        """Context manager holding the read lock of the root document containing doc_id."""
+        return self.locks.read(self._lock_key(doc_id))
+
+    def writing(self, doc_id):
+        """Context manager holding the write lock of the root document containing doc_id."""
+        return self.locks.write(self._lock_key(doc_id))
+
+    def cached_html(self, doc_id):
+        """
+        Returns the last rendering of a cached root document if it is still current, without locking.
+        Rendered HTML strings are immutable and writers drop them, so this never sees a torn document.
+        """
+        root = self.documents.get(doc_id)
+        return root._html if root is not None else None
+
+    def _cache(self, root):
+        """Adds or refreshes a root document in the cache and evicts the least recently used ones."""
+        if self.documents.get(root.id) is root:
+            # saved nodes were added to node_roots by _track_unsaved
+            self.documents.move_to_end(root.id)
+            self._cached_nodes -= self._sizes[root.id]
+        else:
+            self._uncache(root.id)
+            for node_id in root._id_index():
+                self.node_roots[node_id] = root.id
+        size = len(root._id_index())
+        root.record_ops()
+        self.documents[root.id] = root
+        self._sizes[root.id] = size
+        self._cached_nodes += size
+        while self._cached_nodes > self.max_cached_nodes and len(self.documents) > 1:
+            old_id = next(iter(self.documents))
+            self._uncache(old_id)
+            if old_id in self.histories:
+                self.histories[old_id].forget()
+
+    def _uncache(self, root_id):
+        root = self.documents.pop(root_id, None)
+        if root is None:
+            return
+        self._cached_nodes -= self._sizes.pop(root_id)
+        if root.index is None:
+            # rebuilding it here could race with a writer, the entries are found by value instead
+            node_ids = [node_id for node_id, owner in self.node_roots.items() if owner == root_id]
+        else:
+            node_ids = list(root.index) + list(root.removed_ids or ())
+        self._forget_nodes(root_id, node_ids)
+
+    def _forget_nodes(self, root_id, node_ids):
+        for node_id in node_ids:
+            if self.node_roots.get(node_id) == root_id:
+                del self.node_roots[node_id]
+
+    def _history(self, root_id):
+        with self.lock:
+            history = self.histories.get(root_id)
+            if history is None:
+                history = self.histories[root_id] = OpHistory()
+            return history
+
+    def _start_history(self, root_id):
+        """A new document starts at version 0 with nothing logged, so version() needs no query."""
+        self.histories[root_id] = OpHistory()
+        self.snapshot_versions[root_id] = 0
+
+    def version(self, root_id):
+        """Returns the current version of a root document, counted in applied operations."""
+        with self.lock:
+            history = self.histories.get(root_id)
+        if history is None:
+            # never loaded here, so nothing was saved after its snapshot (see recover())
+            return self.db.get_snapshot_version(root_id)
+        return history.version
+
+    def _get_cached(self, root_id):
+        with self.lock:
+            root = self.documents.get(root_id)
+            if root is not None:
+                self.documents.move_to_end(root_id)
+            return root
+
+    def _cached_root(self, doc_id):
+        """Returns the cached root document holding doc_id, loading it if needed."""
+        root = self._get_cached(doc_id)
+        if root is not None:
+            return root
+        root_id = self._root_id_of(doc_id)
+        if root_id is None:
+            return None
+        root = self._get_cached(root_id)
+        if root is not None:
+            return root
+        return self._load(root_id)
+
+    def _load(self, root_id):
+        """
+        Reads the snapshot of a root document and replays the operations logged after it.
+        The caller holds this root's lock, so nobody changes it while it loads.
+        """
+        root = self.db.get_document_by_id(root_id)
+        if root is None:
+            return None
+        version = self.db.get_snapshot_version(root_id)
+        # the operations behind the snapshot that are still logged go into the history too
+        logged = self.db.get_ops(root_id, max(version - OpHistory.LIMIT, 0))
+        tail = [op for op_version, op in logged if op_version > version]
+        for op in tail:
+            root.apply_op(op, keep_ids=True)
+        history = OpHistory(logged[0][0] - 1 if logged else version)
+        history.append([op for _, op in logged])
+        self._track_unsaved(root_id, tail)
+        with self.lock:
+            if root_id in self.documents:
+                # loaded by a concurrent reader in the meantime
+                return self.documents[root_id]
+            self.histories[root_id] = history
+            self.snapshot_versions[root_id] = version
+            self._cache(root)
+        return root
 
     def find_document_by_id(self, doc_id):
-        return self.db.get_document_by_id(doc_id)
+        root = self._cached_root(doc_id)
+        if root is None or root.id == doc_id:
+            return root
+        return root.getid(doc_id)
+
+    def find_path(self, doc_id, path, depth=None):
+        """
+        Returns (root id, doc[path]) for the node doc_id: the node at an index
+        path like "0/3", or an attribute like "0/3/content", or the node itself
+        for ""; (None, None) if doc_id does not exist. Raises ValueError like
+        Document.__getitem__.
+
+        A cached document is read from the cache. Otherwise, if its rows are
+        current (no saves since its last checkpoint), the path is resolved in
+        the database and only the subtree of the node is loaded, down to depth
+        levels below it if given, so reading a paragraph of a huge document
+        costs about as much as the paragraph. Such partial trees are not
+        cached and must not be edited. The caller holds reading(doc_id).
+        """
+        root_id = self._root_id_of(doc_id)
+        if root_id is None:
+            return None, None
+        with self.lock:
+            in_memory = root_id in self.documents or root_id in self._behind
+        if in_memory:
+            node = self.find_document_by_id(doc_id)
+            if node is None:
+                return None, None
+            return root_id, node[path] if path else node
+
+        parts = path.split("/") if path else []
+        leaf = parts[-1] if parts else ""
+        is_node = not parts or leaf.isdigit()
+        indices = parts if is_node else parts[:-1]
+        if not all(part.isdigit() for part in indices):
+            raise ValueError(f"Error getting item at path '{path}': path must be numeric indices, except for the final leaf")
+        node_id = self.db.get_node_id_at(doc_id, [int(part) for part in indices])
+        if node_id is None:
+            raise ValueError(f"Error getting item at path '{path}': Path index out of bounds")
+        # an attribute only needs its node
+        node = self.db.get_document_by_id(node_id, depth if is_node else 0)
+        if node is None:
+            return None, None
+        return root_id, node if is_node else node[leaf]
 
     def create(self):
+        doc = Document()
+        db_model = DocumentDbModel(doc.id, doc.id, "" ,doc.markup, json.dumps(doc.attributes))
+        self.db.insert_document(db_model)
         with self.lock:
-            doc = Document()
-            self.documents[doc.id] = doc
             self.attached_users[doc.id] = set()
-            db_model = DocumentDbModel(doc.id, doc.id, "" ,doc.markup, json.dumps(doc.attributes))
-            self.db.insert_document(db_model)
-            return doc.id
+            self._start_history(doc.id)
+            self._cache(doc)
+        return doc.id
+
+    def save(self, doc, durability=None):
+        """
+        Persists the pending changes of the tree doc belongs to by appending them to its log.
+        The append is group committed with other saves, durability overrides
+        how long to wait for that (see NewDb.append_ops).
+        Returns the root id and the operations applied since the last save.
+        """
+        root = doc._root()
+        ops = root.take_ops()
+        history = self._history(root.id)
+        try:
+            self.db.append_ops(root.id, history.version + 1, ops, durability)
+        except Exception:
+            # the cached tree no longer matches the database
+            with self.lock:
+                self._uncache(root.id)
+            raise
+        history.append(ops)
+        self._track_unsaved(root.id, ops)
+        with self.lock:
+            if root.id in self.documents:
+                self._cache(root)
+            self._behind.setdefault(root.id, time.monotonic())
+        if history.version - self.snapshot_versions.get(root.id, 0) >= self.checkpoint_ops:
+            self.checkpoint(root)
+        return root.id, ops
+
+    def checkpoint(self, root):
+        """
+        Writes the rows changed since the last snapshot and records them as the snapshot at the current version.
+        The caller holds writing(root.id).
+        """
+        version = self._history(root.id).version
+        removed = list(root.removed_ids or ()) # taken by save_changes
+        try:
+            self.db.save_changes(root, version)
+        except Exception as e:
+            # the operations are in the log, the tree is rebuilt from it on the next load
+            print(f"Checkpoint of document {root.id} failed: {e}")
+            with self.lock:
+                self._uncache(root.id)
+                self._forget_nodes(root.id, removed)
+            return
+        with self.lock:
+            self.snapshot_versions[root.id] = version
+            self._behind.pop(root.id, None)
+            self._forget_unsaved(root.id)
+            self._forget_nodes(root.id, removed)
+
+    def _run_checkpoints(self):
+        """Checkpoints documents whose last snapshot is older than checkpoint_interval, so idle ones catch up too."""
+        while True:
+            time.sleep(self.checkpoint_interval)
+            now = time.monotonic()
+            with self.lock:
+                due = [root_id for root_id, since in self._behind.items() if now - since >= self.checkpoint_interval]
+            self._checkpoint_behind(due)
+
+    def _checkpoint_behind(self, root_ids):
+        for root_id in root_ids:
+            try:
+                with self.writing(root_id):
+                    root = self._cached_root(root_id)
+                    if root is not None and root_id in self._behind:
+                        self.checkpoint(root)
+            except Exception as e:
+                print(f"Checkpoint of document {root_id} failed: {e}")
+
+    def catch_up(self, doc_id=None):
+        """
+        Checkpoints the document containing doc_id, or every document, if it was saved
+        since its last snapshot, so that queries over the repo rows (search) see all saves.
+        Returns the root id of doc_id, None if it does not exist.
+        """
+        root_id = self._root_id_of(doc_id) if doc_id is not None else None
+        if doc_id is not None and root_id is None:
+            return None
+        with self.lock:
+            behind = [root_id] if root_id in self._behind else [] if doc_id is not None else list(self._behind)
+        self._checkpoint_behind(behind)
+        return root_id
+
+    def recover(self):
+        """
+        Checkpoints the documents whose log is ahead of their snapshot,
+        e.g. after a crash, so that the repo table is current again. Called at startup.
+        """
+        for root_id in self.db.get_unsnapshotted_roots():
+            with self.writing(root_id):
+                root = self._cached_root(root_id)
+                if root is not None:
+                    self.checkpoint(root)
+
+    def apply_ops(self, doc, ops, base_version):
+        """
+        Applies operations a client made on base_version of doc's tree and saves them.
+        They are first rebased over the operations saved since then, see ot.rebase.
+        Returns the root id, the operations as applied and the new version.
+        Raises ot.VersionError if base_version is too old to rebase from.
+        The caller holds writing(doc.id).
+        """
+        root = doc._root()
+        concurrent = self._history(root.id).since(base_version)
+        root.take_ops() # nothing else may be pending in the applied batch
+        try:
+            for op in rebase(ops, concurrent):
+                root.apply_op(op)
+        except Exception:
+            self.discard(root.id)
+            raise
+        root_id, applied = self.save(root)
+        return root_id, applied, self.version(root_id)
+
+    def discard(self, root_id):
+        """
+        Drops a cached tree with unsaved changes, e.g. a half applied batch.
+        The next lookup reloads it from the database. The caller holds writing(root_id).
+        """
+        with self.lock:
+            self._uncache(root_id)
+
+    def insert_tree(self, doc):
+        """Writes a whole new document tree and caches it."""
+        self.db.insert_document_tree(doc)
+        with self.lock:
+            self._start_history(doc.id)
+            self._cache(doc)
 
     def list(self):
         with self.lock:
             return [(doc_id, doc.description) for doc_id, doc in self.documents.items()]
 
-    def list_all(self):
-        with self.lock:
-            return self.db.get_all()
-            """
-            children_list = []
-            for doc_id, doc in self.documents.items():
-                children_list.append((doc_id, doc.markup))
-                children_list.extend(doc.list())
-            return children_list
-            """
+    def list_all(self, after=None, limit=50):
+        """
+        Lists root documents by id, limit at a time, after the root id `after`.
+        Returns [{"id", "title", "size"}, ...] and the cursor of the next page, or None on the last one.
+        Titles and sizes are as of the last checkpoint.
+        """
+        rows = self.db.list_roots(after, limit + 1) # one extra row tells whether there is a next page
+        items = [{"id": root_id, "title": title, "size": size} for root_id, title, size in rows[:limit]]
+        next_cursor = items[-1]["id"] if len(rows) > limit else None
+        return items, next_cursor
+        """
+        children_list = []
+        for doc_id, doc in self.documents.items():
+            children_list.append((doc_id, doc.markup))
+            children_list.extend(doc.list())
+        return children_list
+        """
 
 
     def listattached(self, user):
@@ -44,17 +432,19 @@ class DocumentRepo:
             attached_docs = []
             for doc_id, users in self.attached_users.items():
                 if user in users:
-                    if doc_id in self.documents:
-                        attached_docs.append((doc_id, self.documents[doc_id].markup))
+                    doc = self.find_document_by_id(doc_id)
+                    if doc:
+                        attached_docs.append((doc_id, doc.markup))
             return attached_docs
 
     def attach(self, id, user):
         with self.lock:
-            if id not in self.documents:
+            doc = self.find_document_by_id(id)
+            if doc is None:
                 raise ValueError(f"No document with id: {id}")
-                
-            self.attached_users[id].add(user)
-            return self.documents[id]
+
+            self.attached_users.setdefault(id, set()).add(user)
+            return doc
 
     def detach(self, id, user):
         with self.lock:
@@ -62,20 +452,36 @@ class DocumentRepo:
                 self.attached_users[id].discard(user)
 
     def delete(self, id):
+        """
+        Deletes a document or node. Returns the root id and the applied operations.
+        The caller holds writing(id).
+        """
+        root_id = self._root_id_of(id)
+        if root_id is None:
+            raise ValueError(f"No document with id: {id}")
+
         with self.lock:
-            if id not in [doc_id for doc_id, _ in self.list_all()]:
-                raise ValueError(f"No document with id: {id}")
-                
             if id in self.attached_users and self.attached_users[id]:
                 # Check if the set of users is not empty
                 raise PermissionError("Cannot delete document: users are still attached.")
-                
+
+        ops = []
+        if root_id == id:
+            # the rows and the log of the whole document
             self.db.delete_document(id)
-            # Delete from all tracking dictionaries
-            if id in self.documents:
-                del self.documents[id]
-            else:
-                for doc in self.documents.values():
-                    doc.del_id(id) 
+            with self.lock:
+                self._uncache(id)
+                self.histories.pop(id, None)
+                self.snapshot_versions.pop(id, None)
+                self._behind.pop(id, None)
+                self._forget_unsaved(id)
+        else:
+            # a node is deleted through its tree, so the deletion is logged like any other edit
+            root = self._cached_root(root_id)
+            if root is None or not root.del_id(id):
+                raise ValueError(f"No document with id: {id}")
+            _, ops = self.save(root)
+        with self.lock:
             if id in self.attached_users:
                 del self.attached_users[id]
+        return root_id, ops
@@ -1,19 +1,111 @@
 import asyncio
 import json
 import logging
+import os
+import time
 from aiohttp import web
 import websockets
 
+import metrics
+from pubsub import BrokerPubSub, InProcessPubSub
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
 
-# WebSocket server settings
+# WebSocket server settings, override the ports to run several workers on one box
 WS_HOST = "localhost"
-WS_PORT = 8080
-HTTP_PORT = 8081  # Internal HTTP port for receiving notifications from Flask
+WS_PORT = int(os.environ.get("WS_PORT", 8080))
+HTTP_PORT = int(os.environ.get("HTTP_PORT", 8081))  # Internal HTTP port for receiving notifications from Flask
+# "host:port" or unix socket path of a pubsub.py broker shared by all workers, unset for a single server
+PUBSUB_BROKER = os.environ.get("PUBSUB_BROKER")
+
+# Outgoing messages waiting per client before the slow client policy kicks in
+SEND_QUEUE_SIZE = 64
+# What to do with a client whose queue is full:
+#   "coalesce"   - replace its backlog with one resync message per document,
+#                  or close the connection if those do not fit in the queue
+#   "drop"       - drop the new message, the client notices the sequence gap
+#   "disconnect" - close the connection
+SLOW_CLIENT_POLICY = "coalesce"
+
+CLIENTS = metrics.gauge("websocket_clients", "Connected WebSocket clients")
+BROADCAST_SECONDS = metrics.histogram("websocket_broadcast_seconds", "Time queueing one update for the subscribers of a document")
+MESSAGES = metrics.counter("websocket_messages_total", "Messages to clients by what happened to them", ("outcome",))
+
+
+class ClientConnection:
+    """
+    Outgoing side of one client connection.
+
+    Messages go into a bounded queue drained by the connection's own sender
+    task, so a slow client only delays itself.
+    """
+
+    def __init__(self, websocket, queue_size: int = SEND_QUEUE_SIZE, on_close=None):
+        self.websocket = websocket
+        self.on_close = on_close # called with the websocket when the sender stops by itself
+        self.closing = False
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_backlog = 0
+        self.task = asyncio.create_task(self._sender())
+
+    async def _sender(self):
+        try:
+            while True:
+                message = await self.queue.get()
+                try:
+                    await self.websocket.send(message)
+                    self.sent += 1
+                except websockets.exceptions.ConnectionClosed:
+                    return
+                except Exception as e:
+                    logger.error(f"Error sending to client: {e}")
+                    return
+        finally:
+            # nothing is sent to this client any more, it must not stay subscribed
+            if not self.closing and self.on_close:
+                self.on_close(self.websocket)
+
+    def enqueue(self, message: str) -> bool:
+        """Queue a message for sending, returns False if the queue is full."""
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            return False
+        self.max_backlog = max(self.max_backlog, self.queue.qsize())
+        return True
+
+    def coalesce(self, resync_messages: list[str]) -> bool:
+        """Replace the whole backlog with resync messages, returns False if they do not fit in the queue."""
+        if len(resync_messages) > self.queue.maxsize:
+            return False
+        while not self.queue.empty():
+            self.queue.get_nowait()
+            self.coalesced += 1
+        for message in resync_messages:
+            self.queue.put_nowait(message)
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "remote": str(getattr(self.websocket, "remote_address", "")),
+            "backlog": self.queue.qsize(),
+            "max_backlog": self.max_backlog,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+        }
+
+    def close(self):
+        self.closing = True
+        if self.task is not asyncio.current_task():
+            self.task.cancel()
 
 
 class DocumentConnectionManager:
@@ -22,21 +114,49 @@ class DocumentConnectionManager:
     
     Clients can subscribe to specific document IDs and will receive
     notifications when those documents are updated.
+
+    Every update of a document gets the next sequence number of that
+    document, so clients can tell when they missed one and reload.
+
+    Updates go out through a pub/sub backend (see pubsub.py) and come back
+    to every worker sharing it; each worker only sends them to its own
+    subscribers.
     """
     
-    def __init__(self):
+    def __init__(self, slow_client_policy: str = SLOW_CLIENT_POLICY, pubsub=None):
         self.subscriptions: dict[str, set] = {}
         self.client_subscriptions: dict = {}
         self.clients: set = set()
+        self.connections: dict = {}
+        self.sequences: dict[str, int] = {}
+        self.slow_client_policy = slow_client_policy
+        self.pubsub = pubsub or InProcessPubSub()
+        self.pubsub.attach(self._receive, self.resync)
+    
+    def next_sequence(self, doc_id: str) -> int:
+        """Assign the next update sequence number of a document."""
+        seq = self.sequences.get(doc_id, 0) + 1
+        self.sequences[doc_id] = seq
+        return seq
     
     def connect(self, websocket):
         """Register a new client connection."""
         self.clients.add(websocket)
         self.client_subscriptions[websocket] = set()
+        self.connections[websocket] = ClientConnection(websocket, on_close=self._sender_stopped)
+        CLIENTS.set(len(self.clients))
         logger.info(f"Client connected. Total clients: {len(self.clients)}")
     
+    def _sender_stopped(self, websocket):
+        """The sender of a client ended, on a closed connection or an error, so the client is dropped."""
+        if websocket in self.clients:
+            self.disconnect(websocket)
+            asyncio.create_task(websocket.close(code=1011, reason="Send failed"))
+
     def disconnect(self, websocket):
         """Clean up when a client disconnects."""
+        if websocket not in self.clients:
+            return # already dropped, e.g. by its sender
         # Remove from all document subscriptions
         if websocket in self.client_subscriptions:
             for doc_id in self.client_subscriptions[websocket]:
@@ -47,7 +167,11 @@ class DocumentConnectionManager:
                         del self.subscriptions[doc_id]
             del self.client_subscriptions[websocket]
         
+        connection = self.connections.pop(websocket, None)
+        if connection:
+            connection.close()
         self.clients.discard(websocket)
+        CLIENTS.set(len(self.clients))
         logger.info(f"Client disconnected. Total clients: {len(self.clients)}")
     
     def subscribe(self, websocket, doc_id: str):
@@ -56,7 +180,7 @@ class DocumentConnectionManager:
             self.subscriptions[doc_id] = set()
         
         self.subscriptions[doc_id].add(websocket)
-        self.client_subscriptions[websocket].add(doc_id)
+        self.client_subscriptions.setdefault(websocket, set()).add(doc_id)
         logger.info(f"Client subscribed to document: {doc_id}")
     
     def unsubscribe(self, websocket, doc_id: str):
@@ -70,37 +194,115 @@ class DocumentConnectionManager:
             self.client_subscriptions[websocket].discard(doc_id)
         logger.info(f"Client unsubscribed from document: {doc_id}")
     
+    def send(self, websocket, message: dict):
+        """Queue a message for one client."""
+        connection = self.connections.get(websocket)
+        if connection:
+            self._deliver(connection, json.dumps(message))
+
+    def _deliver(self, connection: ClientConnection, message_json: str):
+        """Queue a message, applying the slow client policy when the client is behind."""
+        if connection.enqueue(message_json):
+            MESSAGES.inc(outcome="queued")
+            return
+        if self.slow_client_policy == "drop":
+            connection.dropped += 1
+            MESSAGES.inc(outcome="dropped")
+        elif self.slow_client_policy == "disconnect":
+            self._disconnect_slow(connection)
+        else:
+            # one resync per subscribed document tells the client to reload
+            resync = [
+                json.dumps(self._resync_message(doc_id))
+                for doc_id in self.client_subscriptions.get(connection.websocket, ())
+            ]
+            backlog = connection.queue.qsize()
+            if connection.coalesce(resync):
+                MESSAGES.inc(backlog + 1, outcome="coalesced")
+            else:
+                # subscribed to more documents than the queue holds, it has to reconnect anyway
+                self._disconnect_slow(connection)
+
+    def _disconnect_slow(self, connection: ClientConnection):
+        MESSAGES.inc(outcome="disconnected")
+        logger.info("Disconnecting slow client")
+        websocket = connection.websocket
+        self.disconnect(websocket)
+        asyncio.create_task(websocket.close(code=1008, reason="Client too slow"))
+
+    def _resync_message(self, doc_id: str) -> dict:
+        return {
+            "type": "document_update",
+            "doc_id": doc_id,
+            "action": "resync",
+            "seq": self.sequences.get(doc_id, 0)
+        }
+
+    def resync(self):
+        """Tell every subscriber to reload, after updates from other workers may have been missed."""
+        for doc_id in list(self.subscriptions):
+            self.broadcast(doc_id, self._resync_message(doc_id))
+
+    def publish(self, doc_id: str, action: str = "update", ops: list = None, version: int = None):
+        """
+        Publish a document update to all workers.
+        ops=None means the update cannot be patched and clients reload.
+        version is the document version after the update (see ot.py), if any.
+        Must be called from the event loop thread.
+        """
+        event = {"doc_id": doc_id, "action": action}
+        if ops is not None:
+            event["ops"] = ops
+        if version is not None:
+            event["version"] = version
+        self.pubsub.publish(event)
+
+    def _receive(self, event: dict):
+        """Broadcast an update from the pub/sub backend with the document's next sequence number."""
+        doc_id = event["doc_id"]
+        message = {
+            "type": "document_update",
+            "doc_id": doc_id,
+            "action": event.get("action", "update"),
+            "seq": self.next_sequence(doc_id)
+        }
+        if "ops" in event:
+            message["ops"] = event["ops"]
+        if "version" in event:
+            message["version"] = event["version"]
+        self.broadcast(doc_id, message)
+
     async def broadcast_to_document(self, doc_id: str, message: dict):
         """Send a message to all clients subscribed to a document."""
+        self.broadcast(doc_id, message)
+
+    def broadcast(self, doc_id: str, message: dict):
+        """
+        Queue a message for all clients subscribed to a document.
+        Each client's sender task delivers it concurrently, so this never
+        waits on a slow client.
+        """
         if doc_id not in self.subscriptions:
-            logger.info(f"No subscribers for document: {doc_id}")
+            logger.debug(f"No subscribers for document: {doc_id}")
             return
         
         subscribers = self.subscriptions[doc_id].copy()
         if not subscribers:
             return
         
+        start = time.perf_counter()
         message_json = json.dumps(message)
         logger.info(f"Broadcasting to {len(subscribers)} subscribers of document: {doc_id}")
         
-        # Send to all subscribers
-        disconnected = set()
         for websocket in subscribers:
-            try:
-                await websocket.send(message_json)
-            except websockets.exceptions.ConnectionClosed:
-                disconnected.add(websocket)
-            except Exception as e:
-                logger.error(f"Error sending to client: {e}")
-                disconnected.add(websocket)
-        
-        # Clean up disconnected clients
-        for ws in disconnected:
-            self.disconnect(ws)
+            connection = self.connections.get(websocket)
+            if connection:
+                self._deliver(connection, message_json)
+        BROADCAST_SECONDS.observe(time.perf_counter() - start)
 
 
 # Global connection manager
-manager = DocumentConnectionManager()
+manager = DocumentConnectionManager(pubsub=BrokerPubSub(PUBSUB_BROKER) if PUBSUB_BROKER else None)
 
 
 async def websocket_handler(websocket):
@@ -123,37 +325,38 @@ async def websocket_handler(websocket):
                 doc_id = data.get("doc_id")
                 
                 if not action or not doc_id:
-                    await websocket.send(json.dumps({
+                    manager.send(websocket, {
                         "type": "error",
                         "message": "Missing 'action' or 'doc_id'"
-                    }))
+                    })
                     continue
                 
                 if action == "subscribe":
                     manager.subscribe(websocket, doc_id)
-                    await websocket.send(json.dumps({
+                    manager.send(websocket, {
                         "type": "subscribed",
-                        "doc_id": doc_id
-                    }))
+                        "doc_id": doc_id,
+                        "seq": manager.sequences.get(doc_id, 0)
+                    })
                 
                 elif action == "unsubscribe":
                     manager.unsubscribe(websocket, doc_id)
-                    await websocket.send(json.dumps({
+                    manager.send(websocket, {
                         "type": "unsubscribed",
                         "doc_id": doc_id
-                    }))
+                    })
                 
                 else:
-                    await websocket.send(json.dumps({
+                    manager.send(websocket, {
                         "type": "error",
                         "message": f"Unknown action: {action}"
-                    }))
+                    })
                     
             except json.JSONDecodeError:
-                await websocket.send(json.dumps({
+                manager.send(websocket, {
                     "type": "error",
                     "message": "Invalid JSON"
-                }))
+                })
     except websockets.exceptions.ConnectionClosed:
         pass
     finally:
@@ -164,31 +367,32 @@ async def handle_notify(request):
     """
     HTTP endpoint to receive notifications from Flask API.
     
-    Expected POST body:
+    Expected POST body, either one event or a batch of them:
     {
         "doc_id": "document-uuid",
-        "action": "insert" | "delete" | "update"
+        "action": "insert" | "delete" | "update",
+        "ops": [{"op": "set", "path": "0/1", "key": "content", "value": "..."}, ...],  (optional)
+        "version": 42  (optional)
+    }
+    {
+        "events": [{"doc_id": ..., "action": ..., "ops": ...}, ...]
     }
     """
     try:
         data = await request.json()
-        doc_id = data.get("doc_id")
-        action = data.get("action", "update")
+        events = data.get("events", [data])
         
-        if not doc_id:
+        if not all(event.get("doc_id") for event in events):
             return web.json_response(
                 {"error": "Missing doc_id"},
                 status=400
             )
         
-        # Broadcast to all subscribers of this document
-        await manager.broadcast_to_document(doc_id, {
-            "type": "document_update",
-            "doc_id": doc_id,
-            "action": action
-        })
+        for event in events:
+            # Broadcast to all subscribers of this document
+            manager.publish(event["doc_id"], event.get("action", "update"), event.get("ops"), event.get("version"))
         
-        return web.json_response({"status": "ok"})
+        return web.json_response({"status": "ok", "events": len(events)})
     
     except Exception as e:
         logger.error(f"Error handling notification: {e}")
@@ -203,15 +407,23 @@ async def handle_health(request):
     return web.json_response({
         "status": "healthy",
         "clients": len(manager.clients),
-        "subscriptions": {k: len(v) for k, v in manager.subscriptions.items()}
+        "subscriptions": {k: len(v) for k, v in manager.subscriptions.items()},
+        "connections": [c.stats() for c in manager.connections.values()],
+        "pubsub": manager.pubsub.stats()
     })
 
 
+async def handle_metrics(request):
+    """Metrics of this process in the Prometheus text format, see metrics.py."""
+    return web.Response(body=metrics.render().encode(), headers={"Content-Type": metrics.CONTENT_TYPE})
+
+
 async def start_http_server():
     """Start the internal HTTP server for receiving notifications."""
     app = web.Application()
     app.router.add_post("/notify", handle_notify)
     app.router.add_get("/health", handle_health)
+    app.router.add_get("/metrics", handle_metrics)
     
     runner = web.AppRunner(app)
     await runner.setup()
@@ -225,6 +437,9 @@ async def main():
     """Main entry point - starts both WebSocket and HTTP servers."""
     logger.info("Starting Document WebSocket Server...")
     
+    # Join the other workers, if any
+    await manager.pubsub.start()
+
     # Start the HTTP server for receiving notifications from Flask
     http_runner = await start_http_server()
     
@@ -0,0 +1,80 @@
+"""
+Memory per node and construction time of Document trees.
+
+Builds the same document through both construction paths the backend uses:
+Document._from_dict (importing JSON) and NewDb._construct_document
+(loading rows from the database), and reports the memory held per node
+(tracemalloc) and the time per node.
+
+    python3 benchmarks/document_memory.py [nodes]
+"""
+import json
+import os
+import sys
+import time
+import tracemalloc
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+from document import Document
+from new_db import NewDb
+from order_keys import keys_between
+
+
+def document_data(nodes):
+    """A document of paragraphs holding one text node each, about nodes nodes in total."""
+    paragraphs = max(nodes // 2, 1)
+    return {"markup": "document", "children": [
+        {"markup": "paragraph", "children": [{"markup": "text", "content": f"Paragraph {i}"}]}
+        for i in range(paragraphs)
+    ]}
+
+
+def document_rows(data):
+    """The same document as repo rows (id, markup, attributes, parent_id, position) in document order."""
+    rows = []
+    def add(node, parent_id, position):
+        node_id = str(uuid.uuid4())
+        attributes = {k: v for k, v in node.items() if k not in ("markup", "children")}
+        rows.append((node_id, node["markup"], json.dumps(attributes), parent_id, position))
+        children = node.get("children", [])
+        for child, key in zip(children, keys_between(None, None, len(children))):
+            add(child, node_id, key)
+    add(data, None, "")
+    return rows
+
+
+def measure(build, count):
+    """Bytes and microseconds per node, timed without tracemalloc since tracing slows allocation down."""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tree = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del tree
+    start = time.perf_counter()
+    tree = build()
+    elapsed = time.perf_counter() - start
+    return (after - before) / count, elapsed / count * 1e6
+
+
+def main():
+    nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    data = document_data(nodes)
+    rows = document_rows(data)
+    count = len(rows)
+    db = NewDb(":memory:")
+
+    def from_dict():
+        doc = Document()
+        doc._from_dict(data, parent=None)
+        return doc
+
+    for name, build in (("_from_dict", from_dict), ("_construct_document", lambda: db._construct_document(rows))):
+        memory, micros = measure(build, count)
+        print(f"{name:22} {count} nodes  {memory:8.0f} bytes/node  {micros:6.2f} us/node")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""
+End-to-end load test of the editor backend.
+
+Starts api.py and websocket_server.py (or async_server.py with --async) on
+a fresh database in a temporary directory, imports a document and runs a
+mixed workload against it for --duration seconds:
+
+  readers      GET /api/document/<id>?path=<paragraph>
+  editors      POST /api/document/<id>/batch setting the text of a paragraph
+  subscribers  WebSocket clients subscribed to the document; the time from
+               sending an edit to receiving its update is reported as notify
+
+and reports throughput and p50/p99 latency per operation:
+
+    python3 benchmarks/load.py [--duration 10] [--readers 8] [--editors 2] [--subscribers 50]
+
+Needs the servers' dependencies (flask, aiohttp, websockets) and requests.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+import websockets
+
+BACKEND = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend")
+API_URL = "http://localhost:8000/api"
+WS_URL = "ws://localhost:8080"
+STARTUP_TIMEOUT = 30 # seconds to wait for the servers to listen
+
+
+class Stats:
+    """Latencies per operation, appended to from any thread."""
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, op, seconds):
+        self.latencies.setdefault(op, []).append(seconds)
+
+    def error(self, op):
+        self.errors[op] = self.errors.get(op, 0) + 1
+
+    def report(self, duration):
+        print(f"{'operation':12} {'count':>8} {'errors':>7} {'per sec':>9} {'p50 ms':>9} {'p99 ms':>9}")
+        for op, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            p50 = values[int(0.50 * (len(values) - 1))]
+            p99 = values[int(0.99 * (len(values) - 1))]
+            print(f"{op:12} {len(values):8} {self.errors.get(op, 0):7} {len(values) / duration:9.1f} {p50 * 1e3:9.2f} {p99 * 1e3:9.2f}")
+
+
+def wait_for_port(port):
+    deadline = time.time() + STARTUP_TIMEOUT
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("localhost", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Nothing is listening on port {port}")
+
+
+def start_servers(use_async, directory):
+    """Starts the servers with the temporary directory as working directory, so they get a fresh document.db."""
+    scripts = ["async_server.py"] if use_async else ["websocket_server.py", "api.py"]
+    processes = [
+        subprocess.Popen([sys.executable, os.path.join(BACKEND, script)], cwd=directory,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+        for script in scripts
+    ]
+    for port in (8000, 8080):
+        wait_for_port(port)
+    return processes
+
+
+def stop_servers(processes):
+    for process in processes:
+        try:
+            os.killpg(process.pid, signal.SIGTERM) # the Flask reloader runs the app in a child process
+        except ProcessLookupError:
+            pass
+        process.wait()
+
+
+def reader(doc_id, paragraphs, stats, stop):
+    session = requests.Session()
+    while not stop.is_set():
+        start = time.perf_counter()
+        try:
+            response = session.get(f"{API_URL}/document/{doc_id}", params={"path": str(random.randrange(paragraphs))})
+            response.raise_for_status()
+            stats.record("read", time.perf_counter() - start)
+        except requests.exceptions.RequestException:
+            stats.error("read")
+
+
+def editor(doc_id, paragraphs, stats, stop, sent):
+    """Edits random paragraphs; sent maps the written text to the time the edit was sent, for the notify latency."""
+    session = requests.Session()
+    while not stop.is_set():
+        value = f"edit {threading.get_ident()} {time.perf_counter_ns()}"
+        ops = [{"op": "set", "path": f"{random.randrange(paragraphs)}/0/content", "value": value}]
+        start = time.perf_counter()
+        sent[value] = start
+        try:
+            response = session.post(f"{API_URL}/document/{doc_id}/batch", json=ops)
+            response.raise_for_status()
+            stats.record("edit", time.perf_counter() - start)
+        except requests.exceptions.RequestException:
+            stats.error("edit")
+
+
+async def subscriber(doc_id, stats, stop, sent):
+    async with websockets.connect(WS_URL, max_size=None) as websocket:
+        start = time.perf_counter()
+        await websocket.send(json.dumps({"action": "subscribe", "doc_id": doc_id}))
+        while not stop.is_set():
+            try:
+                message = json.loads(await asyncio.wait_for(websocket.recv(), timeout=0.5))
+            except asyncio.TimeoutError:
+                continue
+            now = time.perf_counter()
+            if message.get("type") == "subscribed":
+                stats.record("subscribe", now - start)
+            for op in message.get("ops") or ():
+                sent_at = sent.get(op.get("value"))
+                if sent_at is not None:
+                    stats.record("notify", now - sent_at)
+
+
+def run_subscribers(count, doc_id, stats, stop, sent):
+    async def run_all():
+        await asyncio.gather(*(subscriber(doc_id, stats, stop, sent) for _ in range(count)))
+    asyncio.run(run_all())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--editors", type=int, default=2)
+    parser.add_argument("--subscribers", type=int, default=50)
+    parser.add_argument("--paragraphs", type=int, default=500, help="size of the edited document")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="run async_server.py instead of api.py and websocket_server.py")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        processes = start_servers(args.use_async, directory)
+        try:
+            data = {"markup": "document", "children": [
+                {"markup": "paragraph", "children": [{"markup": "text", "content": f"Paragraph {i}"}]}
+                for i in range(args.paragraphs)
+            ]}
+            response = requests.post(f"{API_URL}/document/import", json=data)
+            response.raise_for_status()
+            doc_id = response.json()["value"]
+
+            stats = Stats()
+            stop = threading.Event()
+            sent = {}
+            threads = [threading.Thread(target=run_subscribers, args=(args.subscribers, doc_id, stats, stop, sent))] if args.subscribers else []
+            threads += [threading.Thread(target=reader, args=(doc_id, args.paragraphs, stats, stop)) for _ in range(args.readers)]
+            threads += [threading.Thread(target=editor, args=(doc_id, args.paragraphs, stats, stop, sent)) for _ in range(args.editors)]
+            for thread in threads:
+                thread.start()
+            time.sleep(args.duration)
+            stop.set()
+            for thread in threads:
+                thread.join()
+            stats.report(args.duration)
+        finally:
+            stop_servers(processes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Micro-benchmarks of the document model and the database layer.
+
+Every benchmark runs on a synthetic tree of nested paragraphs, `width`
+children per node and `depth` levels, with text leaves, and reports the
+best and the median time of `repeat` runs:
+
+    python3 benchmarks/micro.py [--depth 4] [--width 8] [--repeat 5] [--only html,search]
+
+  from_dict     Document._from_dict of the tree's JSON
+  html          first html() render of a freshly loaded tree
+  to_dict       Document.to_dict
+  doc_search    Document.search, in-memory substring search
+  db_search     NewDb.search, full-text search over the repo table
+  load          NewDb.get_document_by_id of the whole tree
+  path_load     resolving the index path of a node in the middle of the tree
+                with NewDb.get_node_id_at and loading only its subtree
+  front_insert  insert before the first child of the root and save_changes;
+                what used to renumber every sibling now writes one row
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+from document import Document
+from new_db import NewDb
+
+NEEDLE = "needle"
+
+
+def tree_data(depth, width):
+    """A tree of `depth` levels of paragraphs with `width` children each, text leaves at the bottom."""
+    counter = [0]
+    def node(level):
+        counter[0] += 1
+        if level == depth:
+            word = NEEDLE if counter[0] % 97 == 0 else "haystack"
+            return {"markup": "text", "content": f"text {counter[0]} {word} lorem ipsum"}
+        return {"markup": "paragraph", "children": [node(level + 1) for _ in range(width)]}
+    return {"markup": "document", "children": [node(1) for _ in range(width)]}
+
+
+def count_nodes(data):
+    return 1 + sum(count_nodes(child) for child in data.get("children", []))
+
+
+def bench(name, run, setup=None, repeat=5):
+    """Times run(state) after an untimed state = setup(), repeat times."""
+    times = []
+    for _ in range(repeat):
+        state = setup() if setup else None
+        start = time.perf_counter()
+        run(state)
+        times.append(time.perf_counter() - start)
+    print(f"{name:14} best {min(times) * 1e3:10.3f} ms   median {statistics.median(times) * 1e3:10.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--width", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", help="comma separated benchmarks to run")
+    args = parser.parse_args()
+    only = set(args.only.split(",")) if args.only else None
+
+    data = tree_data(args.depth, args.width)
+    print(f"depth {args.depth}, width {args.width}: {count_nodes(data)} nodes")
+
+    def from_dict(_):
+        doc = Document()
+        doc._from_dict(data, parent=None)
+        return doc
+
+    doc = from_dict(None)
+    with tempfile.TemporaryDirectory() as directory:
+        db = NewDb(os.path.join(directory, "bench.db"))
+        db.init_repo()
+        db.insert_document_tree(doc)
+
+        benchmarks = [
+            ("from_dict", from_dict, None),
+            ("html", lambda d: d.html(), lambda: db.get_document_by_id(doc.id)),
+            ("to_dict", lambda _: doc.to_dict(), None),
+            ("doc_search", lambda _: doc.search(NEEDLE), None),
+            ("db_search", lambda _: db.search(NEEDLE, limit=100), None),
+            ("load", lambda _: db.get_document_by_id(doc.id), None),
+            ("path_load", lambda _: db.get_document_by_id(db.get_node_id_at(doc.id, [args.width // 2, 0])), None),
+        ]
+        for name, run, setup in benchmarks:
+            if only is None or name in only:
+                bench(name, run, setup, args.repeat)
+
+        if only is None or "front_insert" in only:
+            target = db.get_document_by_id(doc.id)
+            def front_insert(_):
+                target["0"] = "paragraph"
+                db.save_changes(target)
+            bench("front_insert", front_insert, None, args.repeat)
+
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,10 @@ const WS_URL = "ws://localhost:8080";
 let socket = null;
 let currentDocId = null;
 let subscribedDocId = null;  // Track which document we're subscribed to
+let currentDocData = null;   // Full JSON of the current document, patched by pushed ops
+let currentVersion = null;   // Version of currentDocData (see ot.py), null when it cannot be patched
+let loadInFlight = false;
+let reloadAfterLoad = false;
 
 $(document).ready(() => {
     refreshDocList();
@@ -52,38 +56,158 @@ function initWebSocket() {
 
         // Handle document update notifications
         if (msg.type === "document_update" && msg.doc_id === currentDocId) {
-            console.log(`Document ${msg.doc_id} was updated (${msg.action}). Reloading...`);
-            loadCurrentDoc();
+            handleDocumentUpdate(msg);
         }
     };
 }
 
+function handleDocumentUpdate(msg) {
+    if (msg.action === "delete" && !(msg.ops && msg.ops.length)) {
+        // The document itself was deleted: there is nothing to patch, the reload
+        // shows that it is gone and the list drops it
+        currentDocData = null;
+        currentVersion = null;
+        loadCurrentDoc();
+        refreshDocList();
+        return;
+    }
+    // An update carries the version after its ops, so it applies on top of
+    // version - ops.length. Anything else was missed or is already loaded.
+    if (!loadInFlight && currentDocData && currentVersion !== null && msg.ops && typeof msg.version === "number") {
+        if (msg.version <= currentVersion) {
+            return; // already in the loaded copy
+        }
+        if (msg.version - msg.ops.length === currentVersion) {
+            try {
+                msg.ops.forEach(op => { currentDocData = applyOp(currentDocData, op); });
+                currentVersion = msg.version;
+                renderCurrentDoc();
+                return;
+            } catch (e) {
+                console.warn("Could not apply update, reloading:", e);
+            }
+        }
+    }
+    console.log(`Document ${msg.doc_id} was updated (${msg.action}). Reloading...`);
+    loadCurrentDoc();
+}
+
+// --- 1b. LOCAL DOCUMENT MODEL ---
+// Mirrors Document.to_dict() and Document.html() on the backend.
+function nodeAt(root, path) {
+    let node = root;
+    (path ? path.split('/') : []).forEach(part => {
+        node = node.children[parseInt(part)];
+        if (!node) throw new Error(`No node at ${path}`);
+    });
+    return node;
+}
+
+function splitPath(path) {
+    const i = path.lastIndexOf('/');
+    return i < 0 ? ["", parseInt(path)] : [path.slice(0, i), parseInt(path.slice(i + 1))];
+}
+
+function applyOp(root, op) {
+    if (op.op === "set") {
+        nodeAt(root, op.path)[op.key] = op.value;
+    } else if (op.op === "unset") {
+        delete nodeAt(root, op.path)[op.key];
+    } else if (op.op === "insert") {
+        const [parentPath, idx] = splitPath(op.path);
+        const parent = nodeAt(root, parentPath);
+        parent.children = parent.children || [];
+        parent.children.splice(idx, 0, op.node);
+    } else if (op.op === "delete") {
+        const [parentPath, idx] = splitPath(op.path);
+        const parent = nodeAt(root, parentPath);
+        parent.children.splice(idx, 1);
+        if (!parent.children.length) delete parent.children;
+    } else if (op.op === "replace") {
+        if (!op.path) return op.node;
+        const [parentPath, idx] = splitPath(op.path);
+        nodeAt(root, parentPath).children[idx] = op.node;
+    } else {
+        throw new Error(`Unknown op ${op.op}`);
+    }
+    return root;
+}
+
+function renderHtml(node) {
+    const style = node.style ? ` style="${node.style}"` : "";
+    if (node.markup === 'text') return node.content || "";
+    if (node.markup === 'image') {
+        return node.src ? `\t<img src="${node.src}" alt="image" />\n` : '\t<img alt="image" />\n';
+    }
+    const inner = (node.children || []).map(renderHtml).join("");
+    const tags = {
+        'document': ['', ''],
+        'paragraph': [`\t<p${style}>\n`, '\n</p>\n'],
+        'strong': [`<strong${style}>`, '</strong>'],
+        'list': [`\t<ul${style}>\n`, '</ul>\n'],
+        'item': [`\t<li${style}>\n`, '\n</li>\n'],
+        'table': [`\t<table${style}>\n`, '</table>\n'],
+        'row': [`\t<tr${style}>\n`, '</tr>\n'],
+        'cell': [`\t<td${style}>\n`, '\n</td>\n'],
+    }[node.markup];
+    if (tags) return tags[0] + inner + tags[1];
+    return inner ? `\t<div${style}>\n${inner}\n</div>\n` : "";
+}
+
+function renderCurrentDoc() {
+    $('#visual-content').html(renderHtml(currentDocData));
+    $('#json-content').text(JSON.stringify(currentDocData, null, 4));
+}
+
+// Reload only when the push channel is down, otherwise our own update arrives over it
+function reloadIfOffline() {
+    if (!socket || socket.readyState !== WebSocket.OPEN) {
+        loadCurrentDoc();
+    }
+}
+
 // --- 2. REST API ACTIONS ---
+const DOC_LIST_PAGE_SIZE = 50;
+let docListGeneration = 0;  // a newer refresh drops the pages of an older one
+let docListCursor = null;   // where the next page of the document list starts, null after the last one
+
 function refreshDocList() {
     // Save current selection before refreshing
     const previousSelection = $('#docSelector').val();
-    
-    $.get(API_BASE, (response) => {
-        // response.value looks like: [ ["uuid-1"], ["uuid-2"] ]
-        const list = response.value || []; 
-        const sel = $('#docSelector');
-        sel.empty().append('<option disabled selected>-- Select --</option>');
-        
-        list.forEach(item => {
-            // item is an array like ["4e16c37a..."]
-            // We need the first element (index 0)
-            let id = item[0]; 
-            
-            // Only add if ID exists
-            if (id) {
-                sel.append(`<option value="${id}">${id}</option>`);
-            }
+    docListGeneration++;
+    docListCursor = null;
+    $('#docSelector').empty().append('<option disabled selected>-- Select --</option>');
+    loadDocListPage(null, previousSelection);
+}
+
+// Root documents come a page at a time, further pages only when asked for
+function loadMoreDocs() {
+    if (docListCursor) loadDocListPage(docListCursor, $('#docSelector').val());
+}
+
+function loadDocListPage(cursor, previousSelection) {
+    const generation = docListGeneration;
+    const sel = $('#docSelector');
+    const params = { limit: DOC_LIST_PAGE_SIZE };
+    if (cursor) params.cursor = cursor;
+    $('#loadMoreDocs').hide();
+    $.get(API_BASE, params, (response) => {
+        if (generation !== docListGeneration) return;
+        // response.value looks like: [ {"id": "uuid-1", "title": "...", "size": 12}, ... ]
+        (response.value || []).forEach(item => {
+            const label = `${item.title || item.id} (${item.size} nodes)`;
+            sel.append($('<option>').val(item.id).text(label));
         });
-        
-        // Restore previous selection if it still exists in the list
+
+        // Restore previous selection once its page has arrived
         if (previousSelection && sel.find(`option[value="${previousSelection}"]`).length > 0) {
             sel.val(previousSelection);
         }
+        docListCursor = response.next_cursor || null;
+        $('#loadMoreDocs').toggle(docListCursor !== null);
+    }).fail(() => {
+        // the same page can be asked for again
+        if (generation === docListGeneration) $('#loadMoreDocs').toggle(docListCursor !== null);
     });
 }
 
@@ -92,6 +216,11 @@ function loadCurrentDocWithPath() {
 }
 
 function loadCurrentDoc() {
+    if (loadInFlight) {
+        // An update raced with the running load, load again once it is done
+        reloadAfterLoad = true;
+        return;
+    }
     // Get the selected doc from dropdown, or use existing currentDocId
     const selectedDoc = $('#docSelector').val();
     
@@ -127,13 +256,25 @@ function loadCurrentDoc() {
     });
 
     // 4. Request DATA (JSON) with path
+    loadInFlight = true;
     $.get(`${API_BASE}/${currentDocId}${queryParams}`, (response) => {
         // Handle wrapping if your backend returns {"result":..., "value":...}
         const data = response.value || response;
+        // Only a whole document can be patched by pushed ops
+        currentDocData = pathVal ? null : data;
+        currentVersion = pathVal || typeof response.version !== "number" ? null : response.version;
         const prettyJson = JSON.stringify(data, null, 4);
         $('#json-content').text(prettyJson);
     }).fail((err) => {
+        currentDocData = null;
+        currentVersion = null;
         $('#json-content').text(`Error loading JSON: ${err.responseText || err.statusText}`);
+    }).always(() => {
+        loadInFlight = false;
+        if (reloadAfterLoad) {
+            reloadAfterLoad = false;
+            loadCurrentDoc();
+        }
     });
 }
 
@@ -192,9 +333,8 @@ function performInsert() {
         data: JSON.stringify(jsonData),
         success: (res) => {
             console.log("Insert success:", res);
-            // We reload immediately for ourselves. 
-            // The WS server will tell *others* to reload.
-            loadCurrentDoc(); 
+            // The WS server pushes the change to everyone, including us.
+            reloadIfOffline();
         },
         error: (err) => alert("Error: " + JSON.stringify(err.responseJSON))
     });
@@ -234,7 +374,7 @@ function performQuickEdit() {
         data: JSON.stringify(payload),
         success: (res) => {
             console.log("Quick Edit success:", res);
-            loadCurrentDoc();
+            reloadIfOffline();
             // Clear inputs after success
             $('#quickEditPath').val('');
             $('#quickEditValue').val('');
@@ -289,7 +429,7 @@ function performDelete() {
         type: 'DELETE',
         success: (res) => {
             console.log("Delete success:", res);
-            loadCurrentDoc();
+            reloadIfOffline();
         }
     });
 }
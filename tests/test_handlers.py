@@ -0,0 +1,129 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+import handlers
+from handlers import DocumentApi
+from new_db import NewDb
+from repo import DocumentRepo
+
+IDLE = 3600 # checkpoint_interval that keeps the background checkpoints out of the tests
+
+
+class ApiTestCase(unittest.TestCase):
+    """Runs every test against a fresh database in a temporary directory, recording the published updates."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.db = NewDb(os.path.join(directory.name, "test.db"))
+        self.db.init_repo()
+        self.addCleanup(self.db.close)
+        self.repo = DocumentRepo(self.db, checkpoint_interval=IDLE)
+        self.published = []
+        self.api = DocumentApi(self.repo, lambda *update: self.published.append(update))
+
+    def import_document(self, *texts):
+        payload, status = self.api.import_json({"markup": "document", "children": [
+            {"markup": "paragraph", "children": [{"markup": "text", "content": text} for text in texts]}]})
+        self.assertEqual(status, 201)
+        self.published.clear()
+        return payload["value"]
+
+    def contents(self, doc_id):
+        with self.repo.reading(doc_id):
+            paragraph = self.repo.find_document_by_id(doc_id).children[0]
+            return [child.attributes.get("content") for child in paragraph.children]
+
+
+class BatchTest(ApiTestCase):
+
+    def test_batch_is_applied_saved_and_announced_once(self):
+        doc_id = self.import_document("a", "b")
+        payload, status = self.api.apply_batch(doc_id, [
+            {"op": "set", "path": "0/0/content", "value": "changed"},
+            {"op": "insert", "path": "0/2", "node": {"markup": "text", "content": "c"}},
+            {"op": "delete", "path": "0/1"},
+        ])
+        self.assertEqual(status, 200)
+        self.assertEqual(payload["version"], 3)
+        self.assertEqual(self.contents(doc_id), ["changed", "c"])
+        self.assertEqual(len(self.published), 1)
+        self.assertEqual([op["op"] for op in self.published[0][2]], ["set", "insert", "delete"])
+        self.assertEqual(len(self.db.get_ops(doc_id, 0)), 3)
+
+    def test_failing_operation_leaves_the_document_unchanged(self):
+        doc_id = self.import_document("a", "b")
+        payload, status = self.api.apply_batch(doc_id, {"ops": [
+            {"op": "set", "path": "0/0/content", "value": "changed"},
+            {"op": "delete", "path": "0/1"},
+            {"op": "delete", "path": "0/5"},
+        ]})
+        self.assertEqual(status, 400)
+        self.assertEqual(payload["index"], 2)
+        self.assertEqual(self.contents(doc_id), ["a", "b"])
+        self.assertEqual(self.published, [])
+        self.assertEqual(self.db.get_ops(doc_id, 0), [])
+        self.assertEqual(self.repo.version(doc_id), 0)
+        # the discarded tree is reloaded for the next edit
+        self.assertEqual(self.api.apply_batch(doc_id, [{"op": "delete", "path": "0/0"}])[1], 200)
+        self.assertEqual(self.contents(doc_id), ["b"])
+
+    def test_invalid_batches_are_rejected(self):
+        doc_id = self.import_document("a")
+        self.assertEqual(self.api.apply_batch(doc_id, {"op": "delete", "path": "0/0"})[1], 400)
+        self.assertEqual(self.api.apply_batch(doc_id, ["delete"])[1], 400)
+        with mock.patch.object(handlers, "MAX_BATCH_OPERATIONS", 1):
+            self.assertEqual(self.api.apply_batch(doc_id, [{"op": "delete", "path": "0/0"}] * 2)[1], 400)
+        self.assertEqual(self.api.apply_batch("not-a-uuid", [])[1], 400)
+        self.assertEqual(self.contents(doc_id), ["a"])
+
+
+class PaginationTest(ApiTestCase):
+
+    def read(self, doc_id, **args):
+        payload, status = self.api.get_document(doc_id, args)
+        self.assertEqual(status, 200)
+        return json.loads("".join(payload))
+
+    def test_windows_of_children(self):
+        doc_id = self.import_document(*"abcde")
+        page = self.read(doc_id, path="0", offset="1", limit="3")
+        self.assertEqual([child["content"] for child in page["value"]["children"]], ["b", "c", "d"])
+        self.assertEqual((page["children_total"], page["next_offset"]), (5, 4))
+        last = self.read(doc_id, path="0", offset="4", limit="3")
+        self.assertEqual([child["content"] for child in last["value"]["children"]], ["e"])
+        self.assertIsNone(last["next_offset"])
+        self.assertEqual(self.read(doc_id)["version"], 0)
+
+    def test_depth_leaves_out_deeper_children(self):
+        doc_id = self.import_document("a", "b")
+        shallow = self.read(doc_id, depth="1")["value"]
+        self.assertEqual(shallow["children"][0]["children_count"], 2)
+        self.assertNotIn("children", shallow["children"][0])
+        # a document that is not cached is read from the database
+        self.api = DocumentApi(DocumentRepo(self.db, checkpoint_interval=IDLE), self.api.publish)
+        self.assertEqual(self.read(doc_id, path="0", depth="0")["value"]["children_count"], 2)
+        self.assertEqual(len(self.api.repo.documents), 0)
+
+    def test_invalid_windows_are_rejected(self):
+        doc_id = self.import_document("a")
+        for args in ({"offset": "-1"}, {"limit": "0"}, {"depth": "x"}):
+            self.assertEqual(self.api.get_document(doc_id, args)[1], 400)
+        self.assertEqual(self.api.list_documents({"limit": "x"})[1], 400)
+
+    def test_document_list_pages(self):
+        ids = {self.import_document(text) for text in "abc"}
+        first = self.api.list_documents({"limit": "2"})[0]
+        rest = self.api.list_documents({"limit": "2", "cursor": first["next_cursor"]})[0]
+        self.assertEqual({item["id"] for item in first["value"] + rest["value"]}, ids)
+        self.assertIsNone(rest["next_cursor"])
+
+
+if __name__ == "__main__":
+    unittest.main()
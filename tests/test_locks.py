@@ -0,0 +1,118 @@
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+from locks import LockTable, ReadWriteLock
+
+WAIT = 0.05 # seconds a blocked thread is given to (wrongly) get in
+
+
+def start(target):
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    return thread
+
+
+class ReadWriteLockTest(unittest.TestCase):
+
+    def test_readers_share_the_lock(self):
+        lock = ReadWriteLock()
+        inside = threading.Barrier(2, timeout=1)
+        def reader():
+            with lock.read():
+                inside.wait() # fails unless both readers are in at once
+        threads = [start(reader) for _ in range(2)]
+        for thread in threads:
+            thread.join(1)
+        self.assertFalse(inside.broken)
+
+    def test_writer_excludes_writers_and_readers(self):
+        lock = ReadWriteLock()
+        entered = []
+        release = threading.Event()
+        def hold(name, mode):
+            with mode():
+                entered.append(name)
+                release.wait(1)
+        with lock.write():
+            threads = [start(lambda: hold("write", lock.write)), start(lambda: hold("read", lock.read))]
+            time.sleep(WAIT)
+            self.assertEqual(entered, [])
+        time.sleep(WAIT)
+        # one of them got in after the release, the other waits behind it
+        self.assertEqual(len(entered), 1)
+        release.set()
+        for thread in threads:
+            thread.join(1)
+        self.assertEqual(sorted(entered), ["read", "write"])
+
+    def test_waiting_writer_blocks_new_readers(self):
+        lock = ReadWriteLock()
+        order = []
+        def writer():
+            with lock.write():
+                order.append("write")
+        def reader():
+            with lock.read():
+                order.append("read")
+        with lock.read():
+            writer_thread = start(writer)
+            time.sleep(WAIT)
+            reader_thread = start(reader)
+            time.sleep(WAIT)
+            self.assertEqual(order, [])
+        writer_thread.join(1)
+        reader_thread.join(1)
+        self.assertEqual(order, ["write", "read"])
+
+
+class LockTableTest(unittest.TestCase):
+
+    def test_entries_are_dropped_when_unused(self):
+        table = LockTable()
+        with table.read("a"):
+            with table.read("a"), table.write("b"):
+                self.assertEqual(table._locks["a"][1], 2)
+                self.assertIn("b", table._locks)
+            self.assertEqual(table._locks["a"][1], 1)
+            self.assertNotIn("b", table._locks)
+        self.assertEqual(table._locks, {})
+
+    def test_entry_is_kept_while_a_writer_waits(self):
+        table = LockTable()
+        released = threading.Event()
+        def writer():
+            with table.write("a"):
+                released.wait(1)
+        with table.read("a"):
+            thread = start(writer)
+            time.sleep(WAIT)
+            self.assertEqual(table._locks["a"][1], 2)
+        released.set()
+        thread.join(1)
+        self.assertEqual(table._locks, {})
+
+    def test_entries_are_dropped_after_errors(self):
+        table = LockTable()
+        with self.assertRaises(KeyError):
+            with table.write("a"):
+                raise KeyError("a")
+        self.assertEqual(table._locks, {})
+
+    def test_keys_lock_independently(self):
+        table = LockTable()
+        done = threading.Event()
+        def writer():
+            with table.write("b"):
+                done.set()
+        with table.write("a"):
+            start(writer)
+            self.assertTrue(done.wait(1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,159 @@
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+from document import Document
+from new_db import NewDb
+
+
+def document(*texts):
+    doc = Document()
+    doc.importJson({"markup": "document", "children": [{"markup": "paragraph", "children": [
+        {"markup": "text", "content": text} for text in texts]}]})
+    return doc
+
+
+class NewDbTestCase(unittest.TestCase):
+    """Runs every test against a fresh database in a temporary directory."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.db = NewDb(os.path.join(directory.name, "test.db"))
+        self.db.init_repo()
+        self.addCleanup(self.db.close)
+
+
+class GroupCommitTest(NewDbTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # long enough that appends made one after the other share a group commit
+        self.db.flush_interval = 0.1
+
+    def committed(self, root_id):
+        """Versions of root_id's logged operations, as seen by another connection."""
+        conn = sqlite3.connect(self.db.db_name)
+        try:
+            return [row[0] for row in conn.execute("""select version from ops where root_id = ? order by version""", (root_id,))]
+        finally:
+            conn.close()
+
+    def test_commit_and_fsync_wait_for_the_commit(self):
+        ack = self.db.append_ops("a", 1, [{"op": "set"}, {"op": "unset"}], durability="commit")
+        self.assertTrue(ack.event.is_set())
+        self.assertEqual(self.committed("a"), [1, 2])
+        self.db.append_ops("a", 3, [{"op": "set"}], durability="fsync")
+        self.assertEqual(self.committed("a"), [1, 2, 3])
+
+    def test_none_returns_before_the_commit(self):
+        ack = self.db.append_ops("a", 1, [{"op": "set"}], durability="none")
+        self.assertFalse(ack.event.is_set())
+        self.db.flush()
+        ack.wait()
+        self.assertEqual(self.committed("a"), [1])
+
+    def test_reads_of_the_log_see_queued_appends(self):
+        self.db.append_ops("a", 1, [{"op": "set"}], durability="none")
+        self.assertEqual(self.db.get_ops("a", 0), [(1, {"op": "set"})])
+
+    def test_appends_of_a_failed_group_commit_all_fail(self):
+        self.db.append_ops("a", 1, [{"op": "set"}])
+        other = self.db.append_ops("b", 1, [{"op": "set"}], durability="none")
+        with self.assertRaises(sqlite3.IntegrityError):
+            # version 1 of "a" is logged already
+            self.db.append_ops("a", 1, [{"op": "set"}])
+        with self.assertRaises(sqlite3.IntegrityError):
+            other.wait()
+        self.assertEqual(self.committed("b"), [])
+
+    def test_empty_appends_are_done_right_away(self):
+        self.assertTrue(self.db.append_ops("a", 1, [], durability="commit").event.is_set())
+        self.assertEqual(self.committed("a"), [])
+
+
+class SaveChangesTest(NewDbTestCase):
+
+    def test_changed_nodes_are_written(self):
+        doc = document("a", "b", "c")
+        self.db.insert_document_tree(doc)
+        paragraph = doc.children[0]
+        removed = paragraph.children[1].id
+        paragraph["0/content"] = "changed"
+        paragraph.insert("3", Document("text", attributes={"content": "d"}))
+        del paragraph["1"]
+        self.db.save_changes(doc)
+        self.assertFalse(doc.has_changes())
+        self.assertEqual(self.db.get_document_by_id(doc.id).to_dict(), doc.to_dict())
+        self.assertIsNone(self.db.get_root_id(removed))
+
+    def test_nothing_is_written_without_changes(self):
+        doc = document("a")
+        self.db.insert_document_tree(doc)
+        self.db.save_changes(doc)
+        self.assertEqual(self.db.get_document_by_id(doc.id).to_dict(), doc.to_dict())
+
+    def test_subtree_changes_are_saved_through_any_node(self):
+        doc = document("a", "b")
+        self.db.insert_document_tree(doc)
+        text = doc.children[0].children[1]
+        text["content"] = "changed"
+        self.db.save_changes(text)
+        self.assertEqual(self.db.get_document_by_id(text.id).attributes["content"], "changed")
+
+
+class SearchTest(NewDbTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.first = document("Hello brave new world", "world peace")
+        self.second = document("another world")
+        self.db.insert_document_tree(self.first)
+        self.db.insert_document_tree(self.second)
+
+    def ids(self, rows):
+        return [row[0] for row in rows]
+
+    def test_words_and_prefixes_match(self):
+        texts = self.first.children[0].children
+        self.assertEqual(len(self.db.search("world")), 3)
+        self.assertEqual(self.ids(self.db.search("bra wor")), [texts[0].id])
+        self.assertEqual(self.db.search("peace")[0][3], "world <b>peace</b>")
+        self.assertEqual(self.db.search("   "), [])
+
+    def test_operators_are_searched_literally(self):
+        self.assertEqual(self.db.search('"world" OR'), [])
+        self.assertEqual(self.db.search("world*"), self.db.search("world"))
+
+    def test_search_in_a_document_or_subtree(self):
+        rows = self.db.search("world", self.first.id)
+        self.assertEqual({row[1] for row in rows}, {self.first.id})
+        self.assertEqual(len(rows), 2)
+        text = self.second.children[0].children[0]
+        self.assertEqual(self.ids(self.db.search("world", text.id)), [text.id])
+        self.assertEqual(self.db.search("world", "not-a-document"), [])
+
+    def test_document_ids_are_not_searched(self):
+        self.assertEqual(self.db.search(self.first.id.split("-")[0]), [])
+
+    def test_pages(self):
+        everything = self.ids(self.db.search("world"))
+        pages = [self.ids(self.db.search("world", limit=2, offset=offset)) for offset in (0, 2)]
+        # equal scores come in no particular order
+        self.assertEqual([len(page) for page in pages], [2, 1])
+        self.assertEqual(set(pages[0] + pages[1]), set(everything))
+
+    def test_index_follows_writes(self):
+        self.first.children[0]["1/content"] = "no match"
+        self.db.save_changes(self.first)
+        self.assertEqual(self.db.search("peace"), [])
+        self.db.delete_document(self.second.id)
+        self.assertEqual({row[1] for row in self.db.search("world")}, {self.first.id})
+
+
+if __name__ == "__main__":
+    unittest.main()
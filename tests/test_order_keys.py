@@ -0,0 +1,80 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+from new_db import NewDb
+from order_keys import key_between, keys_between
+
+
+class KeysBetweenTest(unittest.TestCase):
+
+    def assertAscending(self, keys):
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(len(set(keys)), len(keys))
+
+    def test_keys_are_ascending_and_between_bounds(self):
+        for a, b in ((None, None), ("a0", None), (None, "a0"), ("a0", "a1"), ("a0", "a0V")):
+            keys = keys_between(a, b, 50)
+            self.assertEqual(len(keys), 50)
+            self.assertAscending(keys)
+            if a is not None:
+                self.assertGreater(keys[0], a)
+            if b is not None:
+                self.assertLess(keys[-1], b)
+
+    def test_repeated_inserts_keep_order(self):
+        keys = [key_between(None, None)]
+        for i in range(200):
+            keys.append(key_between(keys[-1], None)) # append
+            keys.insert(0, key_between(None, keys[0])) # prepend
+            middle = len(keys) // 2
+            keys.insert(middle, key_between(keys[middle - 1], keys[middle]))
+        self.assertAscending(keys)
+        # appending and prepending only grow the integer part slowly
+        self.assertLess(max(len(keys[0]), len(keys[-1])), 5)
+
+    def test_out_of_order_bounds_raise(self):
+        with self.assertRaises(ValueError):
+            key_between("a1", "a0")
+        with self.assertRaises(ValueError):
+            key_between("a0", "a0")
+        with self.assertRaises(ValueError):
+            key_between("a10", None) # trailing zero fraction
+
+
+class SubtreeRangeTest(unittest.TestCase):
+    """Key paths ("a0/b1/") terminate every segment with '/', so a subtree is one range of paths."""
+
+    def setUp(self):
+        self.db = NewDb(os.path.join(tempfile.mkdtemp(), "keys.db"))
+
+    def in_range(self, path, paths):
+        low, high = self.db._subtree_range(path)
+        return [p for p in paths if low <= p < high]
+
+    def test_range_holds_node_and_descendants_only(self):
+        first = key_between(None, None)
+        # a sibling whose key extends the first one's
+        extended = key_between(first, key_between(first, None))
+        self.assertTrue(extended.startswith(first), extended)
+        child = key_between(None, None)
+        paths = ["", first + "/", first + "/" + child + "/", first + "/" + child + "/" + child + "/",
+                 extended + "/", extended + "/" + child + "/"]
+        self.assertEqual(self.in_range(first + "/", paths), paths[1:4])
+        self.assertEqual(self.in_range(extended + "/", paths), paths[4:])
+        self.assertEqual(self.in_range("", paths), paths)
+
+    def test_sorted_paths_are_document_order(self):
+        keys = keys_between(None, None, 12)
+        paths = []
+        for key in keys:
+            paths.append(key + "/")
+            paths.extend(key + "/" + child + "/" for child in keys[:3])
+        self.assertEqual(sorted(reversed(paths)), paths)
+
+
+if __name__ == "__main__":
+    unittest.main()
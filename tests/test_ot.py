@@ -0,0 +1,164 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+from document import Document
+from ot import OpHistory, VersionError, rebase, transform
+
+
+def insert(path, content):
+    return {"op": "insert", "path": path, "node": {"markup": "text", "content": content}}
+
+
+def contents(doc):
+    return [child.attributes.get("content") for child in doc.children[0].children]
+
+
+def document():
+    doc = Document()
+    doc.importJson({"markup": "document", "children": [{"markup": "paragraph", "children": [
+        {"markup": "text", "content": "a"}, {"markup": "text", "content": "b"}]}]})
+    return doc
+
+
+def converged(first, second):
+    """
+    Applies first then second rebased over it, like the server, and second then first
+    transformed over it, like the client that made second. Returns both documents.
+    """
+    server = document()
+    server.apply_op(first)
+    for op in rebase([second], [first]):
+        server.apply_op(op)
+    client = document()
+    client.apply_op(second)
+    other = transform(first, second, wins_ties=True)
+    if other is not None:
+        client.apply_op(other)
+    return without_ids(server.to_dict()), without_ids(client.to_dict())
+
+
+def without_ids(node):
+    return {**{key: value for key, value in node.items() if key != "id"},
+            "children": [without_ids(child) for child in node.get("children", [])]}
+
+
+class TransformTest(unittest.TestCase):
+
+    def test_insert_at_same_index_goes_after_the_applied_one(self):
+        self.assertEqual(rebase([insert("0/1", "mine")], [insert("0/1", "theirs")]), [insert("0/2", "mine")])
+
+    def test_concurrent_inserts_at_same_index_converge(self):
+        first, second = insert("0/1", "first"), insert("0/1", "second")
+        server = document()
+        server.apply_op(first)
+        for op in rebase([second], [first]):
+            server.apply_op(op)
+        # a client that applied its own insert before hearing of the other one
+        client = document()
+        client.apply_op(second)
+        client.apply_op(transform(first, second, wins_ties=True))
+        self.assertEqual(contents(server), ["a", "first", "second", "b"])
+        self.assertEqual(contents(client), contents(server))
+
+    def test_delete_of_same_node_is_dropped(self):
+        self.assertEqual(rebase([{"op": "delete", "path": "0/1"}], [{"op": "delete", "path": "0/1"}]), [])
+
+    def test_insert_at_index_of_deleted_node_stays(self):
+        self.assertEqual(rebase([insert("0/1", "x")], [{"op": "delete", "path": "0/1"}]), [insert("0/1", "x")])
+
+    def test_delete_moves_past_insert_at_same_index(self):
+        self.assertEqual(rebase([{"op": "delete", "path": "0/1"}], [insert("0/1", "x")]), [{"op": "delete", "path": "0/2"}])
+
+    def test_ops_under_deleted_ancestor_are_dropped(self):
+        concurrent = [{"op": "delete", "path": "0/1"}]
+        self.assertEqual(rebase([{"op": "set", "path": "0/1/2", "key": "content", "value": "x"}], concurrent), [])
+        self.assertEqual(rebase([insert("0/1/0", "x")], concurrent), [])
+        self.assertEqual(rebase([{"op": "delete", "path": "0/1/3"}], concurrent), [])
+
+    def test_ops_on_replaced_node_are_dropped(self):
+        concurrent = [{"op": "replace", "path": "0", "node": {"markup": "paragraph"}}]
+        self.assertEqual(rebase([{"op": "set", "path": "0/1", "key": "content", "value": "x"}], concurrent), [])
+        self.assertEqual(rebase([{"op": "set", "path": "0", "key": "style", "value": "x"}], concurrent), [])
+        self.assertEqual(rebase([{"op": "delete", "path": "0"}], concurrent), [{"op": "delete", "path": "0"}])
+
+    def test_set_of_same_key_keeps_the_first_applied(self):
+        first = {"op": "set", "path": "0/1", "key": "content", "value": "first"}
+        second = {"op": "set", "path": "0/1", "key": "content", "value": "second"}
+        self.assertEqual(rebase([second], [first]), [])
+        self.assertEqual(rebase([{**second, "key": "style"}], [first]), [{**second, "key": "style"}])
+        server, client = converged(first, second)
+        self.assertEqual(server, client)
+        self.assertEqual(server["children"][0]["children"][1]["content"], "first")
+
+    def test_set_and_unset_of_same_key_converge(self):
+        server, client = converged({"op": "unset", "path": "0/0", "key": "content"},
+                                   {"op": "set", "path": "0/0", "key": "content", "value": "x"})
+        self.assertEqual(server, client)
+        server, client = converged({"op": "set", "path": "0/0", "key": "content", "value": "x"},
+                                   {"op": "unset", "path": "0/0", "key": "content"})
+        self.assertEqual(server, client)
+
+    def test_set_and_replace_of_same_node_converge(self):
+        replace = {"op": "replace", "path": "0/1", "node": {"markup": "text", "content": "new"}}
+        for set_op in ({"op": "set", "path": "0/1", "key": "style", "value": "x"},
+                       {"op": "set", "path": "0/1", "key": "content", "value": "x"}):
+            for first, second in ((replace, set_op), (set_op, replace)):
+                server, client = converged(first, second)
+                self.assertEqual(server, client)
+                self.assertEqual(server["children"][0]["children"][1].get("style"), None)
+                self.assertEqual(server["children"][0]["children"][1]["content"], "new")
+
+    def test_replace_of_same_node_keeps_the_first_applied(self):
+        first = {"op": "replace", "path": "0/1", "node": {"markup": "text", "content": "first"}}
+        second = {"op": "replace", "path": "0/1", "node": {"markup": "text", "content": "second"}}
+        server, client = converged(first, second)
+        self.assertEqual(server, client)
+        self.assertEqual(server["children"][0]["children"][1]["content"], "first")
+
+    def test_delete_and_replace_of_same_node_converge(self):
+        replace = {"op": "replace", "path": "0/1", "node": {"markup": "text", "content": "new"}}
+        delete = {"op": "delete", "path": "0/1"}
+        for first, second in ((replace, delete), (delete, replace)):
+            server, client = converged(first, second)
+            self.assertEqual(server, client)
+            self.assertEqual([child["content"] for child in server["children"][0]["children"]], ["a"])
+
+    def test_ancestor_insert_and_delete_shift_descendants(self):
+        op = {"op": "set", "path": "0/3/1", "key": "content", "value": "x"}
+        self.assertEqual(rebase([op], [insert("0/2", "y")])[0]["path"], "0/4/1")
+        self.assertEqual(rebase([op], [{"op": "delete", "path": "0/0"}])[0]["path"], "0/2/1")
+        # siblings of the ancestor after the changed index only
+        self.assertEqual(rebase([op], [insert("0/5", "y")])[0]["path"], "0/3/1")
+
+    def test_later_ops_see_earlier_ones_applied(self):
+        ops = [insert("0/0", "x"), {"op": "delete", "path": "0/3"}]
+        self.assertEqual(rebase(ops, [{"op": "delete", "path": "0/0"}]),
+                         [insert("0/0", "x"), {"op": "delete", "path": "0/2"}])
+
+
+class OpHistoryTest(unittest.TestCase):
+
+    def test_since_returns_ops_after_version(self):
+        history = OpHistory(5)
+        history.append(["a", "b", "c"])
+        self.assertEqual(history.version, 8)
+        self.assertEqual(history.since(6), ["b", "c"])
+        self.assertEqual(history.since(8), [])
+
+    def test_versions_out_of_the_history_raise(self):
+        history = OpHistory(0, limit=2)
+        history.append(["a", "b", "c"])
+        with self.assertRaises(VersionError):
+            history.since(0)
+        with self.assertRaises(VersionError):
+            history.since(4)
+        history.forget()
+        with self.assertRaises(VersionError):
+            history.since(2)
+
+
+if __name__ == "__main__":
+    unittest.main()
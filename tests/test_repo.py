@@ -0,0 +1,189 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+from document import Document
+from new_db import NewDb
+from repo import DocumentRepo
+
+IDLE = 3600 # checkpoint_interval that keeps the background checkpoints out of the tests
+
+
+def document(*texts):
+    doc = Document()
+    doc.importJson({"markup": "document", "children": [{"markup": "paragraph", "children": [
+        {"markup": "text", "content": text} for text in texts]}]})
+    return doc
+
+
+class RepoTestCase(unittest.TestCase):
+    """Runs every test against a fresh database in a temporary directory."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.db = NewDb(os.path.join(directory.name, "test.db"))
+        self.db.init_repo()
+        self.addCleanup(self.db.close)
+        self.repo = self.new_repo()
+
+    def new_repo(self, **kwargs):
+        """A repo with an empty cache, like one of a restarted server."""
+        return DocumentRepo(self.db, checkpoint_interval=IDLE, **kwargs)
+
+    def edit(self, repo, root_id, path, value):
+        with repo.writing(root_id):
+            root = repo.find_document_by_id(root_id)
+            root[path] = value
+            repo.save(root)
+
+
+class OperationLogTest(RepoTestCase):
+
+    def test_saves_are_logged_and_replayed(self):
+        doc = document("a", "b")
+        self.repo.insert_tree(doc)
+        self.edit(self.repo, doc.id, "0/0/content", "changed")
+        self.edit(self.repo, doc.id, "0/2", "text")
+        # the rows wait for the next checkpoint
+        self.assertEqual(self.db.get_document_by_id(doc.id).children[0].children[0].attributes["content"], "a")
+        self.assertEqual([version for version, _ in self.db.get_ops(doc.id, 0)], [1, 2])
+
+        repo = self.new_repo()
+        with repo.reading(doc.id):
+            loaded = repo.find_document_by_id(doc.id)
+            self.assertEqual(loaded.to_dict(), doc.to_dict())
+            self.assertEqual(repo.version(doc.id), 2)
+            # nodes inserted after the snapshot are found by id too
+            inserted = doc.children[0].children[2].id
+            self.assertIs(repo.find_document_by_id(inserted), loaded.children[0].children[2])
+
+    def test_recover_checkpoints_documents_behind_their_log(self):
+        doc = document("a")
+        self.repo.insert_tree(doc)
+        self.edit(self.repo, doc.id, "0/0/content", "changed")
+        self.assertEqual(self.db.get_unsnapshotted_roots(), [doc.id])
+
+        repo = self.new_repo()
+        repo.recover()
+        self.assertEqual(self.db.get_unsnapshotted_roots(), [])
+        self.assertEqual(self.db.get_snapshot_version(doc.id), 1)
+        self.assertEqual(self.db.get_document_by_id(doc.id).to_dict(), doc.to_dict())
+
+    def test_checkpoint_every_checkpoint_ops(self):
+        repo = self.new_repo(checkpoint_ops=3)
+        doc = document("a")
+        repo.insert_tree(doc)
+        for i in range(4):
+            self.edit(repo, doc.id, "0/0/content", str(i))
+        self.assertEqual(self.db.get_snapshot_version(doc.id), 3)
+        self.assertEqual(self.db.get_document_by_id(doc.id).children[0].children[0].attributes["content"], "2")
+
+    def test_checkpoint_compacts_the_log(self):
+        doc = document("a")
+        self.repo.insert_tree(doc)
+        for i in range(5):
+            self.edit(self.repo, doc.id, "0/0/content", str(i))
+        with mock.patch.object(NewDb, "KEPT_OPS", 2), self.repo.writing(doc.id):
+            self.repo.checkpoint(self.repo.find_document_by_id(doc.id))
+        self.assertEqual([version for version, _ in self.db.get_ops(doc.id, 0)], [4, 5])
+        # the history of a reloaded document starts at the oldest kept operation
+        repo = self.new_repo()
+        with repo.reading(doc.id):
+            repo.find_document_by_id(doc.id)
+        self.assertEqual(len(repo.histories[doc.id].since(3)), 2)
+
+    def test_catch_up_makes_saves_searchable(self):
+        doc = document("a")
+        self.repo.insert_tree(doc)
+        self.edit(self.repo, doc.id, "0/1", "text")
+        self.edit(self.repo, doc.id, "0/1/content", "zebra")
+        inserted = doc.children[0].children[1].id
+        self.assertEqual(self.db.search("zebra"), [])
+        self.assertEqual(self.repo.catch_up(inserted), doc.id)
+        self.assertEqual([row[0] for row in self.db.search("zebra", inserted)], [inserted])
+        self.assertIsNone(self.repo.catch_up("not-a-document"))
+
+
+class FindPathTest(RepoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.doc = document("a", "b")
+        self.doc.children[0].children[1].insert("0", Document("strong"))
+        self.repo.insert_tree(self.doc)
+
+    def test_uncached_documents_load_only_the_subtree(self):
+        repo = self.new_repo()
+        with repo.reading(self.doc.id):
+            root_id, node = repo.find_path(self.doc.id, "0/1")
+            self.assertEqual(root_id, self.doc.id)
+            self.assertEqual(node.to_dict(), self.doc.children[0].children[1].to_dict())
+            self.assertEqual(repo.find_path(self.doc.id, "0/0/content"), (self.doc.id, "a"))
+            _, shallow = repo.find_path(self.doc.id, "0", depth=0)
+            self.assertEqual(shallow.children, [])
+        self.assertEqual(len(repo.documents), 0)
+
+    def test_paths_from_a_nested_node(self):
+        paragraph = self.doc.children[0]
+        repo = self.new_repo()
+        with repo.reading(paragraph.id):
+            self.assertEqual(repo.find_path(paragraph.id, "1/0")[1].id, paragraph.children[1].children[0].id)
+            self.assertEqual(repo.find_path(paragraph.id, "")[1].id, paragraph.id)
+
+    def test_documents_behind_their_log_are_read_from_the_cache(self):
+        self.edit(self.repo, self.doc.id, "0/0/content", "changed")
+        with self.repo.reading(self.doc.id):
+            self.assertEqual(self.repo.find_path(self.doc.id, "0/0/content"), (self.doc.id, "changed"))
+        # a restarted server recovers first, which brings the rows up to date
+        self.new_repo().recover()
+        repo = self.new_repo()
+        with repo.reading(self.doc.id):
+            self.assertEqual(repo.find_path(self.doc.id, "0/0/content"), (self.doc.id, "changed"))
+
+    def test_bad_paths(self):
+        repo = self.new_repo()
+        with repo.reading(self.doc.id):
+            with self.assertRaises(ValueError):
+                repo.find_path(self.doc.id, "0/7")
+            with self.assertRaises(ValueError):
+                repo.find_path(self.doc.id, "x/0")
+        self.assertEqual(repo.find_path("not-a-document", "0"), (None, None))
+
+
+class ListTest(RepoTestCase):
+
+    def test_roots_are_listed_a_page_at_a_time(self):
+        docs = [document(f"text {i}") for i in range(5)]
+        for doc in docs:
+            self.repo.insert_tree(doc)
+        self.repo.insert_tree(Document("document", attributes={"title": "Titled"}))
+        seen, cursor = [], None
+        while True:
+            items, cursor = self.repo.list_all(cursor, limit=2)
+            seen.extend(items)
+            if cursor is None:
+                break
+            self.assertEqual(len(items), 2)
+        self.assertEqual([item["id"] for item in seen], sorted(item["id"] for item in seen))
+        by_id = {item["id"]: item for item in seen}
+        self.assertEqual(len(by_id), 6)
+        self.assertEqual(by_id[docs[0].id]["title"], "text 0")
+        self.assertEqual(by_id[docs[0].id]["size"], 3)
+        self.assertIn("Titled", [item["title"] for item in seen])
+
+    def test_summaries_follow_checkpoints(self):
+        doc = document("old")
+        self.repo.insert_tree(doc)
+        self.edit(self.repo, doc.id, "0/0/content", "new")
+        self.assertEqual(self.repo.list_all()[0][0]["title"], "old")
+        self.repo.catch_up(doc.id)
+        self.assertEqual(self.repo.list_all()[0][0]["title"], "new")
+
+
+if __name__ == "__main__":
+    unittest.main()